@@ -0,0 +1,81 @@
+"""
+Per-cell statistics of label maps with thousands of cells: regionprops
+with koopa's cell properties, regionprops with all properties of
+koopaflows.cell_stats, and the bincount engine itself.
+
+    python benchmarks/cell_stats.py [--size 4096] [--cells 5000]
+"""
+import argparse
+import time
+
+import numpy as np
+from koopaflows.cell_stats import cell_stats
+from skimage.draw import ellipse
+from skimage.measure import regionprops_table
+
+
+def labels_2d(size: int, cells: int, rng) -> np.ndarray:
+    labels = np.zeros((size, size), dtype=np.uint16)
+    for label in range(1, cells + 1):
+        rr, cc = ellipse(*rng.integers(0, size, 2), *rng.integers(5, 30, 2),
+                         rotation=rng.uniform(0, np.pi), shape=labels.shape)
+        labels[rr, cc] = label
+    return labels
+
+
+def labels_3d(depth: int, size: int, cells: int, rng) -> np.ndarray:
+    labels = np.zeros((depth, size, size), dtype=np.uint16)
+    for label in range(1, cells + 1):
+        z, y, x = rng.integers(0, depth), *rng.integers(0, size, 2)
+        dz, dy, dx = rng.integers(2, 6), *rng.integers(5, 20, 2)
+        labels[max(z - dz, 0):z + dz, max(y - dy, 0):y + dy,
+               max(x - dx, 0):x + dx] = label
+    return labels
+
+
+def timed(fn, repeats: int = 3) -> float:
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=4096)
+    parser.add_argument("--cells", type=int, default=5000)
+    parser.add_argument("--depth", type=int, default=40)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    cases = {
+        "2D": (labels_2d(args.size, args.cells, rng),
+               ["label", "area", "eccentricity"]),
+        "3D": (labels_3d(args.depth, args.size // 4, args.cells, rng),
+               ["label", "area"]),
+    }
+    all_properties = ["label", "area", "centroid", "bbox", "inertia_tensor",
+                      "inertia_tensor_eigvals", "intensity_mean"]
+
+    print(f"{'map':<5}{'shape':>20}{'cells':>7}{'koopa props s':>15}"
+          f"{'all props s':>13}{'cell_stats s':>14}{'area only s':>13}")
+    for name, (labels, properties) in cases.items():
+        image = rng.random(labels.shape, dtype=np.float32)
+        n_cells = len(np.unique(labels)) - 1
+        koopa_props = timed(lambda: regionprops_table(labels,
+                                                      properties=properties))
+        reference = timed(lambda: regionprops_table(
+            labels, intensity_image=image,
+            properties=all_properties + properties[2:],
+        ))
+        engine = timed(lambda: cell_stats(labels, image))
+        area_only = timed(lambda: cell_stats(labels, geometry=False))
+        print(f"{name:<5}{str(labels.shape):>20}{n_cells:>7}"
+              f"{koopa_props:>15.2f}{reference:>13.2f}{engine:>14.2f}"
+              f"{area_only:>13.2f}")
+
+
+if __name__ == "__main__":
+    main()
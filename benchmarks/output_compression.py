@@ -0,0 +1,91 @@
+"""
+Bytes written and read throughput per codec for intensity images and label
+maps, as written by the koopaflows image targets.
+
+    python benchmarks/output_compression.py [--size 2048] [--channels 3]
+"""
+import argparse
+import os
+import tempfile
+import time
+from os.path import getsize, join
+
+import numpy as np
+import tifffile
+from koopaflows.cpr_image import Compression, tiff_compression_kwargs
+from skimage.draw import disk
+
+
+def intensity_image(channels: int, size: int, rng) -> np.ndarray:
+    image = rng.normal(300, 20, size=(channels, size, size))
+    for _ in range(size // 8):
+        y, x = rng.integers(0, size, 2)
+        rr, cc = disk((y, x), rng.integers(10, 40), shape=(size, size))
+        image[:, rr, cc] += rng.normal(2000, 200)
+    return image.clip(0, 65535).astype(np.uint16)
+
+
+def label_image(size: int, rng) -> np.ndarray:
+    labels = np.zeros((size, size), dtype=np.uint16)
+    for label in range(1, size // 8):
+        y, x = rng.integers(0, size, 2)
+        rr, cc = disk((y, x), rng.integers(20, 60), shape=(size, size))
+        labels[rr, cc] = label
+    return labels
+
+
+def benchmark(data: np.ndarray, compression: Compression, tmp_dir: str):
+    path = join(tmp_dir, "image.tif")
+    kwargs = tiff_compression_kwargs(compression.dict())
+    start = time.perf_counter()
+    tifffile.imwrite(path, data, **kwargs)
+    write_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    tifffile.imread(path)
+    read_s = time.perf_counter() - start
+
+    size = getsize(path)
+    os.remove(path)
+    return size, data.nbytes / 1e6 / write_s, data.nbytes / 1e6 / read_s
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=2048)
+    parser.add_argument("--channels", type=int, default=3)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    outputs = {
+        "intensity": intensity_image(args.channels, args.size, rng),
+        "labels": label_image(args.size, rng),
+    }
+    codecs = [Compression(codec="none")]
+    for codec in ("zstd", "deflate"):
+        for level in (1, 3, 9):
+            codecs.append(Compression(codec=codec, level=level))
+            codecs.append(Compression(codec=codec, level=level, predictor=True))
+
+    print(f"{'output':<10}{'codec':<10}{'level':>6}{'pred':>6}"
+          f"{'MB written':>12}{'ratio':>8}{'write MB/s':>12}{'read MB/s':>11}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for kind, data in outputs.items():
+            for compression in codecs:
+                try:
+                    size, write_mbs, read_mbs = benchmark(data, compression,
+                                                          tmp_dir)
+                except ImportError:
+                    print(f"{kind:<10}{compression.codec:<10}"
+                          f"{compression.level:>6}"
+                          f"{compression.predictor!s:>6}"
+                          f"  needs imagecodecs (koopa-flows[tiff])")
+                    continue
+                print(f"{kind:<10}{compression.codec:<10}"
+                      f"{compression.level:>6}{compression.predictor!s:>6}"
+                      f"{size / 1e6:>12.2f}{data.nbytes / size:>8.1f}"
+                      f"{write_mbs:>12.0f}{read_mbs:>11.0f}")
+
+
+if __name__ == "__main__":
+    main()
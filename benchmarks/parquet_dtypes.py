@@ -0,0 +1,73 @@
+"""
+On-disk size and in-memory footprint of a synthetic spot table written with
+plain pandas dtypes and with the compact dtypes of the koopaflows parquet
+targets.
+
+    python benchmarks/parquet_dtypes.py [--images 1000] [--spots 2000]
+"""
+import argparse
+import tempfile
+import time
+from os.path import getsize, join
+
+import numpy as np
+import pandas as pd
+from koopaflows.cpr_parquet import read_parquet, write_parquet
+
+
+def spot_table(images: int, spots: int, rng) -> pd.DataFrame:
+    n = images * spots
+    return pd.DataFrame({
+        "FileID": np.repeat([f"image_{i:05d}" for i in range(images)], spots),
+        "y": rng.uniform(0, 2048, n),
+        "x": rng.uniform(0, 2048, n),
+        "mass": rng.gamma(2.0, 500.0, n),
+        "size": rng.uniform(1.0, 3.0, n),
+        "frame": rng.integers(0, 40, n),
+        "channel": np.full(n, 1),
+        "cell_id": rng.integers(0, 300, n),
+        "particle": rng.integers(0, 20000, n),
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--images", type=int, default=1000)
+    parser.add_argument("--spots", type=int, default=2000)
+    args = parser.parse_args()
+
+    df = spot_table(args.images, args.spots, np.random.default_rng(0))
+    print(f"{len(df)} spots in {args.images} images")
+    print(f"{'layout':<10}{'MB on disk':>12}{'write s':>10}{'read s':>9}"
+          f"{'MB in memory':>14}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = join(tmp_dir, "legacy.parq")
+        start = time.perf_counter()
+        df.to_parquet(path)
+        write_s = time.perf_counter() - start
+        start = time.perf_counter()
+        legacy = pd.read_parquet(path)
+        read_s = time.perf_counter() - start
+        print(f"{'legacy':<10}{getsize(path) / 1e6:>12.1f}{write_s:>10.2f}"
+              f"{read_s:>9.2f}"
+              f"{legacy.memory_usage(deep=True).sum() / 1e6:>14.1f}")
+
+        path = join(tmp_dir, "compact.parq")
+        start = time.perf_counter()
+        write_parquet(path, df)
+        write_s = time.perf_counter() - start
+        start = time.perf_counter()
+        compact = read_parquet(path, restore=False)
+        read_s = time.perf_counter() - start
+        print(f"{'compact':<10}{getsize(path) / 1e6:>12.1f}{write_s:>10.2f}"
+              f"{read_s:>9.2f}"
+              f"{compact.memory_usage(deep=True).sum() / 1e6:>14.1f}")
+
+        restored = read_parquet(path)
+        max_error = (restored[["y", "x"]] - df[["y", "x"]]).abs().max().max()
+        print(f"Max. coordinate error after float32 round trip: "
+              f"{max_error:.2e} px")
+
+
+if __name__ == "__main__":
+    main()
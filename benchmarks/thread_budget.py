@@ -0,0 +1,61 @@
+"""
+Throughput of concurrent BLAS-heavy tasks in one process, with every task
+using the libraries' default thread pools and with the per-task thread
+budget of koopaflows.threads. Without a budget, N concurrent tasks start
+N full-width thread pools on the same cores.
+
+    python benchmarks/thread_budget.py [--size 1024] [--tasks 32]
+"""
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from koopaflows.threads import available_cores, budgeted, task_slots
+
+
+def work(a: np.ndarray, repeats: int = 4) -> float:
+    for _ in range(repeats):
+        a = np.tanh(a @ a)
+    return float(a[0, 0])
+
+
+def throughput(fn, n_tasks: int, concurrency: int, size: int,
+               repeats: int = 2) -> float:
+    """Tasks per second with `concurrency` tasks running at a time."""
+    rng = np.random.default_rng(0)
+    inputs = [rng.standard_normal((size, size)) / size
+              for _ in range(n_tasks)]
+    best = 0
+    for _ in range(repeats):
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(fn, inputs))
+        best = max(best, n_tasks / (time.perf_counter() - start))
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=1024)
+    parser.add_argument("--tasks", type=int, default=32)
+    args = parser.parse_args()
+
+    cores = len(available_cores())
+    print(f"{cores} cores, {args.tasks} tasks of {args.size}x{args.size} "
+          f"matrix products.")
+    print(f"{'concurrency':>11} {'default [tasks/s]':>18} "
+          f"{'budgeted [tasks/s]':>19}")
+    # Warm up the BLAS thread pools.
+    throughput(work, cores, cores, args.size, repeats=1)
+    for concurrency in sorted({1, 2, 4, cores, 2 * cores, 48}):
+        default = throughput(work, args.tasks, concurrency, args.size)
+        # Like the flows, which run a stage with `concurrency` slots.
+        with task_slots(concurrency):
+            limited = throughput(budgeted(work), args.tasks, concurrency,
+                                 args.size)
+        print(f"{concurrency:>11} {default:>18.2f} {limited:>19.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+import os
+from os.path import join
+from typing import Literal, Optional, Union
+
+import numpy as np
+import pandas as pd
+import tifffile
+from cpr.Resource import Resource
+from cpr.image.ImageSource import ImageSource
+from cpr.image.ImageTarget import ImageTarget
+from koopaflows.cpr_zarr import ZarrImageTarget
+from koopaflows.labels import compact_labels, compute_object_index
+from pydantic import BaseModel
+
+ImageFormat = Literal["tif", "zarr"]
+
+
+class Compression(BaseModel):
+    # zstd TIFFs need imagecodecs (`koopa-flows[tiff]`), deflate falls
+    # back to zlib.
+    codec: Literal["none", "zstd", "lz4", "deflate"] = "none"
+    level: int = 3
+    # Horizontal differencing, only useful for intensity images.
+    predictor: bool = False
+
+
+class OutputCompression(BaseModel):
+    images: Compression = Compression()
+    labels: Compression = Compression()
+
+
+def tiff_compression_kwargs(compression: Optional[dict]) -> dict:
+    """`tifffile.imwrite` arguments for a `Compression` setting."""
+    if compression is None or compression["codec"] == "none":
+        return {}
+
+    if compression["codec"] == "lz4":
+        raise ValueError("LZ4 is not a TIFF compression, use the zarr "
+                         "image format or zstd.")
+
+    return {
+        "compression": compression["codec"],
+        "compressionargs": {"level": compression["level"]},
+        "predictor": compression["predictor"],
+    }
+
+
+def read_tiff_region(path: str, slices: tuple) -> Optional[np.ndarray]:
+    """
+    Read `slices` of an uncompressed TIFF through a memory map, so only the
+    requested planes are read from disk. Returns None if the file can not
+    be memory-mapped (e.g. compressed).
+    """
+    try:
+        data = tifffile.memmap(path, mode="r")
+    except ValueError:
+        return None
+
+    region = np.array(data[slices])
+    del data
+    return region
+
+
+class LazyTiffMixin:
+    """
+    Channel- and region-selective reads for TIFF files. Compressed files
+    fall back to a full read.
+    """
+
+    def get_channel(self, channel: int) -> np.ndarray:
+        return self.get_region((channel,))
+
+    def get_region(self, slices: tuple) -> np.ndarray:
+        if self._data is None:
+            region = read_tiff_region(self.get_path(), slices)
+            if region is not None:
+                return region
+
+        return self.get_data()[slices]
+
+
+class TiffImageSource(LazyTiffMixin, ImageSource):
+    pass
+
+
+class TiffImageTarget(LazyTiffMixin, ImageTarget):
+    def __init__(self, *args, compression: Optional[dict] = None, **kwargs):
+        super(TiffImageTarget, self).__init__(*args, **kwargs)
+        self.compression = compression
+
+    def serialize(self) -> dict:
+        data = super(TiffImageTarget, self).serialize()
+        data["compression"] = self.compression
+        return data
+
+    def _write_data(self):
+        kwargs = tiff_compression_kwargs(self.compression)
+        if len(kwargs) == 0:
+            super(TiffImageTarget, self)._write_data()
+        elif self._data is not None:
+            # ImageJ hyperstacks can not be compressed.
+            tifffile.imwrite(
+                self.get_path(),
+                self._data,
+                metadata=self.get_metadata(),
+                resolution=self.get_resolution(),
+                **kwargs,
+            )
+
+
+class LabelIndexMixin:
+    """
+    Label maps are stored with the smallest sufficient unsigned dtype and a
+    sidecar `<name>.objects.parq` with the per-object index (area, centroid,
+    bounding box), so consumers can look up cells without scanning the map.
+    The serialized state is marked with `labels`, see `image_from_dict`.
+    """
+
+    def __init__(self, *args, labels: bool = True, **kwargs):
+        super(LabelIndexMixin, self).__init__(*args, **kwargs)
+
+    def serialize(self) -> dict:
+        data = super(LabelIndexMixin, self).serialize()
+        data["labels"] = True
+        return data
+
+    def get_index_path(self) -> str:
+        return join(os.path.dirname(self.get_path()),
+                    self.get_name() + ".objects.parq")
+
+    def set_data(self, data: np.ndarray):
+        super(LabelIndexMixin, self).set_data(compact_labels(data))
+
+    def get_object_index(self) -> pd.DataFrame:
+        if os.path.exists(self.get_index_path()):
+            return pd.read_parquet(self.get_index_path())
+
+        return compute_object_index(self.get_data())
+
+    def _write_data(self):
+        super(LabelIndexMixin, self)._write_data()
+        if self._data is not None:
+            compute_object_index(self._data).to_parquet(
+                self.get_index_path(), index=False
+            )
+
+
+class TiffLabelTarget(LabelIndexMixin, TiffImageTarget):
+    pass
+
+
+class ZarrLabelTarget(LabelIndexMixin, ZarrImageTarget):
+    pass
+
+
+def create_image_target(
+    out_dir: str,
+    name: str,
+    image_format: ImageFormat = "tif",
+    compression: Optional[Compression] = None,
+    labels: bool = False,
+    **kwargs,
+) -> Union[TiffImageTarget, ZarrImageTarget]:
+    """
+    Image target in `out_dir` in the requested format. `kwargs` are passed
+    to the TIFF target; the zarr target only keeps the metadata. Label maps
+    (`labels=True`) are written compactly together with an object index.
+    """
+    if compression is not None:
+        compression = compression.dict()
+
+    if image_format == "zarr":
+        clazz = ZarrLabelTarget if labels else ZarrImageTarget
+        return clazz(
+            location=out_dir,
+            name=name,
+            metadata=kwargs.get("metadata"),
+            compression=compression,
+        )
+
+    clazz = TiffLabelTarget if labels else TiffImageTarget
+    return clazz(location=out_dir, name=name, ext=".tif",
+                 compression=compression, **kwargs)
+
+
+def image_from_dict(
+    data: dict,
+) -> Union[TiffImageSource, TiffImageTarget, ZarrImageTarget]:
+    """Restore a serialized image resource of any supported format."""
+    labels = data.get("labels", False)
+    if data.get("ext") == ".zarr":
+        return (ZarrLabelTarget if labels else ZarrImageTarget)(**data)
+    elif "data_hash" in data.keys():
+        return (TiffLabelTarget if labels else TiffImageTarget)(**data)
+    else:
+        return TiffImageSource(**data)
+
+
+def open_label_array(image: Resource):
+    """
+    Lazily indexed array of a label map: the loaded data, the zarr array or
+    a read-only memory map of an uncompressed TIFF. Falls back to a full
+    read otherwise.
+    """
+    if image._data is not None:
+        return image._data
+
+    if hasattr(image, "get_array"):
+        return image.get_array()
+
+    if image.get_path().endswith((".tif", ".tiff")):
+        try:
+            return tifffile.memmap(image.get_path(), mode="r")
+        except ValueError:
+            pass
+
+    return image.get_data()
+
+
+def read_channel(image: Resource, channel: int) -> np.ndarray:
+    """Read a single channel, lazily if the image supports it."""
+    if hasattr(image, "get_channel"):
+        return image.get_channel(channel)
+
+    if image._data is None and image.get_path().endswith((".tif", ".tiff")):
+        region = read_tiff_region(image.get_path(), (channel,))
+        if region is not None:
+            return region
+
+    return image.get_data()[channel]
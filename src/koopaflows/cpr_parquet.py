@@ -1,9 +1,12 @@
+import json
 import os
-from os.path import exists
+from os.path import exists, join
+from typing import Optional
 
 import cpr
-import koopa.io
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import xxhash
 from cpr.Resource import Resource
 from cpr.Serializer import cpr_serializer
@@ -12,19 +15,127 @@ from prefect.serializers import JSONSerializer
 from prefect.utilities.importtools import from_qualified_name
 
 
-class ParquetSource(Resource):
+DTYPES_METADATA_KEY = b"koopaflows.dtypes"
+
+# Integer columns which are downcast to the narrowest sufficient type.
+COMPACT_INTEGER_COLUMNS = ("frame", "channel", "cell_id", "particle")
+
+
+def compact_dtypes(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Compact representation of a spot or cell table: dictionary encoded
+    FileID, float32 coordinates/features and narrow frame/channel/id
+    integers.
+    """
+    compact = {}
+    for column, dtype in df.dtypes.items():
+        if column == "FileID":
+            compact[column] = df[column].astype("category")
+        elif column in COMPACT_INTEGER_COLUMNS and \
+                pd.api.types.is_integer_dtype(dtype):
+            compact[column] = pd.to_numeric(df[column], downcast="integer")
+        elif dtype == "float64":
+            compact[column] = df[column].astype("float32")
+        else:
+            compact[column] = df[column]
+
+    return pd.DataFrame(compact)
+
+
+def restore_dtypes(df: pd.DataFrame, metadata: Optional[dict]) -> pd.DataFrame:
+    """Cast a table read from a compact parquet file back to its dtypes."""
+    if metadata is None or DTYPES_METADATA_KEY not in metadata:
+        return df
+
+    dtypes = json.loads(metadata[DTYPES_METADATA_KEY])
+    return df.astype({c: dt for c, dt in dtypes.items() if c in df.columns})
+
+
+def to_compact_table(df: pd.DataFrame) -> pa.Table:
+    """Arrow table with compact dtypes, remembering the original ones."""
+    table = pa.Table.from_pandas(compact_dtypes(df), preserve_index=False)
+    metadata = dict(table.schema.metadata or {})
+    metadata[DTYPES_METADATA_KEY] = json.dumps(
+        {str(c): str(dt) for c, dt in df.dtypes.items()}
+    ).encode()
+    return table.replace_schema_metadata(metadata)
+
+
+def write_parquet(path: str, df: pd.DataFrame):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    pq.write_table(to_compact_table(df), path)
+
+
+def read_parquet(
+    path: str,
+    columns: Optional[list[str]] = None,
+    filters: Optional[list[tuple]] = None,
+    restore: bool = True,
+) -> pd.DataFrame:
+    """
+    Read a parquet file, by default with the dtypes of the written table.
+    `restore=False` keeps the compact in-memory representation.
+    """
+    table = pq.read_table(path, columns=columns, filters=filters)
+    df = table.to_pandas()
+    if restore:
+        df = restore_dtypes(df, table.schema.metadata)
+    return df
+
+
+class ParquetProjectionMixin:
+    """
+    Reads of a subset of columns and/or rows (pyarrow `filters`), cached per
+    projection. Filters are pushed down to the parquet row groups.
+
+    The spot tables of the flows are read whole: colocalization, NMS and
+    both merges (including the sparse one) return every input column in
+    their output, so a projection would not save any reads there.
+    """
+
+    def _get_projection(
+        self,
+        columns: Optional[list[str]],
+        filters: Optional[list[tuple]],
+    ) -> pd.DataFrame:
+        if filters is None and self._data is not None:
+            return self._data[columns]
+
+        if not hasattr(self, "_projections"):
+            self._projections = {}
+
+        key = (None if columns is None else tuple(columns), repr(filters))
+        if key not in self._projections:
+            assert os.path.exists(self.get_path()), (
+                f"{self.get_path()} does not exist."
+            )
+            self._projections[key] = read_parquet(
+                self.get_path(), columns=columns, filters=filters
+            )
+
+        return self._projections[key]
+
+
+class ParquetSource(ParquetProjectionMixin, Resource):
     def __init__(self, location: str, name: str, ext: str):
         super(ParquetSource, self).__init__(location=location, name=name, ext=ext)
 
-    def get_data(self) -> pd.DataFrame:
+    def get_data(
+        self,
+        columns: Optional[list[str]] = None,
+        filters: Optional[list[tuple]] = None,
+    ) -> pd.DataFrame:
+        if columns is not None or filters is not None:
+            return self._get_projection(columns, filters)
+
         if self._data is None:
             assert os.path.exists(self.get_path()), f"{self.get_path()} does not exist."
-            self._data = koopa.io.load_parquet(self.get_path())
+            self._data = read_parquet(self.get_path())
 
         return self._data
 
 
-class ParquetTarget(Target):
+class ParquetTarget(ParquetProjectionMixin, Target):
     def __init__(
         self,
         location: str,
@@ -36,12 +147,19 @@ class ParquetTarget(Target):
             location=location, name=name, ext=ext, data_hash=data_hash
         )
 
-    def get_data(self) -> pd.DataFrame:
+    def get_data(
+        self,
+        columns: Optional[list[str]] = None,
+        filters: Optional[list[tuple]] = None,
+    ) -> pd.DataFrame:
+        if columns is not None or filters is not None:
+            return self._get_projection(columns, filters)
+
         if self._data is None:
             assert os.path.exists(self.get_path()), (
                 f"{self.get_path()} does not " f"exist."
             )
-            self._data = koopa.io.load_parquet(self.get_path())
+            self._data = read_parquet(self.get_path())
 
         return self._data
 
@@ -51,7 +169,120 @@ class ParquetTarget(Target):
 
     def _write_data(self):
         if self._data is not None and not exists(self.get_path()):
-            koopa.io.save_parquet(self.get_path(), self._data)
+            write_parquet(self.get_path(), self._data)
+
+class ParquetDatasetSource(ParquetProjectionMixin, Resource):
+    """
+    Rows of a single image (`name` is the FileID) in a consolidated
+    per-channel parquet dataset `<location>/<dataset_name><ext>`, which
+    stores one row group per FileID. Reads use predicate pushdown on the
+    FileID statistics and only touch the row group of this image.
+
+    `data_hash` is the hash of the rows, so cache keys change with the
+    content even though the dataset path does not.
+    """
+
+    def __init__(
+        self,
+        location: str,
+        name: str,
+        ext: str = ".parq",
+        dataset_name: str = None,
+        data_hash: str = None,
+    ):
+        super(ParquetDatasetSource, self).__init__(
+            location=location, name=name, ext=ext
+        )
+        self.dataset_name = dataset_name
+        self.data_hash = data_hash
+
+    def get_path(self) -> str:
+        return join(self.location, self.dataset_name + self.ext)
+
+    def get_data(
+        self,
+        columns: Optional[list[str]] = None,
+        filters: Optional[list[tuple]] = None,
+    ) -> pd.DataFrame:
+        file_filter = [("FileID", "==", self.get_name())]
+        if columns is not None or filters is not None:
+            return self._get_projection(columns, file_filter + (filters or []))
+
+        if self._data is None:
+            self._data = self._get_projection(None, file_filter)
+
+        return self._data
+
+    def serialize(self) -> dict:
+        data = super(ParquetDatasetSource, self).serialize()
+        data["dataset_name"] = self.dataset_name
+        data["data_hash"] = self.data_hash
+        return data
+
+
+def consolidate_parquet_targets(
+    targets: list[ParquetTarget],
+    dataset_path: str,
+) -> list[ParquetDatasetSource]:
+    """
+    Write per-image parquet files into a single dataset with one row group
+    per FileID and remove the per-image files. Only the row groups of the
+    given images are replaced, images of earlier runs stay in the dataset.
+    Images whose file was already consolidated by an earlier run are taken
+    from the existing dataset.
+    """
+    names = [target.get_name() for target in targets]
+    dfs = []
+    if exists(dataset_path):
+        kept = read_parquet(dataset_path, filters=[("FileID", "not in", names)])
+        dfs.extend(df for _, df in kept.groupby("FileID", sort=False,
+                                                  observed=True))
+    for target in targets:
+        if exists(target.get_path()):
+            dfs.append(read_parquet(target.get_path()))
+        else:
+            dfs.append(read_parquet(
+                dataset_path, filters=[("FileID", "==", target.get_name())]
+            ))
+
+    # A common compact schema for all images, every image is written as
+    # a slice of the combined table.
+    table = to_compact_table(pd.concat(dfs, ignore_index=True))
+    tmp_path = f"{dataset_path}.{os.getpid()}.tmp"
+    with pq.ParquetWriter(tmp_path, table.schema,
+                          write_statistics=True) as writer:
+        offset = 0
+        for df in dfs:
+            writer.write_table(table.slice(offset, len(df)),
+                               row_group_size=max(1, len(df)))
+            offset += len(df)
+
+    metadata = pq.read_metadata(tmp_path)
+    if metadata.num_rows != table.num_rows:
+        os.remove(tmp_path)
+        raise IOError(
+            f"Writing {dataset_path} failed: {metadata.num_rows} of "
+            f"{table.num_rows} rows written."
+        )
+    os.replace(tmp_path, dataset_path)
+
+    for target in targets:
+        if exists(target.get_path()):
+            os.remove(target.get_path())
+
+    location = os.path.dirname(dataset_path)
+    dataset_name, ext = os.path.splitext(os.path.basename(dataset_path))
+    return [
+        ParquetDatasetSource(
+            location=location,
+            name=target.get_name(),
+            ext=ext,
+            dataset_name=dataset_name,
+            data_hash=target.data_hash,
+        )
+        for target in targets
+    ]
+
 
 def target_decoder(result: dict):
     """
@@ -60,7 +291,7 @@ def target_decoder(result: dict):
         Otherwise prefect_json_object_decoder is used.
         """
     if "__class__" in result:
-        if result["__class__"].startswith("koopaflows.cpr_parquet."):
+        if result["__class__"].startswith("koopaflows."):
             clazz = from_qualified_name(result["__class__"])
             return clazz(**result["data"])
         else:
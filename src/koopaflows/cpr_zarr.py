@@ -0,0 +1,121 @@
+import os
+from typing import Optional
+
+import numpy as np
+import xxhash
+from cpr.Target import Target
+
+
+def blosc_compressor(compression: Optional[dict]):
+    """Blosc compressor for a `Compression` setting, lz4 by default."""
+    from numcodecs import Blosc
+
+    if compression is None:
+        return Blosc(cname="lz4", clevel=5, shuffle=Blosc.BITSHUFFLE)
+    if compression["codec"] == "none":
+        return None
+
+    cname = "zlib" if compression["codec"] == "deflate" else \
+        compression["codec"]
+    return Blosc(
+        cname=cname,
+        clevel=compression["level"],
+        shuffle=Blosc.BITSHUFFLE if compression["predictor"] else Blosc.SHUFFLE,
+    )
+
+
+class ZarrImageTarget(Target):
+    """
+    Image stored as a chunked zarr array with one chunk per channel/plane,
+    compressed with blosc (lz4 unless configured otherwise). Channels and
+    regions can be read lazily without decoding the whole image.
+    """
+
+    def __init__(
+        self,
+        location: str,
+        name: str,
+        ext: str = ".zarr",
+        data_hash: str = None,
+        metadata: Optional[dict] = None,
+        resolution: Optional[list] = None,
+        compression: Optional[dict] = None,
+    ):
+        super(ZarrImageTarget, self).__init__(
+            location=location, name=name, ext=ext, data_hash=data_hash
+        )
+        self.metadata = metadata
+        self.resolution = resolution
+        self.compression = compression
+
+    def get_metadata(self) -> Optional[dict]:
+        return self.metadata
+
+    def set_metadata(self, metadata: Optional[dict]):
+        self.metadata = metadata
+
+    def get_resolution(self) -> Optional[list]:
+        return self.resolution
+
+    def set_resolution(self, resolution: Optional[list]):
+        self.resolution = resolution
+
+    def get_array(self):
+        """Lazy zarr array, nothing is read until it is indexed."""
+        import zarr
+
+        assert os.path.exists(self.get_path()), (
+            f"{self.get_path()} does not " f"exist."
+        )
+        return zarr.open_array(self.get_path(), mode="r")
+
+    def get_data(self) -> np.ndarray:
+        if self._data is None:
+            self._data = self.get_array()[...]
+
+        return self._data
+
+    def get_channel(self, channel: int) -> np.ndarray:
+        if self._data is not None:
+            return self._data[channel]
+
+        return self.get_array()[channel]
+
+    def get_region(self, slices: tuple) -> np.ndarray:
+        if self._data is not None:
+            return self._data[slices]
+
+        return self.get_array()[slices]
+
+    def serialize(self) -> dict:
+        data = super(ZarrImageTarget, self).serialize()
+        data["metadata"] = self.metadata
+        data["resolution"] = self.resolution
+        data["compression"] = self.compression
+        return data
+
+    def _hash_data(self, data) -> str:
+        return xxhash.xxh3_64(np.ascontiguousarray(data)).hexdigest()
+
+    def _write_data(self):
+        if self._data is not None:
+            import zarr
+
+            chunks = (1,) * (self._data.ndim - 2) + self._data.shape[-2:]
+            # Images are always written as zarr v2 arrays (`.zarray`), which
+            # zarr 3 only does if asked for; zarr 2 has no such argument.
+            version = {}
+            if int(zarr.__version__.split(".")[0]) >= 3:
+                version["zarr_format"] = 2
+            array = zarr.open_array(
+                self.get_path(),
+                mode="w",
+                shape=self._data.shape,
+                chunks=chunks,
+                dtype=self._data.dtype,
+                compressor=blosc_compressor(self.compression),
+                **version,
+            )
+            array[...] = self._data
+            array.attrs["metadata"] = self.metadata
+            array.attrs["resolution"] = self.resolution
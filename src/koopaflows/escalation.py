@@ -0,0 +1,155 @@
+import os
+import signal
+from datetime import datetime
+from typing import Callable, Optional
+
+from koopaflows.recycling import ProcessRecycling, WorkerDied
+from koopaflows.task_runners import cluster_config_from_env
+from prefect.futures import PrefectFuture
+from pydantic import BaseModel
+
+# Written to the run directory when tasks are rerun with more memory.
+ESCALATION_REPORT = "memory_escalations.md"
+
+# Exit codes of processes killed by the kernel or SLURM OOM killer.
+OOM_EXIT_CODES = (-signal.SIGKILL, 128 + signal.SIGKILL)
+OOM_MESSAGES = ("MemoryError", "out of memory", "Out Of Memory",
+                "oom-kill", "OOM Killer", "KilledWorker")
+
+
+class MemoryEscalation(BaseModel):
+    active: bool = True
+    # Reruns after an out-of-memory failure, each with `factor` times the
+    # memory of the previous attempt.
+    max_attempts: int = 2
+    factor: float = 2
+
+
+def raises_memory(recycling: ProcessRecycling) -> bool:
+    """
+    Whether a rerun with a memory factor gets more memory: the tasks
+    reserve memory on dask workers (`KOOPAFLOWS_CLUSTER_CONFIG`) or their
+    recycled subprocesses have a memory limit.
+    """
+    return cluster_config_from_env() is not None or \
+        (recycling.active and recycling.memory_limit > 0)
+
+
+def is_out_of_memory(error: Optional[BaseException]) -> bool:
+    """Whether a task failure was caused by running out of memory."""
+    while error is not None:
+        if isinstance(error, MemoryError):
+            return True
+        if isinstance(error, WorkerDied) and \
+                error.exitcode in OOM_EXIT_CODES:
+            return True
+        if type(error).__name__ == "KilledWorker" or \
+                any(m in str(error) for m in OOM_MESSAGES):
+            return True
+        error = error.__cause__
+    return False
+
+
+class EscalationReport:
+    """
+    Tasks which were rerun with more memory and how they ended. The report
+    is rewritten to `path` with every entry, so it survives a failing flow.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries: list[dict] = []
+
+    def add(self, stage: str, name: str, memory_factor: float,
+            outcome: str, error: Optional[BaseException] = None):
+        self.entries.append({
+            "stage": stage,
+            "name": name,
+            "memory_factor": memory_factor,
+            "outcome": outcome,
+            "error": "" if error is None else repr(error).splitlines()[0],
+        })
+        self.write()
+
+    def write(self):
+        lines = [
+            "# Memory escalations",
+            f"Date: {datetime.now().strftime('%Y/%m/%d, %H:%M:%S')}",
+            "",
+            "| Stage | Name | Memory factor | Outcome | Error |",
+            "| --- | --- | --- | --- | --- |",
+        ]
+        for e in self.entries:
+            lines.append(f"| {e['stage']} | {e['name']} | "
+                         f"{e['memory_factor']:g} | {e['outcome']} | "
+                         f"{e['error'].replace('|', '/')} |")
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)),
+                    exist_ok=True)
+        with open(self.path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+
+
+def _failure(future: PrefectFuture) -> Optional[BaseException]:
+    result = future.result(raise_on_failure=False)
+    if future.get_state().is_completed():
+        return None
+    if isinstance(result, BaseException):
+        return result
+    return RuntimeError(future.get_state().message)
+
+
+def retry_out_of_memory(
+    futures: list[PrefectFuture],
+    names: list[str],
+    resubmit: Callable[[int, float], PrefectFuture],
+    stage: str,
+    escalation: MemoryEscalation,
+    report: EscalationReport,
+    logger,
+    escalates: bool = True,
+) -> list:
+    """
+    Results of finished `futures`. Tasks which failed because they ran out
+    of memory are resubmitted with `resubmit(index, memory_factor)` up to
+    `max_attempts` times with growing memory. Without memory to raise
+    (`escalates=False`, see `raises_memory`) they are retried as they were,
+    with a memory factor of 1. Other failures and tasks which still run out
+    of memory are reported and their result is None.
+    """
+    results = [None] * len(futures)
+    pending = dict(enumerate(futures))
+    memory_factor = 1.0
+    for attempt in range(escalation.max_attempts + 1):
+        retry = []
+        for i, future in pending.items():
+            error = _failure(future)
+            if error is None:
+                results[i] = future.result()
+                if attempt > 0:
+                    report.add(stage, names[i], memory_factor, "completed")
+            elif escalation.active and is_out_of_memory(error) and \
+                    attempt < escalation.max_attempts:
+                retry.append(i)
+            else:
+                outcome = "out of memory" if is_out_of_memory(error) \
+                    else "failed"
+                report.add(stage, names[i], memory_factor, outcome, error)
+                logger.error(f"{stage} of {names[i]} {outcome}: {error!r}")
+
+        if len(retry) == 0:
+            break
+
+        if escalates:
+            memory_factor *= escalation.factor
+            logger.warning(f"Rerunning {stage} of {len(retry)} tasks which "
+                           f"ran out of memory with {memory_factor:g}x "
+                           f"memory.")
+        else:
+            logger.warning(f"Retrying {stage} of {len(retry)} tasks which "
+                           f"ran out of memory with the same resources, "
+                           f"there is no memory reservation or limit to "
+                           f"raise.")
+        pending = {i: resubmit(i, memory_factor) for i in retry}
+
+    return results
@@ -0,0 +1,66 @@
+import numpy as np
+import pandas as pd
+from koopaflows.cell_stats import cell_stats
+
+
+def minimal_label_dtype(labels: np.ndarray) -> np.dtype:
+    """Smallest unsigned integer dtype which holds all labels."""
+    max_label = int(labels.max()) if labels.size > 0 else 0
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if max_label <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.uint64)
+
+
+def compact_labels(labels: np.ndarray) -> np.ndarray:
+    assert labels.min(initial=0) >= 0, "Label maps must not be negative."
+    return labels.astype(minimal_label_dtype(labels), copy=False)
+
+
+def compute_object_index(labels: np.ndarray) -> pd.DataFrame:
+    """
+    Per-object index of a label map: area, centroid and bounding box of
+    every label, plus the eccentricity for 2D maps. Columns follow
+    `skimage.measure.regionprops_table` (`centroid-{axis}`, `bbox-{i}` with
+    the exclusive upper bounds last). Leading singleton (channel) axes are
+    dropped.
+    """
+    while labels.ndim > 2 and labels.shape[0] == 1:
+        labels = labels[0]
+
+    stats = cell_stats(labels)
+    columns = ["label", "area"]
+    columns += [f"centroid-{axis}" for axis in range(labels.ndim)]
+    columns += [f"bbox-{i}" for i in range(2 * labels.ndim)]
+    if labels.ndim == 2:
+        columns.append("eccentricity")
+    return stats[columns]
+
+
+def sample_labels(labels, spots: pd.DataFrame) -> np.ndarray:
+    """
+    Label values at the spot coordinates with the semantics of koopa's
+    `get_value`: singleton axes are ignored, coordinates are truncated and
+    clipped to the map. `labels` can be any lazily indexed array (memory
+    map, zarr array), only the touched pages/chunks are read.
+    """
+    axes = [axis for axis, size in enumerate(labels.shape) if size > 1]
+    if len(axes) not in (2, 3):
+        raise ValueError(f"Segmentation image must be 2D or 3D. "
+                         f"Got {len(axes)}D.")
+
+    columns = dict(zip(axes, ["frame", "y", "x"][-len(axes):]))
+    index = []
+    for axis, size in enumerate(labels.shape):
+        if axis not in columns:
+            index.append(np.zeros(len(spots), dtype=np.intp))
+            continue
+
+        values = spots[columns[axis]].to_numpy().astype(np.intp)
+        if columns[axis] != "frame":
+            values = np.minimum(values, size - 1)
+        index.append(values)
+
+    if hasattr(labels, "vindex"):
+        return labels.vindex[tuple(index)]
+    return np.asarray(labels[tuple(index)])
@@ -0,0 +1,152 @@
+import os
+import warnings
+from os.path import exists, join
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+from cpr.Resource import Resource
+from koopaflows.cell_stats import cell_stats
+from koopaflows.cpr_image import open_label_array
+from koopaflows.labels import compute_object_index, sample_labels
+from koopaflows.pipeline import input_fingerprint
+
+
+def _partition_paths(partition_dir: str, name: str) -> tuple[str, str, str]:
+    return (join(partition_dir, f"{name}.spots.parq"),
+            join(partition_dir, f"{name}.cells.parq"),
+            join(partition_dir, f"{name}.fingerprint"))
+
+
+def load_partition(
+    partition_dir: str,
+    name: str,
+    fingerprint: str,
+) -> Optional[tuple[pd.DataFrame, pd.DataFrame]]:
+    """Merged spot and cell tables of an image if its inputs are unchanged."""
+    spots_path, cells_path, fingerprint_path = \
+        _partition_paths(partition_dir, name)
+    if not exists(fingerprint_path):
+        return None
+
+    with open(fingerprint_path) as f:
+        if f.read() != fingerprint:
+            return None
+
+    return pd.read_parquet(spots_path), pd.read_parquet(cells_path)
+
+
+def save_partition(
+    partition_dir: str,
+    name: str,
+    fingerprint: str,
+    df: pd.DataFrame,
+    df_cell: pd.DataFrame,
+):
+    """
+    Store the merged tables of one image. The fingerprint is written last,
+    an interrupted write leaves a partition which is recomputed. The tables
+    are written without compaction, a reused partition gives the same
+    summary as a freshly merged one.
+    """
+    spots_path, cells_path, fingerprint_path = \
+        _partition_paths(partition_dir, name)
+    if exists(fingerprint_path):
+        os.remove(fingerprint_path)
+
+    os.makedirs(partition_dir, exist_ok=True)
+    df.to_parquet(spots_path, index=False)
+    df_cell.to_parquet(cells_path, index=False)
+    with open(fingerprint_path, "w") as f:
+        f.write(fingerprint)
+
+
+def cell_properties(segmap: Resource, name: str) -> pd.DataFrame:
+    """
+    Area and eccentricity per cell, named like koopa's
+    `get_cell_properties`. Taken from the object index of the label map if
+    it has one, otherwise computed from the map.
+    """
+    if hasattr(segmap, "get_object_index"):
+        index = segmap.get_object_index()
+    else:
+        index = compute_object_index(segmap.get_data().squeeze())
+
+    if "eccentricity" not in index.columns:
+        index = compute_object_index(segmap.get_data().squeeze())
+
+    return pd.DataFrame({
+        "cell_id": index["label"].to_numpy(),
+        f"area_{name}": index["area"].to_numpy(dtype="float64"),
+        f"eccentricity_{name}": index["eccentricity"].to_numpy(),
+    })
+
+
+def merge_segmaps_sparse(
+    df: pd.DataFrame,
+    segmaps: dict[str, Resource],
+    fname: str,
+) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    2D equivalent of `koopa.postprocess.merge_segmaps` which samples the
+    label maps only at the spot coordinates and takes the cell properties
+    from the object indices, instead of decoding every label map.
+    """
+    if df["FileID"].nunique() > 1:
+        raise ValueError("Spot files corrupted. Can only contain data from "
+                         "one image.")
+    if not any(i in segmaps for i in ("nuclei", "cyto")):
+        raise ValueError("At least one of 'nuclei' or 'cyto' must be in "
+                         "segmaps")
+
+    df_cell = pd.DataFrame()
+    for select in ("cyto", "nuclei"):
+        if select not in segmaps:
+            warnings.warn(f"Segmap {select} not found (skipping).",
+                          RuntimeWarning)
+            continue
+        df_props = cell_properties(segmaps[select], select)
+        df_cell = pd.concat([df_cell, df_props], axis=1)
+        df_cell = df_cell.loc[:, ~df_cell.columns.duplicated()]
+    df_cell.insert(0, "FileID", fname)
+
+    if not len(df):
+        return df, df_cell
+
+    cell_id_segmap = "cyto" if "cyto" in segmaps else "nuclei"
+    df["cell_id"] = sample_labels(open_label_array(segmaps[cell_id_segmap]),
+                                  df)
+    if "nuclei" in segmaps:
+        df["nuclear"] = sample_labels(open_label_array(segmaps["nuclei"]),
+                                      df) != 0
+
+    for name, segmap in segmaps.items():
+        if "other" in name:
+            df[name] = sample_labels(open_label_array(segmap), df) \
+                .astype(bool)
+
+    return df, df_cell
+
+
+def segmentation_data_3d(
+    df: pd.DataFrame,
+    nuclei: np.ndarray,
+) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Equivalent of `koopa.postprocess.get_segmentation_data` for the 3D
+    brain analysis (cells given by the nuclei), with the cell areas from
+    `cell_stats` instead of regionprops.
+    """
+    if df["FileID"].nunique() != 1:
+        raise ValueError("Spot files corrupted. Can only contain data from "
+                         "one image.")
+
+    df["cell_id"] = sample_labels(nuclei, df)
+
+    stats = cell_stats(nuclei.squeeze(), geometry=False)
+    df_cell = pd.DataFrame({
+        "cell_id": stats["label"].to_numpy(),
+        "area_nuclei": stats["area"].to_numpy(dtype="float64"),
+    })
+    df_cell.insert(0, "FileID", df["FileID"].unique()[0])
+    return df, df_cell
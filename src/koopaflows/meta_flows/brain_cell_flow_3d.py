@@ -1,14 +1,13 @@
 import json
 import os
 from datetime import datetime
-from os.path import join
+from os.path import basename, join
 from pathlib import Path
 from typing import Union, Literal, Any, Optional
 
 import koopa.segment_flies
 import koopa.colocalize
 import koopa.track
-import koopa.postprocess
 import numpy as np
 import pandas as pd
 import pkg_resources
@@ -19,17 +18,27 @@ from cpr.utilities.utilities import task_input_hash
 from faim_prefect.prefect import get_prefect_context
 from koopaflows.cpr_parquet import koopa_serializer, \
     ParquetTarget
+from koopaflows.cpr_image import Compression, ImageFormat, \
+    OutputCompression, create_image_target, read_channel
+from koopaflows.escalation import ESCALATION_REPORT, EscalationReport, \
+    MemoryEscalation, raises_memory, retry_out_of_memory
+from koopaflows.merge import segmentation_data_3d
+from koopaflows.planning import profiled
 from koopaflows.preprocessing.flow import load_images
 from koopaflows.preprocessing.task import load_and_preprocess_brains
+from koopaflows.recycling import ProcessRecycling, run_recycled, \
+    task_logger
 from koopaflows.storage_key import RESULT_STORAGE_KEY
-from koopaflows.utils import wait_for_task_runs
+from koopaflows.task_runners import stage, task_runner_from_env
+from koopaflows.threads import budgeted
+from koopaflows.utils import wait_for_task_runs, consolidate_parquet, \
+    finished
 from prefect import flow, get_client, get_run_logger
 from prefect import task
 from prefect.client.schemas import FlowRun
 from prefect.context import get_run_context
 from prefect.deployments import run_deployment
 from prefect.filesystems import LocalFileSystem
-from prefect.futures import PrefectFuture
 from pydantic import BaseModel
 
 
@@ -40,6 +49,9 @@ class SegmentNuclei(BaseModel):
     min_area: int
     max_area: int
     dilation: int
+    flow_threshold: float = 0.4
+    cell_probability_threshold: float = 0.0
+    save_flows: bool = False
 
 
 
@@ -49,6 +61,12 @@ class SpotDetection(BaseModel):
     search_range: int
     gap_frames: int
     min_length: int
+    refinement_radius: int = 3
+    cache_network_outputs: bool = False
+    z_workers: int = 1
+    # "dataset" writes one parquet file per stage and channel instead of
+    # one per image.
+    layout: Literal["files", "dataset"] = "files"
 
 
 class Colocalization(BaseModel):
@@ -67,7 +85,11 @@ def run_deepblink(
         output_path: str,
         run_name: str,
         detection_channels: list[int],
-        deepblink_models: list[Path]
+        deepblink_models: list[Path],
+        refinement_radius: int = 3,
+        cache_network_outputs: bool = False,
+        z_workers: int = 1,
+        layout: str = "files",
 ):
     parameters = {
         "serialized_preprocessed": image_dicts,
@@ -75,6 +97,12 @@ def run_deepblink(
         "run_name": run_name,
         "detection_channels": detection_channels,
         "deepblink_models": deepblink_models,
+        "inference": {
+            "cache_outputs": cache_network_outputs,
+            "z_workers": z_workers,
+        },
+        "refinement_radius": refinement_radius,
+        "layout": layout,
     }
 
     run: FlowRun = run_deployment(
@@ -87,6 +115,8 @@ def run_deepblink(
 
 
 @task(cache_key_fn=task_input_hash)
+@profiled("process_nuclei_labels", "image")
+@budgeted
 def process_nuclei_labels(
     image: ImageTarget,
     labeling: ImageTarget,
@@ -96,10 +126,41 @@ def process_nuclei_labels(
     max_area: int,
     dilation: int,
     output_dir: str,
+    image_format: ImageFormat = "tif",
+    compression: Optional[Compression] = None,
+    recycling: ProcessRecycling = ProcessRecycling(),
 ):
+    return run_recycled(
+        clean_nuclei_labels,
+        recycling,
+        image=image,
+        labeling=labeling,
+        nuc_channel=nuc_channel,
+        min_intensity=min_intensity,
+        min_area=min_area,
+        max_area=max_area,
+        dilation=dilation,
+        output_dir=output_dir,
+        image_format=image_format,
+        compression=compression,
+    )
+
+
+def clean_nuclei_labels(
+    image: ImageTarget,
+    labeling: ImageTarget,
+    nuc_channel: int,
+    min_intensity: int,
+    min_area: int,
+    max_area: int,
+    dilation: int,
+    output_dir: str,
+    image_format: ImageFormat = "tif",
+    compression: Optional[Compression] = None,
+) -> ImageTarget:
     seg_map = koopa.segment_flies.remove_false_objects(
-        image=image.get_data()[nuc_channel],
-        segmap=labeling.get_data()[0],
+        image=read_channel(image, nuc_channel),
+        segmap=read_channel(labeling, 0),
         min_intensity=min_intensity,
         min_area=min_area,
         max_area=max_area,
@@ -110,11 +171,12 @@ def process_nuclei_labels(
         dilation=dilation,
     )
 
-    clean_segmentation: ImageTarget = ImageTarget.from_path(
-        join(
-            output_dir,
-            labeling.get_name() + labeling.ext
-        ),
+    clean_segmentation: ImageTarget = create_image_target(
+        output_dir,
+        labeling.get_name(),
+        image_format,
+        compression=compression,
+        labels=True,
         imagej=False,
     )
     clean_segmentation.set_metadata(labeling.get_metadata())
@@ -156,7 +218,16 @@ def cell_segmentation(
     max_area: int,
     dilation: int,
     output_dir: str,
+    flow_threshold: float = 0.4,
+    cell_probability_threshold: float = 0.0,
+    save_flows: bool = False,
+    image_format: ImageFormat = "tif",
+    compression: Compression = Compression(),
+    recycling: ProcessRecycling = ProcessRecycling(),
+    escalation: MemoryEscalation = MemoryEscalation(),
+    report: Optional[EscalationReport] = None,
 ):
+    report = report or EscalationReport(join(output_dir, ESCALATION_REPORT))
 
     image_dicts = [img.serialize() for img in images]
 
@@ -165,11 +236,11 @@ def cell_segmentation(
         "seg_channel": brains_channel,
         "nuclei_channel": brains_channel,
         "diameter": 30,
-        "flow_threshold": 0.4,
-        "cell_probability_threshold": 0.0,
+        "flow_threshold": flow_threshold,
+        "cell_probability_threshold": cell_probability_threshold,
         "resample": True,
         "save_labeling": True,
-        "save_flows": False,
+        "save_flows": save_flows,
         "do_3D": True,
     }
 
@@ -187,36 +258,66 @@ def cell_segmentation(
     )
 
     os.makedirs(join(output_dir, "segmentation_cyto"), exist_ok=True)
-    nuclei_segmentations = []
+    labelings = [labeling['mask'] for labeling in labels.result()]
+
+    def submit(i: int, memory_factor: float = 1):
+        return process_nuclei_labels.submit(
+            image=images[i],
+            labeling=labelings[i],
+            nuc_channel=brains_channel,
+            min_intensity=min_intensity,
+            min_area=min_area,
+            max_area=max_area,
+            dilation=dilation,
+            output_dir=join(output_dir, "segmentation_cyto"),
+            image_format=image_format,
+            compression=compression,
+            recycling=recycling.scaled(memory_factor),
+            wait_for=[labels],
+        )
+
+    def resubmit(i: int, memory_factor: float):
+        with stage("segmentation", memory_factor=memory_factor):
+            return submit(i, memory_factor)
+
+    futures = []
     buffer = []
-    for image, labeling in zip(images, labels.result()):
-        buffer.append(
-            process_nuclei_labels.submit(
-                image=image,
-                labeling=labeling['mask'],
-                nuc_channel=brains_channel,
-                min_intensity=min_intensity,
-                min_area=min_area,
-                max_area=max_area,
-                dilation=dilation,
-                output_dir=join(output_dir, "segmentation_cyto"),
-                wait_for=[labels],
+    with stage("segmentation", slots=2):
+        for i in range(len(images)):
+            buffer.append(submit(i))
+
+            wait_for_task_runs(
+                results=futures,
+                buffer=buffer,
+                max_buffer_length=2,
+                result_insert_fn=finished,
             )
-        )
 
         wait_for_task_runs(
-            results=nuclei_segmentations,
+            results=futures,
             buffer=buffer,
-            max_buffer_length=2,
+            max_buffer_length=0,
+            result_insert_fn=finished,
         )
 
-
-    wait_for_task_runs(
-        results=nuclei_segmentations,
-        buffer=buffer,
-        max_buffer_length=0,
+    nuclei_segmentations = retry_out_of_memory(
+        futures,
+        names=[img.get_name() for img in images],
+        resubmit=resubmit,
+        stage="segmentation",
+        escalation=escalation,
+        report=report,
+        logger=get_run_logger(),
+        escalates=raises_memory(recycling),
     )
 
+    # The merge needs the labels of every preprocessed image.
+    failed = [img.get_name() for img, seg in zip(images, nuclei_segmentations)
+              if seg is None]
+    if len(failed) > 0:
+        raise RuntimeError(f"Processing the nuclei labels of {failed} "
+                           f"failed, see {report.path}.")
+
     return nuclei_segmentations
 
 
@@ -225,55 +326,98 @@ class Preprocess3D(BaseModel):
     crop_start: int
     crop_end: int
     bin_axes: list[float]
+    # Preprocessed volumes stay TIFF for the cellpose deployment, the format
+    # applies to the processed label maps.
+    image_format: ImageFormat = "tif"
 
 
 def preprocessing(
     raw_files: list[ImageSource],
     output_dir: str,
     preprocess: Preprocess3D,
+    compression: Compression = Compression(),
+    recycling: ProcessRecycling = ProcessRecycling(),
+    escalation: MemoryEscalation = MemoryEscalation(),
+    report: Optional[EscalationReport] = None,
 ):
     preprocess_output = join(output_dir,
                              "preprocessed")
     os.makedirs(preprocess_output, exist_ok=True)
+    report = report or EscalationReport(join(output_dir, ESCALATION_REPORT))
+
+    def submit(file, memory_factor: float = 1):
+        return load_and_preprocess_brains.submit(
+            file=file,
+            ext=preprocess.file_extension,
+            crop_start=preprocess.crop_start,
+            crop_end=preprocess.crop_end,
+            scale_factors=1/np.array(preprocess.bin_axes),
+            out_dir=preprocess_output,
+            compression=compression,
+            recycling=recycling.scaled(memory_factor),
+        )
 
-    preprocessed = []
+    def resubmit(i: int, memory_factor: float):
+        with stage("preprocess", memory_factor=memory_factor):
+            return submit(raw_files[i], memory_factor)
+
+    futures = []
     buffer = []
-    def obtain_result(future: PrefectFuture):
-        result = future.result(raise_on_failure=False)
-        if future.get_state().is_completed():
-            return result
-        else:
-            return None
-
-    for file in raw_files:
-        buffer.append(
-            load_and_preprocess_brains.submit(
-                file=file,
-                ext=preprocess.file_extension,
-                crop_start=preprocess.crop_start,
-                crop_end=preprocess.crop_end,
-                scale_factors=1/np.array(preprocess.bin_axes),
-                out_dir=preprocess_output,
+    with stage("preprocess", slots=1):
+        for file in raw_files:
+            buffer.append(submit(file))
+
+            wait_for_task_runs(
+                results=futures,
+                buffer=buffer,
+                max_buffer_length=1,
+                result_insert_fn=finished,
             )
-        )
 
         wait_for_task_runs(
-            results=preprocessed,
+            results=futures,
             buffer=buffer,
-            max_buffer_length=1,
-            result_insert_fn=obtain_result
+            max_buffer_length=0,
+            result_insert_fn=finished,
         )
 
-    wait_for_task_runs(
-        results=preprocessed,
-        buffer=buffer,
-        max_buffer_length=0,
-        result_insert_fn=obtain_result
+    preprocessed = retry_out_of_memory(
+        futures,
+        names=[basename(f) for f in raw_files],
+        resubmit=resubmit,
+        stage="preprocess",
+        escalation=escalation,
+        report=report,
+        logger=get_run_logger(),
+        escalates=raises_memory(recycling),
     )
 
+    # Files which could not be preprocessed are listed in the report.
     return list(filter(None, preprocessed))
 
 
+def consolidate_channels(
+    results: list[dict[str, ParquetTarget]],
+    output_dir: str,
+    prefix: str,
+):
+    """Consolidate per-image results of every channel into one dataset."""
+    if len(results) == 0:
+        return results
+
+    consolidated = {}
+    for ch in results[0].keys():
+        consolidated[ch] = consolidate_parquet(
+            targets=[r[ch] for r in results],
+            dataset_path=join(output_dir, f"{prefix}{ch}.parq"),
+        )
+
+    return [
+        {ch: sources[i] for ch, sources in consolidated.items()}
+        for i in range(len(results))
+    ]
+
+
 @task(cache_key_fn=task_input_hash, result_storage_key=RESULT_STORAGE_KEY)
 def non_maxima_suppression(
     raw_spots: dict[int, ParquetTarget],
@@ -339,32 +483,41 @@ def colocalize(
 
 
 @task(cache_key_fn=task_input_hash, result_storage_key=RESULT_STORAGE_KEY)
-def merge(segmentations, all_colocs, output_path):
+def merge(segmentations, all_colocs, output_path,
+          recycling: ProcessRecycling = ProcessRecycling()):
+    return run_recycled(
+        merge_brains,
+        recycling,
+        segmentations=segmentations,
+        all_colocs=all_colocs,
+        output_path=output_path,
+    )
+
+
+def merge_brains(segmentations, all_colocs, output_path):
+    logger = task_logger()
     colocs_per_file = [[coloc] for coloc in all_colocs[0]]
     for ac in all_colocs[1:]:
         for i, coloc in enumerate(ac):
             colocs_per_file[i].append(coloc)
 
-    get_run_logger().debug(colocs_per_file)
+    logger.debug(colocs_per_file)
     dfs, dfs_cell = [], []
-    get_run_logger().debug(f"{len(colocs_per_file)} number of files.")
+    logger.debug(f"{len(colocs_per_file)} number of files.")
     for colocs, nuc_segs in zip(colocs_per_file, segmentations):
         segmaps = {
-            "nuclei": nuc_segs.get_data()[0],
+            "nuclei": read_channel(nuc_segs, 0),
         }
         df = pd.concat([coloc.get_data() for coloc in colocs])
 
         try:
-            df, df_cell = koopa.postprocess.get_segmentation_data(
-                df, segmaps, {"brains_enabled": True, "do_3d": True}
-            )
+            df, df_cell = segmentation_data_3d(df, segmaps["nuclei"])
             dfs.append(df)
             dfs_cell.append(df_cell)
-            get_run_logger().debug(f"Merged files for {colocs[0].get_name()}")
+            logger.debug(f"Merged files for {colocs[0].get_name()}")
         except ValueError as e:
-            get_run_logger().debug(e)
-            get_run_logger().info(f"No spots found for "
-                                  f"{colocs[0].get_name()}.")
+            logger.debug(e)
+            logger.info(f"No spots found for {colocs[0].get_name()}.")
 
     summary = CSVTarget.from_path(join(output_path, "summary.csv"))
     summary.set_data(pd.concat(dfs, ignore_index=True))
@@ -436,6 +589,7 @@ def write_koopa_cfg(
     detection_channels: list[int],
     coloc_active: bool,
     coloc_channels: list[list[int]],
+    refinement_radius: int = 3,
 ):
     det_channels = [str(c) for c in detection_channels]
     content = "[General]\n" \
@@ -448,7 +602,7 @@ def write_koopa_cfg(
               "\n" \
               "[SpotsDetection]\n" \
               f"detect_channels = [{','.join(det_channels)}]\n" \
-              "refinement_radius = 3\n" \
+              f"refinement_radius = {refinement_radius}\n" \
               "\n" \
               "[SpotsColocalization]\n" \
               f"coloc_enabled = {coloc_active}\n" \
@@ -464,6 +618,7 @@ def write_koopa_cfg(
     persist_result=True,
     result_serializer=koopa_serializer(),
     result_storage=LocalFileSystem.load("koopa"),
+    task_runner=task_runner_from_env(),
 )
 def fly_brain_cell_analysis_3D(
         input_path: Union[Path, str],
@@ -473,13 +628,21 @@ def fly_brain_cell_analysis_3D(
         spot_detection: SpotDetection,
         segment_nuclei: SegmentNuclei,
         coloc_conf: Colocalization,
+        output_compression: OutputCompression = OutputCompression(),
+        recycling: ProcessRecycling = ProcessRecycling(),
+        escalation: MemoryEscalation = MemoryEscalation(),
 ):
+    report = EscalationReport(join(output_path, run_name, ESCALATION_REPORT))
     raw_files = load_images(input_path, preprocess.file_extension)
 
     preprocessed = preprocessing(
         raw_files=raw_files,
         output_dir=join(output_path, run_name),
-        preprocess=preprocess
+        preprocess=preprocess,
+        compression=output_compression.images,
+        recycling=recycling,
+        escalation=escalation,
+        report=report,
     )
 
     # Deepblink runs in GPU TensorFlow env
@@ -489,6 +652,10 @@ def fly_brain_cell_analysis_3D(
         run_name=run_name,
         detection_channels=spot_detection.detection_channels,
         deepblink_models=spot_detection.deepblink_models,
+        refinement_radius=spot_detection.refinement_radius,
+        cache_network_outputs=spot_detection.cache_network_outputs,
+        z_workers=spot_detection.z_workers,
+        layout=spot_detection.layout,
         wait_for=[preprocessed],
     )
 
@@ -501,6 +668,14 @@ def fly_brain_cell_analysis_3D(
         max_area=segment_nuclei.max_area,
         dilation=segment_nuclei.dilation,
         output_dir=os.path.join(output_path, run_name),
+        flow_threshold=segment_nuclei.flow_threshold,
+        cell_probability_threshold=segment_nuclei.cell_probability_threshold,
+        save_flows=segment_nuclei.save_flows,
+        image_format=preprocess.image_format,
+        compression=output_compression.labels,
+        recycling=recycling,
+        escalation=escalation,
+        report=report,
     )
 
     final_spots = []
@@ -528,6 +703,13 @@ def fly_brain_cell_analysis_3D(
         max_buffer_length=0
     )
 
+    if spot_detection.layout == "dataset":
+        final_spots = consolidate_channels(
+            final_spots,
+            output_dir=os.path.join(output_path, run_name),
+            prefix="detection_final_c",
+        )
+
     if coloc_conf.active:
         all_colocs = []
         for c_source, c_target in coloc_conf.coloc_channels:
@@ -557,6 +739,14 @@ def fly_brain_cell_analysis_3D(
                 buffer=buffer,
                 max_buffer_length=0,
             )
+            if spot_detection.layout == "dataset":
+                colocs = consolidate_parquet(
+                    targets=colocs,
+                    dataset_path=os.path.join(
+                        output_path, run_name,
+                        f"colocalization_{c_source}-{c_target}.parq"
+                    ),
+                )
             all_colocs.append(colocs)
     else:
         spots_per_channel = final_spots[0]
@@ -568,7 +758,8 @@ def fly_brain_cell_analysis_3D(
     merge(
         segmentations=nuclei_segmentations,
         all_colocs=all_colocs,
-        output_path=join(output_path, run_name)
+        output_path=join(output_path, run_name),
+        recycling=recycling,
     )
 
     write_koopa_cfg(
@@ -576,6 +767,7 @@ def fly_brain_cell_analysis_3D(
         detection_channels=spot_detection.detection_channels,
         coloc_active=coloc_conf.active,
         coloc_channels=coloc_conf.coloc_channels,
+        refinement_radius=spot_detection.refinement_radius,
     )
 
     write_info_md(
@@ -4,7 +4,7 @@ import re
 from datetime import datetime
 from os.path import join
 from pathlib import Path
-from typing import Union, List, Any, Optional
+from typing import Union, List, Any, Optional, Literal
 
 import pandas as pd
 import pkg_resources
@@ -15,19 +15,30 @@ from cpr.utilities.utilities import task_input_hash
 from faim_prefect.prefect import get_prefect_context
 from koopa.postprocess import merge_segmaps
 from koopaflows.cpr_parquet import ParquetSource, koopa_serializer
+from koopaflows.cpr_image import Compression, ImageFormat, \
+    OutputCompression
+from koopaflows.merge import load_partition, merge_segmaps_sparse, \
+    save_partition
+from koopaflows.pipeline import Batching, input_fingerprint
 from koopaflows.preprocessing.flow import Preprocess3Dto2D
-from koopaflows.preprocessing.task import load_and_preprocess_3D_to_2D
+from koopaflows.preprocessing.task import load_and_preprocess_3D_to_2D, \
+    load_and_preprocess_3D_to_2D_shard
 from koopaflows.segmentation.other_threshold_segmentation_flow import \
-    SegmentOther, segment_other_task
+    SegmentOther, segment_other_batch_task, segment_other_task
 from koopaflows.segmentation.threshold_segmentation_flow import SegmentNuclei, \
-    SegmentCyto, segment_nuclei_task, segment_cyto_task
-from koopaflows.utils import wait_for_task_runs
+    SegmentCyto, segment_cyto_batch_task, segment_cyto_task, \
+    segment_nuclei_batch_task, segment_nuclei_task
+from koopaflows.staging import ScratchStaging
+from koopaflows.task_runners import near, stage, task_runner_from_env
+from koopaflows.utils import completed, resolve, shards, \
+    wait_for_task_runs
 from prefect import flow, get_client, get_run_logger
 from prefect import task
 from prefect.client.schemas import FlowRun
 from prefect.context import get_run_context, FlowRunContext
 from prefect.deployments import run_deployment
 from prefect.filesystems import LocalFileSystem
+from prefect.futures import PrefectFuture
 
 
 @task(cache_key_fn=task_input_hash, refresh_cache=True)
@@ -53,7 +64,8 @@ def run_deepblink(
         output_path: str,
         run_name: str,
         detection_channels: list[int],
-        deepblink_models: list[Path]
+        deepblink_models: list[Path],
+        layout: str = "files",
 ):
     parameters = {
         "serialized_preprocessed": image_dicts,
@@ -61,6 +73,7 @@ def run_deepblink(
         "run_name": run_name,
         "detection_channels": detection_channels,
         "deepblink_models": deepblink_models,
+        "layout": layout,
     }
 
     run: FlowRun = run_deployment(
@@ -78,36 +91,36 @@ def merge(
     segmentations: List[dict[str, ImageSource]],
     other_segmentations: List[dict[int, ImageSource]],
     output_path: str,
+    sparse: bool = False,
 ) -> tuple[CSVTarget, CSVTarget]:
-
+    """
+    Merge spots and segmentations per image. Every merged image is kept as
+    a partition in `<output_path>/merged` together with the fingerprint of
+    its inputs; only images with new or changed inputs are merged again.
+    """
+    partition_dir = join(output_path, "merged")
     result_dfs, result_cell_dfs = [], []
+    n_merged = 0
     for all_spots_per_image, cell_seg, other_seg in zip(all_spots,
                                                       segmentations, other_segmentations):
-        dfs = []
-        for spots_per_channel in all_spots_per_image.values():
-            dfs.append(spots_per_channel.get_data())
-
-        df = pd.concat(dfs)
-
-        segs = {}
-        fname = None
-        for k, v in cell_seg.items():
-            if fname is None:
-                fname = v.get_name()
-            segs[k] = v.get_data()
-
-        for k, v in other_seg.items():
-            segs[k] = v.get_data()
-
-        df, cell_df = merge_segmaps(
-            df,
-            segs,
-            fname=fname,
-            do_3d=False,
+        fname = next(iter(cell_seg.values())).get_name()
+        fingerprint = input_fingerprint(
+            [*all_spots_per_image.values(), *cell_seg.values(),
+             *other_seg.values()],
+            sparse=sparse,
         )
-        result_dfs.append(df)
-        result_cell_dfs.append(cell_df)
-
+        partition = load_partition(partition_dir, fname, fingerprint)
+        if partition is None:
+            partition = merge_image(all_spots_per_image, cell_seg, other_seg,
+                                    fname=fname, sparse=sparse)
+            save_partition(partition_dir, fname, fingerprint, *partition)
+            n_merged += 1
+
+        result_dfs.append(partition[0])
+        result_cell_dfs.append(partition[1])
+
+    get_run_logger().info(f"Merged {n_merged} of {len(result_dfs)} images, "
+                          f"reused the others.")
     result_dfs = pd.concat(result_dfs)
     result_cell_dfs = pd.concat(result_cell_dfs)
 
@@ -120,11 +133,45 @@ def merge(
     return result, result_cells
 
 
+def merge_image(
+    all_spots_per_image: dict[int, ParquetSource],
+    cell_seg: dict[str, ImageSource],
+    other_seg: dict[int, ImageSource],
+    fname: str,
+    sparse: bool = False,
+) -> tuple[pd.DataFrame, pd.DataFrame]:
+    dfs = []
+    for spots_per_channel in all_spots_per_image.values():
+        dfs.append(spots_per_channel.get_data())
+
+    df = pd.concat(dfs)
+
+    segs = {}
+    for k, v in cell_seg.items():
+        segs[k] = v if sparse else v.get_data()
+
+    for k, v in other_seg.items():
+        segs[k] = v if sparse else v.get_data()
+
+    if sparse:
+        return merge_segmaps_sparse(df, segs, fname=fname)
+
+    return merge_segmaps(
+        df,
+        segs,
+        fname=fname,
+        do_3d=False,
+    )
+
+
 def cell_segmentation(
-    images: list[ImageTarget],
+    images: list[PrefectFuture],
     output_dir: str,
     segment_nuclei: SegmentNuclei,
-    segment_cyto: SegmentCyto
+    segment_cyto: SegmentCyto,
+    image_format: ImageFormat = "tif",
+    compression: Compression = Compression(),
+    batching: Batching = Batching(),
 ):
     nuc_seg_output = join(output_dir, "segmentation_nuclei")
     os.makedirs(nuc_seg_output, exist_ok=True)
@@ -132,143 +179,334 @@ def cell_segmentation(
     cyto_seg_output = join(output_dir, "segmentation_cyto")
     os.makedirs(cyto_seg_output, exist_ok=True)
 
+    if batching.active:
+        return cell_segmentation_batched(
+            images, nuc_seg_output, cyto_seg_output, segment_nuclei,
+            segment_cyto, image_format, compression, batching,
+        )
+
     nuc_results = []
     buffer = []
-    for img in images:
-        buffer.append(
-            segment_nuclei_task.submit(
-                img=img,
-                output_dir=nuc_seg_output,
-                segment_nuclei=segment_nuclei
+    with stage("segmentation", slots=48):
+        for img in images:
+            with near(img):
+                buffer.append(
+                    segment_nuclei_task.submit(
+                        img=img,
+                        output_dir=nuc_seg_output,
+                        segment_nuclei=segment_nuclei,
+                        image_format=image_format,
+                        compression=compression,
+                    )
+                )
+            wait_for_task_runs(
+                results=nuc_results,
+                buffer=buffer,
+                max_buffer_length=48,
+                result_insert_fn=completed,
             )
-        )
+
         wait_for_task_runs(
             results=nuc_results,
             buffer=buffer,
-            max_buffer_length=48,
+            max_buffer_length=0,
+            result_insert_fn=completed,
         )
 
-    wait_for_task_runs(
-        results=nuc_results,
-        buffer=buffer,
-        max_buffer_length=0
-    )
-
     if segment_cyto.active:
         buffer = []
         cyto_results = []
-        for img, nuc in zip(images, nuc_results):
-            buffer.append(
-                segment_cyto_task.submit(
-                    img=img,
-                    nuc_seg=nuc,
-                    output_dir=cyto_seg_output,
-                    segment_cyto=segment_cyto
+        with stage("segmentation", slots=48):
+            for img, nuc in zip(images, nuc_results):
+                with near(img):
+                    buffer.append(
+                        segment_cyto_task.submit(
+                            img=img,
+                            nuc_seg=nuc,
+                            output_dir=cyto_seg_output,
+                            segment_cyto=segment_cyto,
+                            image_format=image_format,
+                            compression=compression,
+                        )
+                    )
+
+                wait_for_task_runs(
+                    results=cyto_results,
+                    buffer=buffer,
+                    max_buffer_length=48,
                 )
-            )
 
             wait_for_task_runs(
                 results=cyto_results,
                 buffer=buffer,
-                max_buffer_length=48,
+                max_buffer_length=0,
             )
 
-        wait_for_task_runs(
-            results=cyto_results,
-            buffer=buffer,
-            max_buffer_length=0,
-        )
-
         results = []
         for nuc, cyto in zip(nuc_results, cyto_results):
             results.append(
                 {
-                    "nuclei": nuc,
+                    "nuclei": nuc.result(),
                     "cyto": cyto,
                 }
             )
     else:
-        results = [ {"nuclei": nuc} for nuc in nuc_results ]
+        results = [ {"nuclei": nuc.result()} for nuc in nuc_results ]
 
     return results
 
 
+def cell_segmentation_batched(
+    images: list[Union[PrefectFuture, ImageTarget]],
+    nuc_seg_output: str,
+    cyto_seg_output: str,
+    segment_nuclei: SegmentNuclei,
+    segment_cyto: SegmentCyto,
+    image_format: ImageFormat,
+    compression: Compression,
+    batching: Batching,
+):
+    def insert_result_fn(batch_tasks):
+        nuc, cyto = batch_tasks
+        if cyto is None:
+            return [{"nuclei": n} for n in nuc.result()]
+        return [{"nuclei": n, "cyto": c}
+                for n, c in zip(nuc.result(), cyto.result())]
+
+    size = batching.size_of("segmentation")
+    results = []
+    buffer = []
+    with stage("segmentation", slots=max(1, 48 // size)):
+        for batch in shards(images, size):
+            with near(batch[0]):
+                nuc = segment_nuclei_batch_task.submit(
+                    imgs=batch,
+                    output_dir=nuc_seg_output,
+                    segment_nuclei=segment_nuclei,
+                    image_format=image_format,
+                    compression=compression,
+                    in_flight=batching.in_flight,
+                )
+                cyto = None
+                if segment_cyto.active:
+                    cyto = segment_cyto_batch_task.submit(
+                        imgs=batch,
+                        nuc_segs=nuc,
+                        output_dir=cyto_seg_output,
+                        segment_cyto=segment_cyto,
+                        image_format=image_format,
+                        compression=compression,
+                        in_flight=batching.in_flight,
+                    )
+            buffer.append((nuc, cyto))
+
+            wait_for_task_runs(
+                results=results,
+                buffer=buffer,
+                max_buffer_length=max(1, 48 // size),
+                result_insert_fn=insert_result_fn,
+            )
+
+        wait_for_task_runs(
+            results=results,
+            buffer=buffer,
+            max_buffer_length=0,
+            result_insert_fn=insert_result_fn,
+        )
+
+    return [r for batch in results for r in batch]
+
+
 def other_segmentation(
-    preprocessed: list[ImageTarget],
+    preprocessed: list[PrefectFuture],
     output_dir: str,
-    segment_other: SegmentOther
+    segment_other: SegmentOther,
+    image_format: ImageFormat = "tif",
+    compression: Compression = Compression(),
+    batching: Batching = Batching(),
 ):
     other_seg_output = join(output_dir,
                             f"segmentation_{segment_other.channel}")
     os.makedirs(other_seg_output, exist_ok=True)
 
+    if batching.active:
+        return other_segmentation_batched(preprocessed, other_seg_output,
+                                          segment_other, image_format,
+                                          compression, batching)
+
     other_segmentations: list[dict[str, ImageTarget]] = []
     buffer = []
-    for img in preprocessed:
-        buffer.append(
-            segment_other_task.submit(
-                img=img,
-                output_dir=other_seg_output,
-                segment_other=segment_other,
+    with stage("segmentation", slots=6):
+        for img in preprocessed:
+            with near(img):
+                buffer.append(
+                    segment_other_task.submit(
+                        img=img,
+                        output_dir=other_seg_output,
+                        segment_other=segment_other,
+                        image_format=image_format,
+                        compression=compression,
+                    )
+                )
+
+            wait_for_task_runs(
+                results=other_segmentations,
+                buffer=buffer,
+                max_buffer_length=6,
+                result_insert_fn=lambda r: {f"other_c{segment_other.channel}":
+                                                r.result()}
             )
-        )
 
         wait_for_task_runs(
             results=other_segmentations,
             buffer=buffer,
-            max_buffer_length=6,
+            max_buffer_length=0,
             result_insert_fn=lambda r: {f"other_c{segment_other.channel}":
                                             r.result()}
         )
 
-    wait_for_task_runs(
-        results=other_segmentations,
-        buffer=buffer,
-        max_buffer_length=0,
-        result_insert_fn=lambda r: {f"other_c{segment_other.channel}":
-                                        r.result()}
-    )
-
     return other_segmentations
 
 
+def other_segmentation_batched(
+    preprocessed: list[Union[PrefectFuture, ImageTarget]],
+    other_seg_output: str,
+    segment_other: SegmentOther,
+    image_format: ImageFormat,
+    compression: Compression,
+    batching: Batching,
+):
+    size = batching.size_of("other")
+    other_segmentations = []
+    buffer = []
+    with stage("segmentation", slots=max(1, 6 // size)):
+        for batch in shards(preprocessed, size):
+            with near(batch[0]):
+                buffer.append(
+                    segment_other_batch_task.submit(
+                        imgs=batch,
+                        output_dir=other_seg_output,
+                        segment_other=segment_other,
+                        image_format=image_format,
+                        compression=compression,
+                        in_flight=batching.in_flight,
+                    )
+                )
+
+            wait_for_task_runs(
+                results=other_segmentations,
+                buffer=buffer,
+                max_buffer_length=max(1, 6 // size),
+            )
+
+        wait_for_task_runs(
+            results=other_segmentations,
+            buffer=buffer,
+            max_buffer_length=0,
+        )
+
+    return [{f"other_c{segment_other.channel}": mask}
+            for batch in other_segmentations for mask in batch]
+
+
 def preprocessing(
     raw_files: list[ImageSource],
     output_dir: str,
     preprocess: Preprocess3Dto2D,
-):
+    compression: Compression = Compression(),
+    staging: ScratchStaging = ScratchStaging(),
+    batching: Batching = Batching(),
+) -> list[Union[PrefectFuture, ImageTarget]]:
+    """
+    Preprocess all files. Returns the finished futures, the per-image
+    segmentation tasks are submitted with them so that they run where the
+    preprocessed image was produced. With staging or batching, batches of
+    files are processed by one task each and the preprocessed images are
+    returned.
+    """
     preprocess_output = join(output_dir,
                              "preprocessed")
     os.makedirs(preprocess_output, exist_ok=True)
 
+    if staging.active or batching.active:
+        return preprocessing_batched(raw_files, preprocess_output, preprocess,
+                                     compression, staging, batching)
+
     preprocessed = []
     buffer = []
-    for file in raw_files:
-        buffer.append(
-            load_and_preprocess_3D_to_2D.submit(
-                file=file,
-                ext=preprocess.file_extension,
-                projection_operator=preprocess.projection_operator,
-                out_dir=preprocess_output,
+    with stage("preprocess", slots=20):
+        for file in raw_files:
+            buffer.append(
+                load_and_preprocess_3D_to_2D.submit(
+                    file=file,
+                    ext=preprocess.file_extension,
+                    projection_operator=preprocess.projection_operator,
+                    out_dir=preprocess_output,
+                    image_format=preprocess.image_format,
+                    compression=compression,
+                )
+            )
+
+            wait_for_task_runs(
+                results=preprocessed,
+                buffer=buffer,
+                max_buffer_length=20,
+                result_insert_fn=completed,
             )
-        )
 
         wait_for_task_runs(
             results=preprocessed,
             buffer=buffer,
-            max_buffer_length=20,
+            max_buffer_length=0,
+            result_insert_fn=completed,
         )
 
-    wait_for_task_runs(
-        results=preprocessed,
-        buffer=buffer,
-        max_buffer_length=0
-    )
-
     return preprocessed
 
 
 
+def preprocessing_batched(
+    raw_files: list[str],
+    preprocess_output: str,
+    preprocess: Preprocess3Dto2D,
+    compression: Compression,
+    staging: ScratchStaging,
+    batching: Batching,
+) -> list[ImageTarget]:
+    size = batching.size_of("preprocess") if batching.active \
+        else staging.shard_size
+    preprocessed = []
+    buffer = []
+    with stage("preprocess", slots=max(1, 20 // size)):
+        for shard in shards(raw_files, size):
+            buffer.append(
+                load_and_preprocess_3D_to_2D_shard.submit(
+                    files=shard,
+                    ext=preprocess.file_extension,
+                    projection_operator=preprocess.projection_operator,
+                    out_dir=preprocess_output,
+                    image_format=preprocess.image_format,
+                    compression=compression,
+                    staging=staging,
+                    in_flight=batching.in_flight,
+                )
+            )
+
+            wait_for_task_runs(
+                results=preprocessed,
+                buffer=buffer,
+                max_buffer_length=max(1, 20 // size),
+            )
+
+        wait_for_task_runs(
+            results=preprocessed,
+            buffer=buffer,
+            max_buffer_length=0,
+        )
+
+    return [image for shard in preprocessed for image in shard]
+
+
 def exlude_context_task_input_hash(
     context: "TaskRunContext", arguments: dict[str, Any]
 ) -> Optional[str]:
@@ -361,6 +599,7 @@ def write_koopa_cfg(
     persist_result=True,
     result_serializer=koopa_serializer(),
     result_storage=LocalFileSystem.load("koopa"),
+    task_runner=task_runner_from_env(),
 )
 def fixed_cell_flow(
         input_path: Union[Path, str] = "/tungstenfs/scratch/gchao/grieesth/Export_DRB/20221216_HeLa11ht-pIM40nuc-JunD-2_HS-42C-30or1h_DRB-4h_washout-30min-1h-2h_smFISH-IF_HSPH1_SC35/",
@@ -373,22 +612,31 @@ def fixed_cell_flow(
         segment_nuclei: SegmentNuclei = SegmentNuclei(),
         segment_cyto: SegmentCyto = SegmentCyto(),
         segment_other: SegmentOther = SegmentOther(),
+        output_compression: OutputCompression = OutputCompression(),
+        sparse_merge: bool = False,
+        spot_layout: Literal["files", "dataset"] = "files",
+        staging: ScratchStaging = ScratchStaging(),
+        batching: Batching = Batching(),
 ):
     raw_files = load_images(input_path, preprocess.file_extension)
 
     preprocessed = preprocessing(
         raw_files=raw_files,
         output_dir=join(output_path, run_name),
-        preprocess=preprocess
+        preprocess=preprocess,
+        compression=output_compression.images,
+        staging=staging,
+        batching=batching,
     )
 
     # Deepblink runs in GPU TensorFlow env
     spots = run_deepblink.submit(
-        image_dicts=[p.serialize() for p in preprocessed],
+        image_dicts=[resolve(p).serialize() for p in preprocessed],
         output_path=output_path,
         run_name=run_name,
         detection_channels=detection_channels,
         deepblink_models=deepblink_models,
+        layout=spot_layout,
     )
 
     cell_segmentations = cell_segmentation(
@@ -396,19 +644,26 @@ def fixed_cell_flow(
         os.path.join(output_path, run_name),
         segment_nuclei,
         segment_cyto,
+        image_format=preprocess.image_format,
+        compression=output_compression.labels,
+        batching=batching,
     )
 
     other_segmentations = other_segmentation(
         preprocessed,
         os.path.join(output_path, run_name),
-        segment_other
+        segment_other,
+        image_format=preprocess.image_format,
+        compression=output_compression.labels,
+        batching=batching,
     )
 
     merge(
         all_spots=spots.result(),
         segmentations=cell_segmentations,
         other_segmentations=other_segmentations,
-        output_path=join(output_path, run_name)
+        output_path=join(output_path, run_name),
+        sparse=sparse_merge,
     )
 
     write_koopa_cfg(
@@ -0,0 +1,247 @@
+import importlib
+import json
+import os
+import threading
+from collections import deque
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from os.path import exists, join
+from typing import Callable, Optional, TypeVar
+
+import xxhash
+from pydantic import BaseModel
+
+Item = TypeVar("Item")
+
+# Per-image results of batch tasks are cached in this subdirectory of the
+# task's output directory.
+CACHE_DIR = ".batch_cache"
+
+_recorded = threading.local()
+
+
+class Batching(BaseModel):
+    active: bool = False
+    # Images per task run, `sizes` overrides it per stage.
+    size: int = 8
+    sizes: dict[str, int] = {}
+    # Images held in memory by a batch task: loaded, being computed or
+    # waiting to be written. 3 overlaps reading the next image and writing
+    # the previous one with the computation of the current one.
+    in_flight: int = 3
+
+    def size_of(self, stage: str) -> int:
+        return max(1, self.sizes.get(stage, self.size))
+
+
+def input_fingerprint(resources: list, **parameters) -> str:
+    """
+    Fingerprint of the inputs of one image: the serialized resources (with
+    their data hashes) and the parameters. Resources without a data hash
+    and plain paths are identified by the size and mtime of their file.
+    """
+    inputs = []
+    for resource in resources:
+        if isinstance(resource, str):
+            data, path = {"path": resource}, resource
+        else:
+            data, path = resource.serialize(), resource.get_path()
+        if data.get("data_hash") is None and exists(path):
+            stat = os.stat(path)
+            data["stat"] = [stat.st_size, stat.st_mtime_ns]
+        inputs.append(data)
+
+    return xxhash.xxh3_64(
+        json.dumps([inputs, parameters], sort_keys=True,
+                   default=str).encode()
+    ).hexdigest()
+
+
+def dump_resource(resource) -> dict:
+    """Class and serialized state of a resource, its data stays on disk."""
+    clazz = type(resource)
+    return {"class": f"{clazz.__module__}.{clazz.__qualname__}",
+            "data": resource.serialize()}
+
+
+def load_resource(entry: dict):
+    module, _, name = entry["class"].rpartition(".")
+    clazz = getattr(importlib.import_module(module), name)
+    return clazz(**entry["data"])
+
+
+class ResultCache:
+    """
+    Outputs of single images of a batch task, stored as serialized
+    resources in `<cache_dir>/<fingerprint>.json`. An entry is only used if
+    the file it points to exists.
+    """
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return join(self.cache_dir, f"{key}.json")
+
+    def load(self, key: str):
+        if not exists(self._path(key)):
+            return None
+
+        with open(self._path(key)) as f:
+            resource = load_resource(json.load(f))
+        return resource if exists(resource.get_path()) else None
+
+    def save(self, key: str, resource):
+        entry = dump_resource(resource)
+        tmp = f"{self._path(key)}.{os.getpid()}.part"
+        with open(tmp, "w") as f:
+            json.dump(entry, f, default=str)
+        os.replace(tmp, self._path(key))
+
+
+class BatchError(RuntimeError):
+    def __init__(self, failed: dict[str, BaseException]):
+        self.failed = failed
+        super(BatchError, self).__init__(
+            f"{len(failed)} images of the batch failed: "
+            + "; ".join(f"{name}: {error!r}"
+                        for name, error in failed.items())
+        )
+
+
+def pipelined(
+    items: list[Item],
+    load: Callable[[Item], object],
+    compute: Callable[[Item, object], object],
+    write: Callable[[Item, object], object],
+    in_flight: int = 3,
+) -> list:
+    """
+    Process `items` with a background reader and writer: `load` of the
+    next item and `write` of the previous one run while the current item
+    is computed in the calling thread. At most `in_flight` items are
+    between the start of their `load` and the end of their `write`.
+    Returns the results of `write` in the order of `items`, the first
+    error is raised after the pending writes finished.
+    """
+    slots = threading.Semaphore(max(1, in_flight))
+    stop = threading.Event()
+
+    def _load(item):
+        while not slots.acquire(timeout=0.1):
+            if stop.is_set():
+                raise CancelledError()
+        try:
+            return load(item)
+        except BaseException:
+            slots.release()
+            raise
+
+    def _write(item, result):
+        try:
+            return write(item, result)
+        finally:
+            slots.release()
+
+    with ThreadPoolExecutor(max_workers=1) as reader, \
+            ThreadPoolExecutor(max_workers=1) as writer:
+        # Futures hold their loaded data, they are dropped once it is taken.
+        loads = deque(reader.submit(_load, item) for item in items)
+        writes: list[Future] = []
+        try:
+            for item in items:
+                data = loads.popleft().result()
+                try:
+                    result = compute(item, data)
+                except BaseException:
+                    slots.release()
+                    raise
+                del data
+                writes.append(writer.submit(_write, item, result))
+                del result
+        except BaseException:
+            stop.set()
+            for future in loads:
+                future.cancel()
+            for future in writes:
+                future.exception()
+            raise
+
+        return [future.result() for future in writes]
+
+
+class _Failed:
+    def __init__(self, error: Exception):
+        self.error = error
+
+
+def _isolated(fn: Callable) -> Callable:
+    """Return errors as `_Failed` and pass earlier failures through."""
+
+    def call(item, *args):
+        if len(args) > 0 and isinstance(args[0], _Failed):
+            return args[0]
+        try:
+            return fn(item, *args)
+        except Exception as e:
+            return _Failed(e)
+
+    return call
+
+
+@contextmanager
+def record_processed():
+    """
+    Collects the indices of the items which `cached_pipelined` calls in
+    the enclosed code (of this thread) process, one list per call. Items
+    with a cached result are not included.
+    """
+    previous = getattr(_recorded, "calls", None)
+    _recorded.calls = []
+    try:
+        yield _recorded.calls
+    finally:
+        _recorded.calls = previous
+
+
+def cached_pipelined(
+    items: list[Item],
+    names: list[str],
+    keys: list[str],
+    cache: ResultCache,
+    load: Callable[[Item], object],
+    compute: Callable[[Item, object], object],
+    write: Callable[[Item, object], object],
+    in_flight: int = 3,
+) -> list:
+    """
+    `pipelined` with a per-image result cache. Images with a cached result
+    (by `keys`) are skipped, a failing image does not stop the others. The
+    results of all successful images are cached before a `BatchError`
+    names the failed ones, so a rerun of the batch only processes those.
+    """
+    results = [cache.load(key) for key in keys]
+    todo = [i for i, result in enumerate(results) if result is None]
+    if getattr(_recorded, "calls", None) is not None:
+        _recorded.calls.append(todo)
+    outputs = pipelined(
+        [items[i] for i in todo],
+        load=_isolated(load),
+        compute=_isolated(compute),
+        write=_isolated(write),
+        in_flight=in_flight,
+    )
+
+    failed = {}
+    for i, output in zip(todo, outputs):
+        if isinstance(output, _Failed):
+            failed[names[i]] = output.error
+        else:
+            cache.save(keys[i], output)
+            results[i] = output
+
+    if len(failed) > 0:
+        raise BatchError(failed) from next(iter(failed.values()))
+
+    return results
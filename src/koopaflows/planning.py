@@ -0,0 +1,649 @@
+import argparse
+import functools
+import inspect
+import json
+import math
+import os
+import re
+import resource
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from os.path import basename, isdir, join, splitext
+from typing import Callable, Literal, Optional
+
+import tifffile
+from koopaflows.pipeline import record_processed
+from koopaflows.staging import nd_stacks
+from koopaflows.task_runners import CLUSTER_CONFIG_ENV, DaskCluster, \
+    StageResources
+from pydantic import BaseModel
+
+# Directory with the cost records of earlier runs, one `<task>.jsonl` file
+# per profiled task. Tasks only record their costs if it is set.
+PROFILE_DIR_ENV = "KOOPAFLOWS_PROFILE_DIR"
+
+
+class ImageHeader(BaseModel):
+    path: str
+    # Channels, z-planes, y, x as loaded by `koopa.io.load_raw_image`.
+    shape: tuple[int, int, int, int]
+    dtype: str
+
+    @property
+    def channels(self) -> int:
+        return self.shape[0]
+
+    @property
+    def z_depth(self) -> int:
+        return self.shape[1]
+
+    @property
+    def gvoxels(self) -> float:
+        return math.prod(self.shape) / 1e9
+
+    @property
+    def projected_gvoxels(self) -> float:
+        """Voxels after the projection of the z-planes."""
+        return self.gvoxels / self.z_depth
+
+    def preprocessed_gvoxels(self, preprocessing: "Preprocessing") -> float:
+        """Voxels after cropping and binning, see `Preprocessing`."""
+        shape = list(self.shape)
+        for axis in (2, 3):
+            shape[axis] = len(range(shape[axis])[preprocessing.crop_start:
+                                                  preprocessing.crop_end])
+        # Like `skimage.transform.rescale` with the inverse bin factors.
+        shape = [max(1, round(s / b))
+                 for s, b in zip(shape, preprocessing.bin_axes)]
+        return math.prod(shape) / 1e9
+
+
+class Preprocessing(BaseModel):
+    # Crop of y and x and bin factors (CZYX) of `Preprocess3D`, the brain
+    # flow segments and detects spots in the preprocessed volumes.
+    crop_start: int = 0
+    crop_end: Optional[int] = None
+    bin_axes: tuple[float, float, float, float] = (1, 1, 1, 1)
+
+
+def _czyx(shape) -> tuple[int, int, int, int]:
+    """
+    Axes taken by position from the end, singleton C and Z included. Leading
+    axes beyond CZYX are squeezed, or folded into C if they are not single.
+    """
+    shape = tuple(int(s) for s in shape)
+    while len(shape) > 4 and shape[0] == 1:
+        shape = shape[1:]
+    while len(shape) < 4:
+        shape = (1,) + shape
+    return shape if len(shape) == 4 else \
+        (math.prod(shape[:-3]),) + shape[-3:]
+
+
+def _tif_header(path: str) -> tuple[tuple, str]:
+    with tifffile.TiffFile(path) as tif:
+        series = tif.series[0]
+        return series.shape, str(series.dtype)
+
+
+def read_header(path: str) -> ImageHeader:
+    """
+    Shape and dtype of an image from its header, without reading pixels.
+    `.nd` files combine the headers of their per-channel stacks.
+    """
+    path = str(path)
+    ext = splitext(path)[1].lower()
+    if ext == ".zarr":
+        with open(join(path, ".zarray")) as f:
+            meta = json.load(f)
+        shape, dtype = meta["shape"], meta["dtype"]
+    elif ext == ".nd":
+        stacks = nd_stacks(path)
+        shape, _ = _tif_header(stacks[0])
+        # Single plane stacks have a Z of 1, the channels are cast to uint16
+        # when they are merged.
+        shape = (1,) * (3 - len(shape)) + tuple(shape)
+        shape, dtype = (len(stacks),) + shape, "uint16"
+    elif ext == ".czi":
+        import czifile
+
+        with czifile.CziFile(path) as czi:
+            # Without the trailing samples axis.
+            shape, dtype = czi.shape[:-1], str(czi.dtype)
+    else:
+        shape, dtype = _tif_header(path)
+
+    return ImageHeader(path=path, shape=_czyx(shape), dtype=str(dtype))
+
+
+def list_images(input_dir: str, ext: str) -> list[str]:
+    """Raw files of a run, matched like the `load_images` tasks."""
+    pattern_re = re.compile(f".*.{ext}")
+    return sorted(entry.path for entry in os.scandir(input_dir)
+                  if entry.is_file() and pattern_re.fullmatch(entry.name))
+
+
+def scan_headers(files: list[str], workers: int = 16) \
+        -> tuple[list[ImageHeader], dict[str, str]]:
+    """Headers of `files` read in parallel, and the errors by file."""
+
+    def _read(file):
+        try:
+            return read_header(file), None
+        except Exception as e:
+            return None, repr(e)
+
+    headers, errors = [], {}
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for file, (header, error) in zip(files, executor.map(_read, files)):
+            if header is None:
+                errors[file] = error
+            else:
+                headers.append(header)
+    return headers, errors
+
+
+def _peak_rss() -> float:
+    """Peak resident memory of this process and its subprocesses in GB."""
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1e6
+
+
+def _paths(value) -> list[str]:
+    if isinstance(value, (list, tuple)):
+        return [p for v in value for p in _paths(v)]
+    if hasattr(value, "get_path"):
+        return [value.get_path()]
+    return [str(value)]
+
+
+def record_cost(task: str, seconds: float, peak_memory: float,
+                gvoxels: list[float], profile_dir: str):
+    """Append the cost of one task run to `<profile_dir>/<task>.jsonl`."""
+    os.makedirs(profile_dir, exist_ok=True)
+    line = json.dumps({
+        "seconds": round(seconds, 3),
+        "peak_memory": round(peak_memory, 3),
+        "gvoxels": round(sum(gvoxels), 6),
+        "max_gvoxels": round(max(gvoxels), 6),
+        "images": len(gvoxels),
+    })
+    with open(join(profile_dir, f"{task}.jsonl"), "a") as f:
+        f.write(line + "\n")
+
+
+def profiled(name: str, input_arg: str):
+    """
+    Record the wall time, peak memory and input size (from the headers of
+    the images passed as `input_arg`) of a task function if
+    `KOOPAFLOWS_PROFILE_DIR` is set. Batch tasks only count the images
+    `cached_pipelined` processed, not those with a cached result. Placed
+    below `@task`.
+    """
+
+    def decorator(fn: Callable):
+        signature = inspect.signature(fn)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            profile_dir = os.environ.get(PROFILE_DIR_ENV)
+            if profile_dir is None:
+                return fn(*args, **kwargs)
+
+            start = time.perf_counter()
+            with record_processed() as calls:
+                result = fn(*args, **kwargs)
+            seconds = time.perf_counter() - start
+            try:
+                value = signature.bind(*args, **kwargs).arguments[input_arg]
+                paths = _paths(value)
+                if len(calls) > 0:
+                    paths = [paths[i] for todo in calls for i in todo]
+                gvoxels = [read_header(p).gvoxels for p in paths]
+                if len(gvoxels) > 0:
+                    record_cost(name, seconds, _peak_rss(), gvoxels,
+                                profile_dir)
+            except Exception:
+                # Costs are best effort, they never fail the task.
+                pass
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+class TaskCost(BaseModel):
+    # Wall time and peak memory (GB) of one image as a linear function of
+    # its size in Gvoxels.
+    seconds_per_gvoxel: float
+    memory_per_gvoxel: float
+    memory_base: float = 0.5
+    # Task runs the cost was derived from, 0 for the defaults.
+    samples: int = 0
+
+    def seconds(self, gvoxels: float) -> float:
+        return self.seconds_per_gvoxel * gvoxels
+
+    def memory(self, gvoxels: float) -> float:
+        return self.memory_base + self.memory_per_gvoxel * gvoxels
+
+    @classmethod
+    def from_records(cls, records: list[dict]) -> Optional["TaskCost"]:
+        """
+        Median time per Gvoxel and an upper bound of the memory: the peak
+        memory is that of the worker process, it includes the runtime and
+        earlier tasks.
+        """
+        records = [r for r in records if r["gvoxels"] > 0]
+        if len(records) == 0:
+            return None
+
+        base = min(r["peak_memory"] for r in records)
+        ratios = sorted((r["peak_memory"] - base) / r["max_gvoxels"]
+                        for r in records)
+        return cls(
+            seconds_per_gvoxel=statistics.median(
+                r["seconds"] / r["gvoxels"] for r in records
+            ),
+            memory_per_gvoxel=ratios[int(0.9 * (len(ratios) - 1))],
+            memory_base=base,
+            samples=len(records),
+        )
+
+
+# Rough costs of the profiled tasks until runs with `KOOPAFLOWS_PROFILE_DIR`
+# recorded measured ones.
+DEFAULT_COSTS = {
+    "preprocess_3D_to_2D": TaskCost(seconds_per_gvoxel=60,
+                                    memory_per_gvoxel=12),
+    "preprocess_brain": TaskCost(seconds_per_gvoxel=120,
+                                 memory_per_gvoxel=16, memory_base=1),
+    "segment_nuclei": TaskCost(seconds_per_gvoxel=200, memory_per_gvoxel=24),
+    "segment_cyto": TaskCost(seconds_per_gvoxel=200, memory_per_gvoxel=24),
+    "segment_other": TaskCost(seconds_per_gvoxel=100, memory_per_gvoxel=16),
+    "process_nuclei_labels": TaskCost(seconds_per_gvoxel=150,
+                                      memory_per_gvoxel=20, memory_base=1),
+    "detect_spots": TaskCost(seconds_per_gvoxel=400, memory_per_gvoxel=16,
+                             memory_base=2),
+}
+
+
+def load_costs(profile_dir: Optional[str]) -> dict[str, TaskCost]:
+    """Measured costs from `profile_dir`, the defaults for the others."""
+    costs = dict(DEFAULT_COSTS)
+    if profile_dir is None or not isdir(profile_dir):
+        return costs
+
+    for name in os.listdir(profile_dir):
+        task, ext = splitext(name)
+        if ext != ".jsonl":
+            continue
+        with open(join(profile_dir, name)) as f:
+            records = [json.loads(line) for line in f if line.strip()]
+        cost = TaskCost.from_records(records)
+        if cost is not None:
+            costs[task] = cost
+    return costs
+
+
+class PlanStage(BaseModel):
+    # Profiled tasks run per image and whether they see the raw image, its
+    # z-projection or the cropped and binned volume.
+    tasks: list[str]
+    input: Literal["raw", "projected", "preprocessed"] = "raw"
+    # Stage of the `DaskCluster` configuration, None if the stage runs in
+    # another deployment.
+    cluster_stage: Optional[str] = None
+    # Whether the flow runs the stage in batches (`Batching.sizes`).
+    batched: bool = False
+
+
+FLOW_STAGES = {
+    "fixed_cell": {
+        "preprocess": PlanStage(tasks=["preprocess_3D_to_2D"],
+                                cluster_stage="preprocess", batched=True),
+        "segmentation": PlanStage(tasks=["segment_nuclei", "segment_cyto"],
+                                  input="projected",
+                                  cluster_stage="segmentation",
+                                  batched=True),
+        "other": PlanStage(tasks=["segment_other"], input="projected",
+                           cluster_stage="segmentation", batched=True),
+        "spots": PlanStage(tasks=["detect_spots"], input="projected"),
+    },
+    "brain_3d": {
+        "preprocess": PlanStage(tasks=["preprocess_brain"],
+                                cluster_stage="preprocess"),
+        "segmentation": PlanStage(tasks=["process_nuclei_labels"],
+                                  input="preprocessed",
+                                  cluster_stage="segmentation"),
+        "spots": PlanStage(tasks=["detect_spots"], input="preprocessed"),
+    },
+}
+
+
+class Queue(BaseModel):
+    name: str
+    # Maximum walltime in hours and memory per node in GB (0: any).
+    walltime: float
+    memory: float = 0
+
+    @classmethod
+    def parse(cls, spec: str) -> "Queue":
+        """`name:hours[:memory]`, e.g. `cpu_short:4:128`."""
+        name, *limits = spec.split(":")
+        return cls(name=name, walltime=float(limits[0]),
+                   memory=float(limits[1]) if len(limits) > 1 else 0)
+
+
+class StageEstimate(BaseModel):
+    stage: str
+    images: int
+    gvoxels: float
+    # Wall time of all images on one core, peak memory of one task (GB).
+    seconds: float
+    peak_memory: float
+    # Memory to reserve per task and tasks per worker and in total.
+    memory: float
+    per_worker: int
+    concurrency: int
+    workers: int
+    batch_size: int
+    shards: int
+    hours: float
+    measured: bool
+
+
+class RunPlan(BaseModel):
+    flow: str
+    input_path: str
+    ext: str
+    images: int
+    gvoxels: float
+    shapes: dict[str, int]
+    unreadable: dict[str, str] = {}
+    stages: list[StageEstimate]
+    hours: float
+    queue: Optional[str]
+    warnings: list[str] = []
+    cluster: DaskCluster
+    batching_sizes: dict[str, int] = {}
+    shard_size: Optional[int] = None
+
+
+def _walltime(hours: float) -> str:
+    minutes = max(15, math.ceil(hours * 60))
+    days, minutes = divmod(minutes, 24 * 60)
+    clock = f"{minutes // 60:02d}:{minutes % 60:02d}:00"
+    return f"{days}-{clock}" if days > 0 else clock
+
+
+def _round_up(value: float, step: float = 0.5) -> float:
+    return math.ceil(value / step) * step
+
+
+def _input_gvoxels(header: ImageHeader, spec: PlanStage,
+                   preprocessing: Preprocessing) -> float:
+    if spec.input == "projected":
+        return header.projected_gvoxels
+    if spec.input == "preprocessed":
+        return header.preprocessed_gvoxels(preprocessing)
+    return header.gvoxels
+
+
+def estimate_stage(stage: str, spec: PlanStage, headers: list[ImageHeader],
+                   costs: dict[str, TaskCost], cluster: DaskCluster,
+                   headroom: float, task_seconds: float,
+                   preprocessing: Preprocessing = Preprocessing()) \
+        -> StageEstimate:
+    sizes = [_input_gvoxels(h, spec, preprocessing) for h in headers]
+    per_image = [sum(costs[t].seconds(s) for t in spec.tasks) for s in sizes]
+    peak = max(costs[t].memory(s) for t in spec.tasks for s in sizes)
+    memory = _round_up(peak * headroom)
+
+    reserved = cluster.stages.get(spec.cluster_stage, StageResources())
+    per_worker = max(1, min(cluster.cores // max(1, reserved.cores),
+                            int(cluster.memory // memory)))
+    concurrency = max(1, min(len(headers), per_worker * cluster.max_workers))
+    mean_seconds = statistics.mean(per_image)
+
+    batch_size = 1
+    if spec.batched:
+        # Batches long enough to amortize the task overhead, small enough
+        # to keep every slot busy.
+        batch_size = min(math.ceil(task_seconds / max(mean_seconds, 1e-3)),
+                         math.ceil(len(headers) / concurrency))
+        batch_size = max(1, batch_size)
+    shards = math.ceil(len(headers) / batch_size)
+
+    return StageEstimate(
+        stage=stage,
+        images=len(headers),
+        gvoxels=round(sum(sizes), 3),
+        seconds=round(sum(per_image), 1),
+        peak_memory=round(peak, 2),
+        memory=memory,
+        per_worker=per_worker,
+        concurrency=min(concurrency, shards),
+        workers=min(cluster.max_workers, math.ceil(shards / per_worker)),
+        batch_size=batch_size,
+        shards=shards,
+        hours=max(sum(per_image) / min(concurrency, shards),
+                  max(per_image) * batch_size) / 3600,
+        measured=all(costs[t].samples > 0 for t in spec.tasks),
+    )
+
+
+def plan_run(
+    flow: str,
+    input_path: str,
+    ext: str,
+    headers: list[ImageHeader],
+    costs: dict[str, TaskCost],
+    cluster: DaskCluster,
+    queues: list[Queue],
+    unreadable: Optional[dict[str, str]] = None,
+    preprocessing: Preprocessing = Preprocessing(),
+    headroom: float = 1.25,
+    task_seconds: float = 300,
+    margin: float = 1.5,
+) -> RunPlan:
+    """
+    Time and memory of every stage of `flow` for the images of `headers`,
+    with the reservations, batch sizes and queue to run them with on
+    workers of `cluster`. Stages on preprocessed volumes see the images
+    cropped and binned by `preprocessing`.
+    """
+    if len(headers) == 0:
+        raise ValueError(f"No readable .{ext} images in {input_path}.")
+
+    warnings = []
+    estimates = [
+        estimate_stage(name, spec, headers, costs, cluster, headroom,
+                       task_seconds, preprocessing)
+        for name, spec in FLOW_STAGES[flow].items()
+    ]
+
+    # Planned stages replace the reservations of the configuration.
+    stages = {name: r.copy() for name, r in cluster.stages.items()}
+    planned = set()
+    for estimate in estimates:
+        name = FLOW_STAGES[flow][estimate.stage].cluster_stage
+        if name is None:
+            continue
+        if estimate.memory > cluster.memory:
+            warnings.append(
+                f"Tasks of stage {estimate.stage} need {estimate.memory:g} GB,"
+                f" more than a worker has ({cluster.memory:g} GB)."
+            )
+        resources = stages.setdefault(name, StageResources())
+        if name not in planned:
+            resources.memory, resources.max_workers = 0, 0
+            planned.add(name)
+        resources.memory = min(cluster.memory,
+                               max(resources.memory, estimate.memory))
+        resources.max_workers = max(resources.max_workers, estimate.workers)
+
+    hours = sum(e.hours for e in estimates) * margin
+    queue = None
+    fitting = [q for q in sorted(queues, key=lambda q: q.walltime)
+               if q.walltime >= hours and
+               (q.memory == 0 or q.memory >= cluster.memory)]
+    if len(fitting) > 0:
+        queue = fitting[0]
+    elif len(queues) > 0:
+        queue = max(queues, key=lambda q: q.walltime)
+        warnings.append(f"The run needs about {hours:.1f} h, longer than "
+                        f"the walltime of every queue.")
+
+    walltime = hours if queue is None else min(hours, queue.walltime)
+    planned = cluster.copy(update={
+        "queue": cluster.queue if queue is None else queue.name,
+        "walltime": _walltime(walltime),
+        "max_workers": max([cluster.min_workers] +
+                           [r.max_workers for r in stages.values()]),
+        "stages": stages,
+    })
+
+    shapes = {}
+    for h in headers:
+        key = f"{'x'.join(map(str, h.shape))} {h.dtype}"
+        shapes[key] = shapes.get(key, 0) + 1
+
+    batched = {e.stage: e.batch_size for e in estimates
+               if FLOW_STAGES[flow][e.stage].batched}
+    return RunPlan(
+        flow=flow,
+        input_path=input_path,
+        ext=ext,
+        images=len(headers),
+        gvoxels=round(sum(h.gvoxels for h in headers), 3),
+        shapes=shapes,
+        unreadable=unreadable or {},
+        stages=estimates,
+        hours=round(hours, 2),
+        queue=None if queue is None else queue.name,
+        warnings=warnings,
+        cluster=planned,
+        batching_sizes=batched,
+        shard_size=batched.get("preprocess"),
+    )
+
+
+def format_plan(plan: RunPlan) -> str:
+    lines = [
+        f"Plan for {plan.flow}: {plan.images} .{plan.ext} images "
+        f"({plan.gvoxels:g} Gvoxels) in {plan.input_path}",
+    ]
+    for shape, count in plan.shapes.items():
+        lines.append(f"  {count} x {shape} (CZYX)")
+    for file, error in plan.unreadable.items():
+        lines.append(f"  unreadable: {basename(file)}: {error}")
+
+    lines += [
+        "",
+        f"{'stage':<13}{'Gvoxels':>9}{'CPU h':>8}{'peak GB':>9}"
+        f"{'reserve':>9}{'tasks':>7}{'workers':>9}{'batch':>7}"
+        f"{'shards':>8}{'hours':>7}  costs",
+    ]
+    for e in plan.stages:
+        lines.append(
+            f"{e.stage:<13}{e.gvoxels:>9.3f}{e.seconds / 3600:>8.2f}"
+            f"{e.peak_memory:>9.1f}{e.memory:>9g}{e.concurrency:>7}"
+            f"{e.workers:>9}{e.batch_size:>7}{e.shards:>8}{e.hours:>7.2f}"
+            f"  {'measured' if e.measured else 'default'}"
+        )
+
+    lines += ["", f"Estimated run time (with margin): {plan.hours:.2f} h"]
+    if plan.queue is not None:
+        lines.append(f"Queue: {plan.queue}, walltime {plan.cluster.walltime}")
+    if len(plan.batching_sizes) > 0:
+        lines.append(f"Flow parameters: batching.sizes = "
+                     f"{json.dumps(plan.batching_sizes)}, "
+                     f"staging.shard_size = {plan.shard_size}")
+    lines += [f"Warning: {w}" for w in plan.warnings]
+    return "\n".join(lines)
+
+
+def main(argv: Optional[list[str]] = None):
+    parser = argparse.ArgumentParser(
+        prog="koopaflows-plan",
+        description="Estimate the time and memory of a run from the image "
+                    "headers and the cost profiles of earlier runs, and "
+                    "recommend the cluster configuration to run it with.",
+    )
+    parser.add_argument("input_path")
+    parser.add_argument("--flow", choices=sorted(FLOW_STAGES),
+                        default="fixed_cell")
+    parser.add_argument("--ext", default="nd",
+                        choices=["tif", "stk", "nd", "czi"])
+    parser.add_argument("--profiles", default=os.environ.get(PROFILE_DIR_ENV),
+                        help=f"Cost records of earlier runs "
+                             f"(default: ${PROFILE_DIR_ENV}).")
+    parser.add_argument("--cluster-config",
+                        default=os.environ.get(CLUSTER_CONFIG_ENV),
+                        help=f"`DaskCluster` JSON with the worker size "
+                             f"(default: ${CLUSTER_CONFIG_ENV}).")
+    parser.add_argument("--queue", action="append", default=[],
+                        help="Queue as name:hours[:memory_gb], repeatable.")
+    parser.add_argument("--crop-start", type=int, default=0,
+                        help="Preprocess3D.crop_start of the brain flow.")
+    parser.add_argument("--crop-end", type=int, default=None,
+                        help="Preprocess3D.crop_end of the brain flow.")
+    parser.add_argument("--bin-axes", type=float, nargs=4,
+                        default=[1, 1, 1, 1], metavar=("C", "Z", "Y", "X"),
+                        help="Preprocess3D.bin_axes of the brain flow.")
+    parser.add_argument("--workers", type=int, default=16,
+                        help="Threads reading the headers.")
+    parser.add_argument("--output", default=".",
+                        help="Directory for plan.json and cluster.json.")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Print the plan and the cluster configuration "
+                             "without writing them.")
+    args = parser.parse_args(argv)
+
+    cluster = DaskCluster()
+    if args.cluster_config is not None:
+        with open(args.cluster_config) as f:
+            cluster = DaskCluster(**json.load(f))
+    queues = [Queue.parse(q) for q in args.queue]
+    if len(queues) == 0 and cluster.queue is not None:
+        hours, minutes, _ = map(int, cluster.walltime.split("-")[-1]
+                                .split(":"))
+        days = int(cluster.walltime.split("-")[0]) \
+            if "-" in cluster.walltime else 0
+        queues = [Queue(name=cluster.queue,
+                        walltime=24 * days + hours + minutes / 60)]
+
+    headers, unreadable = scan_headers(
+        list_images(args.input_path, args.ext), workers=args.workers
+    )
+    preprocessing = Preprocessing(crop_start=args.crop_start,
+                                  crop_end=args.crop_end,
+                                  bin_axes=args.bin_axes)
+    try:
+        plan = plan_run(args.flow, args.input_path, args.ext, headers,
+                        load_costs(args.profiles), cluster, queues,
+                        unreadable=unreadable, preprocessing=preprocessing)
+    except ValueError as e:
+        parser.error(str(e))
+    print(format_plan(plan))
+
+    cluster_json = plan.cluster.json(indent=4)
+    if args.dry_run:
+        print("\ncluster.json:\n" + cluster_json)
+        return plan
+
+    os.makedirs(args.output, exist_ok=True)
+    with open(join(args.output, "plan.json"), "w") as f:
+        f.write(plan.json(indent=4))
+    with open(join(args.output, "cluster.json"), "w") as f:
+        f.write(cluster_json)
+    print(f"\nexport {CLUSTER_CONFIG_ENV}="
+          f"{os.path.abspath(join(args.output, 'cluster.json'))}")
+    return plan
+
+
+if __name__ == "__main__":
+    main()
@@ -5,8 +5,12 @@ from typing import Literal
 
 from cpr.Serializer import cpr_serializer
 from cpr.utilities.utilities import task_input_hash
-from koopaflows.preprocessing.task import load_and_preprocess_3D_to_2D
+from koopaflows.cpr_image import Compression, ImageFormat
+from koopaflows.preprocessing.task import load_and_preprocess_3D_to_2D, \
+    load_and_preprocess_3D_to_2D_shard
+from koopaflows.staging import ScratchStaging
 from koopaflows.storage_key import RESULT_STORAGE_KEY
+from koopaflows.utils import shards
 from prefect import flow, task
 from prefect.filesystems import LocalFileSystem
 from pydantic import BaseModel
@@ -31,6 +35,7 @@ def load_images(input_dir, ext):
 class Preprocess3Dto2D(BaseModel):
     file_extension: Literal["tif", "stk", "nd", "czi"] = "nd"
     projection_operator: Literal["maximum", "mean", "sharpest"] = "maximum"
+    image_format: ImageFormat = "tif"
 
 
 @flow(
@@ -45,6 +50,8 @@ def preprocess_flow(
         output_path: str = "/path/to/output/dir",
         run_name: str = "run-1",
         preprocess: Preprocess3Dto2D = Preprocess3Dto2D(),
+        compression: Compression = Compression(),
+        staging: ScratchStaging = ScratchStaging(),
 ):
     run_dir = join(output_path, run_name)
 
@@ -56,6 +63,23 @@ def preprocess_flow(
     raw_files = load_images(input_path, preprocess.file_extension)
 
     preprocessed = []
+    if staging.active:
+        for shard in shards(raw_files, staging.shard_size):
+            preprocessed.append(
+                load_and_preprocess_3D_to_2D_shard.submit(
+                    files=shard,
+                    ext=preprocess.file_extension,
+                    projection_operator=preprocess.projection_operator,
+                    out_dir=preprocess_output,
+                    image_format=preprocess.image_format,
+                    compression=compression,
+                    staging=staging,
+                )
+            )
+
+        # One image per raw file, like without staging.
+        return [image for shard in preprocessed for image in shard.result()]
+
     for file in raw_files:
         preprocessed.append(
             load_and_preprocess_3D_to_2D.submit(
@@ -63,6 +87,8 @@ def preprocess_flow(
                 ext=preprocess.file_extension,
                 projection_operator=preprocess.projection_operator,
                 out_dir=preprocess_output,
+                image_format=preprocess.image_format,
+                compression=compression,
             )
         )
 
@@ -1,7 +1,8 @@
 import gc
 import os
-from os.path import basename, splitext
+from os.path import basename, join, splitext
 from pathlib import Path
+from typing import Optional
 
 import numpy as np
 import psutil
@@ -9,16 +10,26 @@ from cpr.image.ImageTarget import ImageTarget
 from cpr.utilities.utilities import task_input_hash
 from koopa.io import load_raw_image
 from koopa.preprocess import register_3d_image, crop_image, bin_image
+from koopaflows.cpr_image import Compression, ImageFormat, \
+    create_image_target
+from koopaflows.pipeline import CACHE_DIR, ResultCache, \
+    cached_pipelined, input_fingerprint
+from koopaflows.planning import profiled
+from koopaflows.recycling import ProcessRecycling, run_recycled, \
+    task_logger
+from koopaflows.staging import ScratchStaging, ShardStaging
 from koopaflows.storage_key import RESULT_STORAGE_KEY
-from prefect import task, get_run_logger
+from koopaflows.threads import budgeted
+from prefect import task
 
 
-@task(cache_key_fn=task_input_hash)
-def load_and_preprocess_3D_to_2D(
+def preprocess_3D_to_2D(
         file: str,
         ext: str,
         projection_operator: str,
-        out_dir: Path
+        out_dir: Path,
+        image_format: ImageFormat = "tif",
+        compression: Optional[Compression] = None,
 ) -> ImageTarget:
     data = register_3d_image(
         load_raw_image(fname=file, file_ext=ext),
@@ -26,23 +37,126 @@ def load_and_preprocess_3D_to_2D(
     )
 
     name, _ = splitext(basename(file))
-    output = ImageTarget.from_path(
-        path=os.path.join(out_dir, name + ".tif"),
-    )
+    output = create_image_target(out_dir, name, image_format,
+                                 compression=compression)
     output.set_data(data)
     return output
 
 
+@task(cache_key_fn=task_input_hash)
+@profiled("preprocess_3D_to_2D", "file")
+@budgeted
+def load_and_preprocess_3D_to_2D(
+        file: str,
+        ext: str,
+        projection_operator: str,
+        out_dir: Path,
+        image_format: ImageFormat = "tif",
+        compression: Optional[Compression] = None,
+) -> ImageTarget:
+    return preprocess_3D_to_2D(
+        file=file,
+        ext=ext,
+        projection_operator=projection_operator,
+        out_dir=out_dir,
+        image_format=image_format,
+        compression=compression,
+    )
+
+
+@task(cache_key_fn=task_input_hash)
+@profiled("preprocess_3D_to_2D", "files")
+@budgeted
+def load_and_preprocess_3D_to_2D_shard(
+        files: list[str],
+        ext: str,
+        projection_operator: str,
+        out_dir: Path,
+        image_format: ImageFormat = "tif",
+        compression: Optional[Compression] = None,
+        staging: ScratchStaging = ScratchStaging(),
+        in_flight: int = 3,
+) -> list[ImageTarget]:
+    """
+    Preprocess a shard of files. The next raw file is read while the
+    current one is projected and the previous one is written, with at most
+    `in_flight` images in memory. With active staging the raw files are
+    prefetched to node-local scratch, the outputs are written there and
+    copied back to `out_dir` in the background. Outputs are cached per
+    file, a rerun only processes (and stages) the files which failed.
+    """
+    cache = ResultCache(join(out_dir, CACHE_DIR))
+    keys = [input_fingerprint([file], ext=ext,
+                              projection_operator=projection_operator,
+                              image_format=image_format,
+                              compression=compression) for file in files]
+    todo = [file for file, key in zip(files, keys) if cache.load(key) is None]
+    with ShardStaging(todo, out_dir, staging) as shard:
+        def load(file):
+            local = shard.stage_in(file)
+            data = load_raw_image(fname=local, file_ext=ext)
+            shard.release(local)
+            return data
+
+        def write(file, data):
+            name, _ = splitext(basename(file))
+            output = create_image_target(shard.out_dir, name, image_format,
+                                         compression=compression)
+            output.set_data(data)
+            return shard.stage_out(output)
+
+        return cached_pipelined(
+            files,
+            names=[basename(file) for file in files],
+            keys=keys,
+            cache=cache,
+            load=load,
+            compute=lambda file, data: register_3d_image(data,
+                                                         projection_operator),
+            write=write,
+            in_flight=in_flight,
+        )
+
+
 @task(cache_key_fn=task_input_hash, result_storage_key=RESULT_STORAGE_KEY)
+@profiled("preprocess_brain", "file")
+@budgeted
 def load_and_preprocess_brains(
         file: str,
         ext: str,
         crop_start: int,
         crop_end: int,
         scale_factors: list[float],
-        out_dir: Path
+        out_dir: Path,
+        image_format: ImageFormat = "tif",
+        compression: Optional[Compression] = None,
+        recycling: ProcessRecycling = ProcessRecycling(),
+) -> ImageTarget:
+    return run_recycled(
+        preprocess_brain,
+        recycling,
+        file=file,
+        ext=ext,
+        crop_start=crop_start,
+        crop_end=crop_end,
+        scale_factors=scale_factors,
+        out_dir=out_dir,
+        image_format=image_format,
+        compression=compression,
+    )
+
+
+def preprocess_brain(
+        file: str,
+        ext: str,
+        crop_start: int,
+        crop_end: int,
+        scale_factors: list[float],
+        out_dir: Path,
+        image_format: ImageFormat = "tif",
+        compression: Optional[Compression] = None,
 ) -> ImageTarget:
-    logger = get_run_logger()
+    logger = task_logger()
     gc.collect()
     mem_usage = psutil.Process(os.getpid()).memory_info().rss / 1e9
     logger.debug(f"[Start] Process memory usage: {mem_usage} GB")
@@ -71,8 +185,11 @@ def load_and_preprocess_brains(
 
     logger.debug(f"Final image shape {data.shape}.")
     name, _ = splitext(basename(file))
-    output = ImageTarget.from_path(
-        path=os.path.join(out_dir, name + ".tif"),
+    output = create_image_target(
+        out_dir,
+        name,
+        image_format,
+        compression=compression,
         metadata={
             'axes': 'CZYX',
         },
@@ -0,0 +1,249 @@
+import atexit
+import gc
+import logging
+import multiprocessing
+import threading
+import traceback
+from typing import Callable, Optional
+
+import psutil
+from koopaflows.pipeline import dump_resource, load_resource
+from prefect import get_run_logger
+from prefect.exceptions import MissingContextError
+from pydantic import BaseModel
+
+
+class ProcessRecycling(BaseModel):
+    active: bool = False
+    # Subprocesses per worker, heavy tasks beyond that wait for a free one.
+    processes: int = 1
+    # A subprocess is replaced after this many tasks, or after a task which
+    # leaves it above `max_rss` GB (0 disables the limit).
+    max_tasks: int = 4
+    max_rss: float = 0
+    # Address space limit of the subprocesses in GB (0: unlimited). Tasks
+    # exceeding it fail with a MemoryError, like on a node with less memory.
+    memory_limit: float = 0
+
+    def scaled(self, factor: float) -> "ProcessRecycling":
+        """Same configuration with `factor` times the memory limit."""
+        return self.copy(update={"memory_limit": self.memory_limit * factor})
+
+
+class WorkerDied(RuntimeError):
+    """The subprocess running a task exited without a result."""
+
+    def __init__(self, name: str, exitcode: int):
+        self.exitcode = exitcode
+        super(WorkerDied, self).__init__(
+            f"Worker process running {name} died with exit code {exitcode}."
+        )
+
+
+def task_logger():
+    """Run logger inside a task, a plain logger in a worker subprocess."""
+    try:
+        return get_run_logger()
+    except MissingContextError:
+        return logging.getLogger("koopaflows")
+
+
+def _encode(result):
+    """Resources are returned by reference, their data stays in the files."""
+    if isinstance(result, (list, tuple)):
+        return type(result)(_encode(r) for r in result)
+    if isinstance(result, dict):
+        return {k: _encode(v) for k, v in result.items()}
+    if hasattr(result, "serialize") and hasattr(result, "get_path"):
+        return {"__resource__": dump_resource(result)}
+    return result
+
+
+def _decode(result):
+    if isinstance(result, (list, tuple)):
+        return type(result)(_decode(r) for r in result)
+    if isinstance(result, dict):
+        if "__resource__" in result:
+            return load_resource(result["__resource__"])
+        return {k: _decode(v) for k, v in result.items()}
+    return result
+
+
+def _worker_loop(conn, max_tasks: int, max_rss: float, memory_limit: float):
+    logging.basicConfig(level=logging.INFO)
+    if memory_limit > 0:
+        import resource
+
+        limit = int(memory_limit * 1e9)
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    n_tasks = 0
+    while True:
+        message = conn.recv()
+        if message is None:
+            return
+
+        fn, kwargs = message
+        try:
+            result = ("ok", _encode(fn(**kwargs)))
+        except Exception as e:
+            result = ("error", (e, traceback.format_exc()))
+        del message, fn, kwargs
+
+        n_tasks += 1
+        gc.collect()
+        rss = psutil.Process().memory_info().rss / 1e9
+        recycle = n_tasks >= max_tasks or 0 < max_rss < rss
+        try:
+            conn.send((result, rss, recycle))
+        except Exception as e:
+            # Unpicklable error.
+            conn.send((("error", (RuntimeError(repr(e)), result[1][1])),
+                       rss, recycle))
+        if recycle:
+            return
+
+
+class _Worker:
+    def __init__(self, config: ProcessRecycling):
+        context = multiprocessing.get_context("spawn")
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_worker_loop,
+            args=(child_conn, max(1, config.max_tasks), config.max_rss,
+                  config.memory_limit),
+            daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+
+    def close(self):
+        if self.process.is_alive():
+            try:
+                self.conn.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+            self.process.join(timeout=10)
+        if self.process.is_alive():
+            self.process.kill()
+        self.conn.close()
+
+
+class RecyclingPool:
+    """
+    Runs functions in spawned subprocesses which are replaced after
+    `max_tasks` tasks or when their RSS exceeds `max_rss` after a task.
+    Memory fragmentation of long-running workers is returned to the system
+    with the process. Arguments are pickled; resources in the result are
+    passed back by reference, their data is read from the written files.
+
+    Pools sharing `slots` and `siblings` (the same configuration with other
+    memory limits) run at most `processes` subprocesses together: starting
+    a subprocess stops the idle ones of the other pools.
+    """
+
+    def __init__(
+        self,
+        config: ProcessRecycling,
+        slots: Optional[threading.BoundedSemaphore] = None,
+        siblings: Optional[list["RecyclingPool"]] = None,
+    ):
+        self.config = config
+        self._slots = slots or threading.BoundedSemaphore(
+            max(1, config.processes)
+        )
+        self._siblings = siblings if siblings is not None else [self]
+        self._lock = threading.Lock()
+        self._idle: list[_Worker] = []
+        self._closed = False
+        self.n_started = 0
+
+    def _acquire(self) -> _Worker:
+        with self._lock:
+            if len(self._idle) > 0:
+                return self._idle.pop()
+            self.n_started += 1
+        for pool in list(self._siblings):
+            if pool is not self:
+                pool.close_idle()
+        return _Worker(self.config)
+
+    def run(self, fn: Callable, **kwargs):
+        with self._slots:
+            worker = self._acquire()
+            try:
+                worker.conn.send((fn, kwargs))
+                (status, value), rss, recycle = worker.conn.recv()
+            except (EOFError, OSError):
+                worker.process.join(timeout=10)
+                worker.close()
+                raise WorkerDied(fn.__name__, worker.process.exitcode)
+
+            with self._lock:
+                keep = not recycle and not self._closed
+                if keep:
+                    self._idle.append(worker)
+            if not keep:
+                worker.close()
+
+        if status == "error":
+            error, trace = value
+            raise error from RuntimeError(trace)
+        return _decode(value)
+
+    def close_idle(self):
+        """Stop the idle workers, the pool starts new ones when needed."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for worker in idle:
+            worker.close()
+
+    def close(self):
+        """Stop the idle workers, busy ones stop after their task."""
+        with self._lock:
+            self._closed = True
+        self.close_idle()
+
+
+_pools: dict[tuple, RecyclingPool] = {}
+_groups: dict[tuple, tuple[threading.BoundedSemaphore, list]] = {}
+_pools_lock = threading.Lock()
+
+
+def _pool(config: ProcessRecycling) -> RecyclingPool:
+    """
+    Pool of this worker for `config`. Tasks rerun with a scaled memory limit
+    get their own pool, which shares the `processes` budget with the pools
+    of the other memory limits.
+    """
+    group = (config.processes, config.max_tasks, config.max_rss)
+    key = group + (config.memory_limit,)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            if group not in _groups:
+                _groups[group] = (
+                    threading.BoundedSemaphore(max(1, config.processes)), []
+                )
+            slots, siblings = _groups[group]
+            pool = RecyclingPool(config, slots=slots, siblings=siblings)
+            siblings.append(pool)
+            _pools[key] = pool
+    return pool
+
+
+@atexit.register
+def _close_pools():
+    for pool in _pools.values():
+        pool.close()
+
+
+def run_recycled(fn: Callable, recycling: ProcessRecycling, **kwargs):
+    """
+    Call `fn(**kwargs)` in a recycled subprocess of this worker, or
+    directly if recycling is not active. `fn` must be importable (defined
+    at module level).
+    """
+    if not recycling.active:
+        return fn(**kwargs)
+
+    return _pool(recycling).run(fn, **kwargs)
@@ -7,6 +7,7 @@ import skimage
 from cpr.Serializer import cpr_serializer
 from cpr.image.ImageTarget import ImageTarget
 from cpr.utilities.utilities import task_input_hash
+from koopaflows.cpr_image import read_channel
 from prefect import task, flow
 from pydantic import BaseModel
 
@@ -37,7 +38,7 @@ def segment_nuclei_task(
     )
     result.set_data(
         ksct.segment_nuclei(
-            image=img.get_data()[segment_nuclei.channel],
+            image=read_channel(img, segment_nuclei.channel),
             gaussian=segment_nuclei.gaussian,
             min_size_nuclei=segment_nuclei.min_size_nuclei,
             min_distance=segment_nuclei.min_distance,
@@ -55,7 +56,7 @@ def segment_cyto_task(
     result = ImageTarget.from_path(
         join(output_dir, img.get_name() + ".tif")
     )
-    image_cyto = img.get_data()[segment_cyto.channel]
+    image_cyto = read_channel(img, segment_cyto.channel)
     segmap_cyto = ksct.segment_background(
         image=image_cyto,
         method=segment_cyto.method,
@@ -2,7 +2,7 @@ from glob import glob
 from os import makedirs
 from os.path import join
 from pathlib import Path
-from typing import Literal
+from typing import Literal, Optional
 
 import koopa.segment_other_threshold as koct
 import numpy as np
@@ -10,6 +10,12 @@ from cpr.image.ImageSource import ImageSource
 from cpr.image.ImageTarget import ImageTarget
 from cpr.utilities.utilities import task_input_hash
 from koopaflows.cpr_parquet import koopa_serializer
+from koopaflows.cpr_image import Compression, ImageFormat, \
+    create_image_target, image_from_dict, read_channel
+from koopaflows.pipeline import CACHE_DIR, ResultCache, \
+    cached_pipelined, input_fingerprint
+from koopaflows.planning import profiled
+from koopaflows.threads import budgeted, task_slots
 from koopaflows.utils import wait_for_task_runs
 from prefect import task, flow, get_client
 from prefect.client.schemas import FlowRun
@@ -23,28 +29,74 @@ class SegmentOther(BaseModel):
     method: Literal["otsu", "li", "multiotsu"] = "multiotsu"
     channel: int = 0
 
+
+def other_mask(image: np.ndarray, segment_other: SegmentOther):
+    mask = koct.segment(
+        image=image[np.newaxis],
+        method=segment_other.method,
+    )
+    return mask.astype(np.uint8)
+
+
+def write_mask(result: ImageTarget, mask: np.ndarray) -> ImageTarget:
+    result.set_data(mask)
+    return result
+
+
 @task(cache_key_fn=task_input_hash)
+@profiled("segment_other", "img")
+@budgeted
 def segment_other_task(
         img: ImageTarget,
         output_dir: str,
-        segment_other
+        segment_other,
+        image_format: ImageFormat = "tif",
+        compression: Optional[Compression] = None,
 ):
-    result = ImageTarget.from_path(
-        join(output_dir, img.get_name() + ".tif")
-    )
-
-    mask = koct.segment(
-            image=img.get_data()[segment_other.channel][np.newaxis],
-            method=segment_other.method,
-        )
+    result = create_image_target(output_dir, img.get_name(), image_format,
+                                 compression=compression)
 
     result.set_data(
-        mask.astype(np.uint8)
+        other_mask(read_channel(img, segment_other.channel), segment_other)
     )
 
     return result
 
 
+@task(cache_key_fn=task_input_hash)
+@profiled("segment_other", "imgs")
+@budgeted
+def segment_other_batch_task(
+        imgs: list[ImageTarget],
+        output_dir: str,
+        segment_other: SegmentOther,
+        image_format: ImageFormat = "tif",
+        compression: Optional[Compression] = None,
+        in_flight: int = 3,
+) -> list[ImageTarget]:
+    """
+    `segment_other_task` for a batch of images, reading the next image and
+    writing the previous mask while the current one is segmented. Masks
+    are cached per image, a rerun only segments the images which failed.
+    """
+    return cached_pipelined(
+        imgs,
+        names=[img.get_name() for img in imgs],
+        keys=[input_fingerprint([img], segment_other=segment_other.dict(),
+                                image_format=image_format,
+                                compression=compression) for img in imgs],
+        cache=ResultCache(join(output_dir, CACHE_DIR)),
+        load=lambda img: read_channel(img, segment_other.channel),
+        compute=lambda img, image: other_mask(image, segment_other),
+        write=lambda img, mask: write_mask(
+            create_image_target(output_dir, img.get_name(), image_format,
+                                compression=compression),
+            mask
+        ),
+        in_flight=in_flight,
+    )
+
+
 @flow(
     name="other-seg-threshold-2d",
     cache_result_in_memory=False,
@@ -55,11 +107,10 @@ def other_threshold_segmentation_flow(
         serialized_images: list[dict],
         output_dir: str,
         segment_other: SegmentOther = SegmentOther(),
+        image_format: ImageFormat = "tif",
+        compression: Compression = Compression(),
 ):
-    if 'data_hash' in serialized_images[0].keys():
-        images = [ImageTarget(**d) for d in serialized_images]
-    else:
-        images = [ImageSource(**d) for d in serialized_images]
+    images = [image_from_dict(d) for d in serialized_images]
 
     segmentation_result: list[dict[str, ImageTarget]] = []
 
@@ -68,29 +119,34 @@ def other_threshold_segmentation_flow(
     makedirs(other_seg_output, exist_ok=True)
 
     buffer = []
-    for img in images:
-        buffer.append(
-            segment_other_task.submit(
-                img=img,
-                output_dir=other_seg_output,
-                segment_other=segment_other,
+    with task_slots(6):
+        for img in images:
+            buffer.append(
+                segment_other_task.submit(
+                    img=img,
+                    output_dir=other_seg_output,
+                    segment_other=segment_other,
+                    image_format=image_format,
+                    compression=compression,
+                )
+            )
+
+            wait_for_task_runs(
+                results=segmentation_result,
+                buffer=buffer,
+                max_buffer_length=6,
+                result_insert_fn=lambda r: {
+                    f"other_c{segment_other.channel}": r
+                }
             )
-        )
 
         wait_for_task_runs(
             results=segmentation_result,
             buffer=buffer,
-            max_buffer_length=6,
+            max_buffer_length=0,
             result_insert_fn=lambda r: {f"other_c{segment_other.channel}": r}
         )
 
-    wait_for_task_runs(
-        results=segmentation_result,
-        buffer=buffer,
-        max_buffer_length=0,
-        result_insert_fn=lambda r: {f"other_c{segment_other.channel}": r}
-    )
-
     return segmentation_result
 
 @flow(
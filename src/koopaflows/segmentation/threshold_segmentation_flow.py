@@ -2,14 +2,21 @@ from glob import glob
 from os import makedirs
 from os.path import join
 from pathlib import Path
-from typing import Literal
+from typing import Literal, Optional
 
 import koopa.segment_cells_threshold as ksct
+import numpy as np
 import skimage
 from cpr.image.ImageSource import ImageSource
 from cpr.image.ImageTarget import ImageTarget
 from cpr.utilities.utilities import task_input_hash
 from koopaflows.cpr_parquet import koopa_serializer
+from koopaflows.cpr_image import Compression, ImageFormat, \
+    create_image_target, image_from_dict, read_channel
+from koopaflows.pipeline import CACHE_DIR, ResultCache, \
+    cached_pipelined, input_fingerprint
+from koopaflows.planning import profiled
+from koopaflows.threads import budgeted, task_slots
 from koopaflows.utils import wait_for_task_runs
 from prefect import task, flow, get_client
 from prefect.client.schemas import FlowRun
@@ -34,54 +41,153 @@ class SegmentCyto(BaseModel):
     gaussian: int = 3
     min_size: int = 5000
 
+def label_target(
+        img: ImageTarget,
+        output_dir: str,
+        image_format: ImageFormat = "tif",
+        compression: Optional[Compression] = None,
+) -> ImageTarget:
+    return create_image_target(
+        output_dir, img.get_name(), image_format, compression=compression,
+        labels=True, imagej=False,
+    )
+
+
+def nuclei_labels(image: np.ndarray, segment_nuclei: SegmentNuclei):
+    return ksct.segment_nuclei(
+        image=image,
+        gaussian=segment_nuclei.gaussian,
+        min_size_nuclei=segment_nuclei.min_size_nuclei,
+        min_distance=segment_nuclei.min_distance,
+    )
+
+
+def cyto_labels(image_cyto: np.ndarray, nuc_seg: np.ndarray,
+                segment_cyto: SegmentCyto):
+    segmap_cyto = ksct.segment_background(
+        image=image_cyto,
+        method=segment_cyto.method,
+        upper_clip=segment_cyto.upper_clip,
+        gaussian=segment_cyto.gaussian,
+        min_size=segment_cyto.min_size,
+    )
+    return skimage.segmentation.watershed(
+        image=~image_cyto,
+        markers=nuc_seg,
+        mask=segmap_cyto,
+        watershed_line=True,
+    )
+
+
+def write_labels(result: ImageTarget, labels: np.ndarray) -> ImageTarget:
+    result.set_data(labels)
+    return result
+
+
 @task(cache_key_fn=task_input_hash)
+@profiled("segment_nuclei", "img")
+@budgeted
 def segment_nuclei_task(
         img: ImageTarget,
         output_dir: str,
-        segment_nuclei: SegmentNuclei
+        segment_nuclei: SegmentNuclei,
+        image_format: ImageFormat = "tif",
+        compression: Optional[Compression] = None,
 ):
-    result = ImageTarget.from_path(
-        join(output_dir, img.get_name() + ".tif"),
-        imagej=False,
-    )
+    result = label_target(img, output_dir, image_format, compression)
     result.set_data(
-        ksct.segment_nuclei(
-            image=img.get_data()[segment_nuclei.channel],
-            gaussian=segment_nuclei.gaussian,
-            min_size_nuclei=segment_nuclei.min_size_nuclei,
-            min_distance=segment_nuclei.min_distance,
-        )
+        nuclei_labels(read_channel(img, segment_nuclei.channel),
+                      segment_nuclei)
     )
     return result
 
+
 @task(cache_key_fn=task_input_hash)
+@profiled("segment_nuclei", "imgs")
+@budgeted
+def segment_nuclei_batch_task(
+        imgs: list[ImageTarget],
+        output_dir: str,
+        segment_nuclei: SegmentNuclei,
+        image_format: ImageFormat = "tif",
+        compression: Optional[Compression] = None,
+        in_flight: int = 3,
+) -> list[ImageTarget]:
+    """
+    `segment_nuclei_task` for a batch of images, reading the next image
+    and writing the previous label map while the current one is segmented.
+    Label maps are cached per image, a rerun only segments the images
+    which failed.
+    """
+    return cached_pipelined(
+        imgs,
+        names=[img.get_name() for img in imgs],
+        keys=[input_fingerprint([img], segment_nuclei=segment_nuclei.dict(),
+                                image_format=image_format,
+                                compression=compression) for img in imgs],
+        cache=ResultCache(join(output_dir, CACHE_DIR)),
+        load=lambda img: read_channel(img, segment_nuclei.channel),
+        compute=lambda img, image: nuclei_labels(image, segment_nuclei),
+        write=lambda img, labels: write_labels(
+            label_target(img, output_dir, image_format, compression), labels
+        ),
+        in_flight=in_flight,
+    )
+
+
+@task(cache_key_fn=task_input_hash)
+@profiled("segment_cyto", "img")
+@budgeted
 def segment_cyto_task(
         img: ImageTarget,
         nuc_seg: ImageTarget,
         output_dir: str,
         segment_cyto: SegmentCyto,
+        image_format: ImageFormat = "tif",
+        compression: Optional[Compression] = None,
 ):
-    result = ImageTarget.from_path(
-        join(output_dir, img.get_name() + ".tif"),
-        imagej=False,
-    )
-    image_cyto = img.get_data()[segment_cyto.channel]
-    segmap_cyto = ksct.segment_background(
-        image=image_cyto,
-        method=segment_cyto.method,
-        upper_clip=segment_cyto.upper_clip,
-        gaussian=segment_cyto.gaussian,
-        min_size=segment_cyto.min_size,
-    )
-    segmap_cyto = skimage.segmentation.watershed(
-        image=~image_cyto,
-        markers=nuc_seg.get_data(),
-        mask=segmap_cyto,
-        watershed_line=True,
+    result = label_target(img, output_dir, image_format, compression)
+    result.set_data(
+        cyto_labels(read_channel(img, segment_cyto.channel),
+                    nuc_seg.get_data(), segment_cyto)
     )
-    result.set_data(segmap_cyto)
     return result
 
+
+@task(cache_key_fn=task_input_hash)
+@profiled("segment_cyto", "imgs")
+@budgeted
+def segment_cyto_batch_task(
+        imgs: list[ImageTarget],
+        nuc_segs: list[ImageTarget],
+        output_dir: str,
+        segment_cyto: SegmentCyto,
+        image_format: ImageFormat = "tif",
+        compression: Optional[Compression] = None,
+        in_flight: int = 3,
+) -> list[ImageTarget]:
+    """
+    `segment_cyto_task` for a batch of images and their nuclei, pipelined
+    and cached like `segment_nuclei_batch_task`.
+    """
+    return cached_pipelined(
+        list(zip(imgs, nuc_segs)),
+        names=[img.get_name() for img in imgs],
+        keys=[input_fingerprint([img, nuc], segment_cyto=segment_cyto.dict(),
+                                image_format=image_format,
+                                compression=compression)
+              for img, nuc in zip(imgs, nuc_segs)],
+        cache=ResultCache(join(output_dir, CACHE_DIR)),
+        load=lambda pair: (read_channel(pair[0], segment_cyto.channel),
+                           pair[1].get_data()),
+        compute=lambda pair, data: cyto_labels(*data, segment_cyto),
+        write=lambda pair, labels: write_labels(
+            label_target(pair[0], output_dir, image_format, compression),
+            labels
+        ),
+        in_flight=in_flight,
+    )
+
 @flow(
     name="cell-seg-threshold-2d",
     cache_result_in_memory=False,
@@ -93,12 +199,11 @@ def threshold_segmentation_flow(
         serialized_images: list[dict],
         output_dir: str,
         segment_nuclei: SegmentNuclei = SegmentNuclei(),
-        segment_cyto: SegmentCyto = SegmentCyto()
+        segment_cyto: SegmentCyto = SegmentCyto(),
+        image_format: ImageFormat = "tif",
+        compression: Compression = Compression(),
 ):
-    if 'data_hash' in serialized_images[0].keys():
-        images = [ImageTarget(**d) for d in serialized_images]
-    else:
-        images = [ImageSource(**d) for d in serialized_images]
+    images = [image_from_dict(d) for d in serialized_images]
 
     segmentation_result: list[dict[str, ImageTarget]] = []
 
@@ -121,40 +226,45 @@ def threshold_segmentation_flow(
 
 
     buffer = []
-    for img in images:
-        tasks = []
-        nuc_seg_task = segment_nuclei_task.submit(
-            img=img,
-            output_dir=nuc_seg_output,
-            segment_nuclei=segment_nuclei
-        )
-        tasks.append(nuc_seg_task)
-
-        if segment_cyto.active:
-            cyto_seg_task = segment_cyto_task.submit(
+    with task_slots(60):
+        for img in images:
+            tasks = []
+            nuc_seg_task = segment_nuclei_task.submit(
                 img=img,
-                nuc_seg=nuc_seg_task,
-                output_dir=cyto_seg_output,
-                segment_cyto=segment_cyto
+                output_dir=nuc_seg_output,
+                segment_nuclei=segment_nuclei,
+                image_format=image_format,
+                compression=compression,
             )
-            tasks.append(cyto_seg_task)
+            tasks.append(nuc_seg_task)
 
-        buffer.append(tasks)
+            if segment_cyto.active:
+                cyto_seg_task = segment_cyto_task.submit(
+                    img=img,
+                    nuc_seg=nuc_seg_task,
+                    output_dir=cyto_seg_output,
+                    segment_cyto=segment_cyto,
+                    image_format=image_format,
+                    compression=compression,
+                )
+                tasks.append(cyto_seg_task)
+
+            buffer.append(tasks)
+
+            wait_for_task_runs(
+                results=segmentation_result,
+                buffer=buffer,
+                max_buffer_length=60,
+                result_insert_fn=insert_result_fn
+            )
 
         wait_for_task_runs(
             results=segmentation_result,
             buffer=buffer,
-            max_buffer_length=60,
+            max_buffer_length=0,
             result_insert_fn=insert_result_fn
         )
 
-    wait_for_task_runs(
-        results=segmentation_result,
-        buffer=buffer,
-        max_buffer_length=0,
-        result_insert_fn=insert_result_fn
-    )
-
     return segmentation_result
 
 @flow(
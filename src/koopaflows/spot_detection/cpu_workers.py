@@ -0,0 +1,123 @@
+import os
+import queue
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from typing import Optional, Union
+
+import numpy as np
+import pandas as pd
+from cpr.Resource import Resource
+from koopaflows.spot_detection.inference import DeepBlinkInference, \
+    detect_image, load_inference_model
+from koopaflows.spot_detection.warmup import warm_up_detection
+from koopaflows.threads import THREAD_ENV_VARS, available_cores
+from threadpoolctl import threadpool_limits
+
+_MODEL = None
+
+
+def _init_worker(
+    model_path: str,
+    inference: DeepBlinkInference,
+    cores: list[int],
+    output_cache: Optional[str],
+):
+    global _MODEL
+    os.sched_setaffinity(0, cores)
+    # numpy and numba were imported while unpickling this initializer, so
+    # their pools are limited at runtime. The environment covers libraries
+    # loaded later (ONNX Runtime, OpenMP of TensorFlow ops).
+    for var in THREAD_ENV_VARS:
+        os.environ[var] = str(len(cores))
+    threadpool_limits(limits=len(cores))
+    numba = sys.modules.get("numba")
+    if numba is not None:
+        numba.set_num_threads(min(len(cores), numba.config.NUMBA_NUM_THREADS))
+
+    _MODEL = load_inference_model(
+        model_path,
+        inference.copy(
+            update={"intra_op_threads": len(cores), "inter_op_threads": 1}
+        ),
+        output_cache=output_cache,
+    )
+    # Compile the kernels before the worker takes an image.
+    warm_up_detection(_MODEL)
+
+
+def _detect(
+    image: Union[Resource, np.ndarray],
+    detection_channel: int,
+    refinement_radius: int,
+) -> pd.DataFrame:
+    if isinstance(image, Resource):
+        image = image.get_data()
+
+    return detect_image(
+        image, detection_channel, _MODEL,
+        refinement_radius=refinement_radius, engine="numba",
+    )
+
+
+class CPUInferencePool:
+    """
+    Pool of inference processes, each pinned to a disjoint set of cores and
+    holding its own copy of the model.
+    """
+
+    def __init__(
+        self,
+        model_path: str,
+        inference: DeepBlinkInference = DeepBlinkInference(),
+        n_workers: Optional[int] = None,
+        threads_per_worker: int = 2,
+        output_cache: Optional[str] = None,
+    ):
+        cores = available_cores()
+        threads_per_worker = max(1, min(threads_per_worker, len(cores)))
+        # Every worker gets its own cores.
+        max_workers = max(1, len(cores) // threads_per_worker)
+        if n_workers is None or n_workers <= 0:
+            n_workers = max_workers
+        n_workers = min(n_workers, max_workers)
+
+        self.n_workers = n_workers
+        self._idle = queue.Queue()
+        self._executors = []
+        for i in range(n_workers):
+            partition = cores[i * threads_per_worker:
+                              (i + 1) * threads_per_worker]
+            executor = ProcessPoolExecutor(
+                max_workers=1,
+                mp_context=get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(str(model_path), inference, partition,
+                          output_cache),
+            )
+            self._executors.append(executor)
+            self._idle.put(executor)
+
+    def detect(
+        self,
+        image: Union[Resource, np.ndarray],
+        detection_channel: int,
+        refinement_radius: int = 3,
+    ) -> pd.DataFrame:
+        executor = self._idle.get()
+        try:
+            return executor.submit(
+                _detect, image, detection_channel, refinement_radius
+            ).result()
+        finally:
+            self._idle.put(executor)
+
+    def shutdown(self):
+        for executor in self._executors:
+            executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
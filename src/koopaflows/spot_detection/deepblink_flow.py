@@ -1,17 +1,25 @@
 import os
 import threading
+from contextlib import ExitStack
 from os.path import join
 from pathlib import Path
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Union, Literal
 
-import deepblink as pink
 import prefect
 import tensorflow as tf
-from cpr.image.ImageSource import ImageSource
 from cpr.image.ImageTarget import ImageTarget
 from cpr.utilities.utilities import task_input_hash
-from koopa.detect import detect_image
 from koopaflows.cpr_parquet import ParquetTarget, koopa_serializer
+from koopaflows.cpr_image import image_from_dict
+from koopaflows.planning import profiled
+from koopaflows.spot_detection.cpu_workers import CPUInferencePool
+from koopaflows.spot_detection.inference import DeepBlinkInference, \
+    OnnxModel, CachedOutputModel, detect_image, inference_model_hash, \
+    load_inference_model
+from koopaflows.spot_detection.planes import detect_planes
+from koopaflows.spot_detection.warmup import warm_up_detection
+from koopaflows.threads import budgeted, task_slots
+from koopaflows.utils import consolidate_parquet
 from prefect import get_run_logger
 from prefect.filesystems import LocalFileSystem
 
@@ -21,8 +29,12 @@ def exclude_sem_and_model_input_hash(
 ) -> Optional[str]:
     hash_args = {}
     for k, item in arguments.items():
-        if ((not isinstance(item, threading.Semaphore)) and
-                (not isinstance(item, tf.keras.models.Model))):
+        # Plane parallelism does not change the detections.
+        if k == "z_workers":
+            continue
+        if not isinstance(item, (threading.Semaphore, tf.keras.models.Model,
+                                 OnnxModel, CachedOutputModel,
+                                 CPUInferencePool)):
             hash_args[k] = item
 
     return task_input_hash(context, hash_args)
@@ -33,31 +45,54 @@ def exclude_sem_and_model_input_hash(
     cache_result_in_memory=False,
     persist_result=True,
     cache_key_fn=exclude_sem_and_model_input_hash,
-    refresh_cache=True,
 )
+@profiled("detect_spots", "image")
+@budgeted
 def deepblink_spot_detection_task(
         image: ImageTarget,
         detection_channel: int,
         out_dir: Path,
-        model: tf.keras.Model,
+        model: Union[tf.keras.Model, OnnxModel, CachedOutputModel],
         model_name: str,
-        gpu_sem: threading.Semaphore
+        model_hash: str,
+        gpu_sem: threading.Semaphore,
+        cpu_pool: Optional[CPUInferencePool] = None,
+        refinement_radius: int = 3,
+        z_workers: int = 1,
 ):
     logger = prefect.get_run_logger()
     logger.info(f"Detect spots in {image.get_path()} with model {model_name}.")
 
-    data = image.get_data()
-
-    try:
-        gpu_sem.acquire()
-        df = detect_image(
-            data, detection_channel, model, refinement_radius=3,
-            engine="numba",
+    if cpu_pool is not None and z_workers <= 1:
+        df = cpu_pool.detect(
+            image, detection_channel, refinement_radius=refinement_radius
+        )
+    elif cpu_pool is not None:
+        df = detect_planes(
+            image.get_data(),
+            lambda plane: cpu_pool.detect(
+                plane, detection_channel, refinement_radius=refinement_radius
+            ),
+            n_workers=min(z_workers, cpu_pool.n_workers),
         )
-    except RuntimeError as e:
-        raise e
-    finally:
-        gpu_sem.release()
+    else:
+        data = image.get_data()
+
+        try:
+            gpu_sem.acquire()
+            df = detect_planes(
+                data,
+                lambda plane: detect_image(
+                    plane, detection_channel, model,
+                    refinement_radius=refinement_radius,
+                    engine="numba",
+                ),
+                n_workers=z_workers,
+            )
+        except RuntimeError as e:
+            raise e
+        finally:
+            gpu_sem.release()
 
     df.insert(loc=0, column="FileID", value=image.get_name())
 
@@ -83,41 +118,84 @@ def deepblink_spot_detection_flow(
         run_name: str,
         detection_channels: List[int],
         deepblink_models: List[Path],
+        inference: DeepBlinkInference = DeepBlinkInference(),
+        refinement_radius: int = 3,
+        layout: Literal["files", "dataset"] = "files",
 ):
     run_dir = join(output_path, run_name)
 
+    # Network outputs (spots before refinement) are shared between runs
+    # with the same output_path.
+    output_cache = None
+    if inference.cache_outputs:
+        output_cache = join(output_path, ".network_outputs")
+
     preprocess_output = run_dir
     os.makedirs(preprocess_output, exist_ok=True)
 
-    if 'data_hash' in serialized_preprocessed[0].keys():
-        preprocessed = [ImageTarget(**d) for d in serialized_preprocessed]
-    else:
-        preprocessed = [ImageSource(**d) for d in serialized_preprocessed]
+    preprocessed = [image_from_dict(d) for d in serialized_preprocessed]
 
     gpu_sem = threading.Semaphore(1)
 
     output_channels = []
     for channel, model_path in zip(detection_channels, deepblink_models):
-        model = pink.io.load_model(model_path)
-        detections = []
-        buffer = []
-        for img in preprocessed:
-            buffer.append(
-                deepblink_spot_detection_task.submit(
-                    image=img,
-                    detection_channel=channel,
-                    out_dir=preprocess_output,
-                    model=model,
-                    model_name=model_path,
-                    gpu_sem=gpu_sem,
+        # The model object is excluded from the cache key, the hash of the
+        # weights file and the backend make sure a retrained or converted
+        # model invalidates the cache.
+        model_hash = inference_model_hash(model_path, inference)
+        with ExitStack() as stack:
+            if inference.device == "cpu":
+                # Closed on errors too, the inference processes must not
+                # outlive a failed task.
+                cpu_pool = stack.enter_context(CPUInferencePool(
+                    model_path,
+                    inference=inference,
+                    n_workers=inference.cpu_workers,
+                    threads_per_worker=inference.threads_per_worker,
+                    output_cache=output_cache,
+                ))
+                model = None
+                max_buffer_length = max(4, 2 * cpu_pool.n_workers)
+            else:
+                cpu_pool = None
+                model = load_inference_model(model_path, inference,
+                                             output_cache=output_cache)
+                # The tasks run in this process, compile the kernels once
+                # before they detect concurrently.
+                warm_up_detection(model)
+                max_buffer_length = 4
+            stack.enter_context(task_slots(max_buffer_length))
+
+            detections = []
+            buffer = []
+            for img in preprocessed:
+                buffer.append(
+                    deepblink_spot_detection_task.submit(
+                        image=img,
+                        detection_channel=channel,
+                        out_dir=preprocess_output,
+                        model=model,
+                        model_name=model_path,
+                        model_hash=model_hash,
+                        gpu_sem=gpu_sem,
+                        cpu_pool=cpu_pool,
+                        refinement_radius=refinement_radius,
+                        z_workers=inference.z_workers,
+                    )
                 )
-            )
 
-            while len(buffer) >= 4:
+                while len(buffer) >= max_buffer_length:
+                    detections.append(buffer.pop(0).result())
+
+            while len(buffer) > 0:
                 detections.append(buffer.pop(0).result())
 
-        while len(buffer) > 0:
-            detections.append(buffer.pop(0).result())
+        if layout == "dataset":
+            detections = consolidate_parquet(
+                targets=detections,
+                dataset_path=join(preprocess_output,
+                                  f"detection_raw_c{channel}.parq"),
+            )
 
         output_channels.append(detections)
 
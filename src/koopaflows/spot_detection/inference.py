@@ -0,0 +1,329 @@
+import os
+from os.path import exists, getmtime, join, splitext
+from typing import Literal, Optional, Union
+
+import deepblink as pink
+import koopa.detect
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+import trackpy as tp
+import xxhash
+from pydantic import BaseModel
+
+_MODEL_HASHES: dict[tuple[str, int, int], str] = {}
+
+
+class DeepBlinkInference(BaseModel):
+    backend: Literal["keras", "onnx"] = "keras"
+    quantize: bool = False
+    intra_op_threads: int = 0
+    inter_op_threads: int = 0
+    device: Literal["gpu", "cpu"] = "gpu"
+    cpu_workers: int = 0
+    threads_per_worker: int = 2
+    cache_outputs: bool = False
+    z_workers: int = 1
+
+
+def model_content_hash(model_path: str) -> str:
+    """
+    Hash of the model weights file, memoized by path, mtime and size so the
+    file is only read once per process unless it changes.
+    """
+    stat = os.stat(model_path)
+    key = (os.path.abspath(model_path), stat.st_mtime_ns, stat.st_size)
+    if key not in _MODEL_HASHES:
+        digest = xxhash.xxh3_64()
+        with open(model_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+        _MODEL_HASHES[key] = digest.hexdigest()
+
+    return _MODEL_HASHES[key]
+
+
+def inference_model_hash(model_path: str,
+                         inference: DeepBlinkInference) -> str:
+    """
+    Identity of the network outputs: the weights and the backend, since
+    keras, ONNX and int8 ONNX models give slightly different detections.
+    """
+    precision = "int8" if inference.quantize else "fp32"
+    return f"{model_content_hash(model_path)}-{inference.backend}-{precision}"
+
+
+def onnx_model_path(model_path: str, quantize: bool = False) -> str:
+    """Location of the converted model, next to the original `.h5` file."""
+    stem, _ = splitext(str(model_path))
+    return stem + (".int8.onnx" if quantize else ".onnx")
+
+
+def convert_to_onnx(model_path: str, quantize: bool = False) -> str:
+    """
+    Convert a deepBlink keras model to ONNX once and cache it next to the
+    model. The cached artifact is reused as long as it is newer than the
+    `.h5` file.
+    """
+    import tf2onnx
+
+    out_path = onnx_model_path(model_path, quantize=quantize)
+    if exists(out_path) and getmtime(out_path) >= getmtime(model_path):
+        return out_path
+
+    fp32_path = onnx_model_path(model_path, quantize=False)
+    if not (exists(fp32_path) and getmtime(fp32_path) >= getmtime(model_path)):
+        model = pink.io.load_model(str(model_path))
+        tmp_path = f"{fp32_path}.{os.getpid()}.tmp"
+        tf2onnx.convert.from_keras(
+            model,
+            input_signature=(
+                tf.TensorSpec((None, None, None, 1), tf.float32, name="input"),
+            ),
+            opset=13,
+            output_path=tmp_path,
+        )
+        os.replace(tmp_path, fp32_path)
+
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        tmp_path = f"{out_path}.{os.getpid()}.tmp"
+        quantize_dynamic(fp32_path, tmp_path, weight_type=QuantType.QInt8)
+        os.replace(tmp_path, out_path)
+
+    return out_path
+
+
+class OnnxModel:
+    """
+    ONNX Runtime session which quacks like a keras model, i.e. it can be
+    passed to `koopa.detect.detect_image` in place of `tf.keras.Model`.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        intra_op_threads: int = 0,
+        inter_op_threads: int = 0,
+    ):
+        self.path = path
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self._session = None
+
+    def _get_session(self):
+        if self._session is None:
+            import onnxruntime as ort
+
+            options = ort.SessionOptions()
+            options.intra_op_num_threads = self.intra_op_threads
+            options.inter_op_num_threads = self.inter_op_threads
+            self._session = ort.InferenceSession(
+                self.path,
+                sess_options=options,
+                providers=["CPUExecutionProvider"],
+            )
+
+        return self._session
+
+    def predict(self, x, *args, **kwargs) -> np.ndarray:
+        session = self._get_session()
+        name = session.get_inputs()[0].name
+        return session.run(None, {name: np.asarray(x, dtype=np.float32)})[0]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_session"] = None
+        return state
+
+
+class CachedOutputModel:
+    """
+    Persists the spots predicted by the network (before refinement) per
+    frame, keyed by the hash of the unpadded frame and the padding of the
+    network input, below a directory per model weights and backend. Reruns
+    skip inference for frames they already detected, see `detect_image`.
+    """
+
+    def __init__(self, model, model_hash: str, cache_dir: str):
+        self.model = model
+        self.cache_dir = join(cache_dir, model_hash)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def predict(self, x, *args, **kwargs) -> np.ndarray:
+        return self.model.predict(x, *args, **kwargs)
+
+    def predict_coordinates(self, frame: np.ndarray,
+                            padding: int) -> np.ndarray:
+        """
+        Spot coordinates (y, x) in `frame` found by the network in the
+        frame with `padding` reflected pixels, like koopa which pads by
+        `refinement_radius + 1`. The network outputs depend on the padding.
+        """
+        frame = np.ascontiguousarray(frame)
+        digest = xxhash.xxh3_64(frame.tobytes())
+        digest.update(f"{frame.shape}{frame.dtype}{padding}".encode())
+        path = join(self.cache_dir, f"{digest.hexdigest()}.npy")
+        if exists(path):
+            return np.load(path)
+
+        padded = np.pad(frame, padding, mode="reflect")
+        yx = pink.inference.predict(image=padded, model=self.model) - padding
+        tmp_path = f"{path}.{os.getpid()}.tmp.npy"
+        np.save(tmp_path, yx)
+        os.replace(tmp_path, path)
+        return yx
+
+
+def refine_spots(
+    frame: np.ndarray,
+    yx: np.ndarray,
+    refinement_radius: int,
+    engine: str = "numba",
+) -> pd.DataFrame:
+    """
+    Refinement of the spots `yx` found in `frame`, like the second half of
+    `koopa.detect.detect_frame`: spots closer than `refinement_radius + 1`
+    to the border of the padded frame are dropped.
+    """
+    pad = refinement_radius + 1
+    padded = np.pad(frame, pad, mode="reflect")
+    yx = yx + pad
+    yx = yx[np.all((yx >= pad) & (yx < np.array(padded.shape) - pad),
+                   axis=1)]
+    y, x = yx.T
+    df = tp.refine_com(raw_image=padded, image=padded,
+                       radius=refinement_radius, coords=yx, engine=engine)
+    df["x"] = x - pad
+    df["y"] = y - pad
+    df = df.rename({"ecc": "eccentricity"}, axis=1)
+    return df.drop("raw_mass", axis=1)
+
+
+def detect_image(
+    image: np.ndarray,
+    index_channel: int,
+    model,
+    refinement_radius: int,
+    engine: str = "numba",
+) -> pd.DataFrame:
+    """
+    `koopa.detect.detect_image`. Models with an output cache only run the
+    network on frames which are not cached yet.
+    """
+    if not isinstance(model, CachedOutputModel):
+        return koopa.detect.detect_image(
+            image, index_channel, model,
+            refinement_radius=refinement_radius, engine=engine,
+        )
+
+    image = image[index_channel]
+    if image.ndim == 2:
+        image = image[np.newaxis]
+    if image.ndim != 3:
+        raise ValueError(
+            f"Image must have 3 dimensions for detection. Got {image.ndim}."
+        )
+
+    frames = []
+    for frame, data in enumerate(image):
+        yx = model.predict_coordinates(data, padding=refinement_radius + 1)
+        df = refine_spots(data, yx, refinement_radius, engine=engine)
+        df["frame"] = frame
+        df["channel"] = index_channel
+        frames.append(df)
+
+    return pd.concat(frames, ignore_index=True)
+
+
+def load_inference_model(
+    model_path: str,
+    inference: DeepBlinkInference = DeepBlinkInference(),
+    output_cache: Optional[str] = None,
+) -> Union[tf.keras.Model, OnnxModel, CachedOutputModel]:
+    model = _load_model(model_path, inference)
+    if output_cache is not None:
+        return CachedOutputModel(
+            model, inference_model_hash(model_path, inference), output_cache
+        )
+
+    return model
+
+
+def _load_model(
+    model_path: str,
+    inference: DeepBlinkInference,
+) -> Union[tf.keras.Model, OnnxModel]:
+    if inference.backend == "onnx":
+        return OnnxModel(
+            convert_to_onnx(model_path, quantize=inference.quantize),
+            intra_op_threads=inference.intra_op_threads,
+            inter_op_threads=inference.inter_op_threads,
+        )
+
+    try:
+        if inference.intra_op_threads > 0:
+            tf.config.threading.set_intra_op_parallelism_threads(
+                inference.intra_op_threads
+            )
+        if inference.inter_op_threads > 0:
+            tf.config.threading.set_inter_op_parallelism_threads(
+                inference.inter_op_threads
+            )
+    except RuntimeError:
+        # TensorFlow was already initialized in this process, the thread
+        # pools can not be changed anymore.
+        pass
+
+    return pink.io.load_model(str(model_path))
+
+
+def synthetic_spots(
+    shape: tuple[int, int] = (256, 256),
+    n_spots: int = 50,
+    sigma: float = 1.0,
+    seed: int = 0,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Gaussian spots on a noisy background and their true coordinates."""
+    rng = np.random.default_rng(seed)
+    coords = rng.uniform(4, np.array(shape) - 4, size=(n_spots, 2))
+    yy, xx = np.mgrid[: shape[0], : shape[1]]
+    image = rng.normal(100, 5, size=shape)
+    for y, x in coords:
+        image += 200 * np.exp(-((yy - y) ** 2 + (xx - x) ** 2) / (2 * sigma**2))
+    return image.astype(np.float32), coords
+
+
+def check_parity(
+    reference: tf.keras.Model,
+    model: Union[tf.keras.Model, OnnxModel],
+    images: list[np.ndarray],
+    max_distance: float = 1.0,
+) -> dict[str, float]:
+    """
+    Compare the raw network outputs and the detected spots of `model`
+    against the keras `reference` on `images`.
+    """
+    from scipy.spatial import cKDTree
+
+    max_abs_error = 0.0
+    n_reference, n_matched = 0, 0
+    for image in images:
+        batch = pink.data.normalize_image(image)[np.newaxis, ..., np.newaxis]
+        max_abs_error = max(
+            max_abs_error,
+            float(np.abs(reference.predict(batch) - model.predict(batch)).max()),
+        )
+
+        coords_ref = pink.inference.predict(image, reference)
+        coords = pink.inference.predict(image, model)
+        n_reference += len(coords_ref)
+        if len(coords_ref) > 0 and len(coords) > 0:
+            distances, _ = cKDTree(coords).query(coords_ref)
+            n_matched += int(np.sum(distances <= max_distance))
+
+    return {
+        "max_abs_error": max_abs_error,
+        "recall": n_matched / n_reference if n_reference > 0 else 1.0,
+    }
@@ -0,0 +1,33 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+import numpy as np
+import pandas as pd
+
+
+def detect_planes(
+    data: np.ndarray,
+    detect_fn: Callable[[np.ndarray], pd.DataFrame],
+    n_workers: int,
+) -> pd.DataFrame:
+    """
+    Run `detect_fn` on every z-plane of a CZYX volume in parallel and
+    reassemble a single table with the plane index in `frame`.
+
+    `detect_fn` receives single-plane CZYX views. The first plane is
+    processed on its own so lazily built predict functions and JIT kernels
+    are initialized before planes are processed concurrently.
+    """
+    if n_workers <= 1 or data.ndim != 4 or data.shape[1] == 1:
+        return detect_fn(data)
+
+    def detect_plane(z: int) -> pd.DataFrame:
+        df = detect_fn(data[:, z:z + 1])
+        df["frame"] = z
+        return df
+
+    dfs = [detect_plane(0)]
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        dfs.extend(executor.map(detect_plane, range(1, data.shape[1])))
+
+    return pd.concat(dfs, ignore_index=True)
@@ -0,0 +1,45 @@
+import time
+
+import numpy as np
+from koopaflows.spot_detection.inference import CachedOutputModel, \
+    detect_image, synthetic_spots
+
+
+def warm_up_detection(
+    model,
+    shape: tuple[int, ...] = (1, 1, 128, 128),
+    dtypes: tuple[str, ...] = ("uint16", "float32"),
+    refinement_radius: int = 3,
+) -> dict[str, dict[str, float]]:
+    """
+    Compile the refinement kernels and initialize the model in the calling
+    process on representative inputs.
+
+    The kernels are trackpy's `numba.jit` functions, which are compiled
+    without `cache=True`. They can not be shared through an on-disk cache,
+    so every process which detects spots warms up once before it takes
+    work. Every input is processed twice; the difference between the first
+    and the second call is the JIT/initialization overhead of the process.
+    """
+    if isinstance(model, CachedOutputModel):
+        # Synthetic frames do not belong in the output cache.
+        model = model.model
+
+    image, _ = synthetic_spots(shape=shape[-2:])
+    timings = {}
+    for dtype in dtypes:
+        data = np.broadcast_to(image.astype(dtype), shape)
+        calls = []
+        for _ in range(2):
+            start = time.perf_counter()
+            detect_image(data, 0, model, refinement_radius=refinement_radius,
+                         engine="numba")
+            calls.append(time.perf_counter() - start)
+
+        timings[dtype] = {
+            "first_call": calls[0],
+            "second_call": calls[1],
+            "startup_overhead": calls[0] - calls[1],
+        }
+
+    return timings
@@ -0,0 +1,285 @@
+import os
+import re
+import shutil
+import tempfile
+from concurrent.futures import Future, ThreadPoolExecutor
+from glob import escape, glob
+from os.path import basename, dirname, exists, isdir, isfile, join, \
+    splitext
+from typing import Optional
+
+import xxhash
+from cpr.Resource import Resource
+from pydantic import BaseModel
+
+
+class ScratchStaging(BaseModel):
+    active: bool = False
+    # Node-local directory, `$TMPDIR` if not set.
+    scratch_dir: Optional[str] = None
+    # Raw files per task and how many of them are copied ahead of need.
+    shard_size: int = 8
+    prefetch_depth: int = 2
+    # Finished outputs are copied back in batches of this many files.
+    write_back_batch: int = 8
+    # Compare checksums of the copies, not only their sizes.
+    verify: bool = True
+
+
+def parse_nd(path: str) -> dict:
+    """Key/value pairs of a MetaMorph `.nd` file, see `koopa.io.parse_nd`."""
+    nd_data = {}
+    with open(path) as f:
+        for line in f:
+            match = re.search(r'^"(.+)", "?([^"]+)"?\s$', line)
+            if match is not None:
+                nd_data[match.group(1)] = match.group(2)
+    return nd_data
+
+
+def nd_stacks(path: str) -> list[str]:
+    """
+    Per-channel stacks of a MetaMorph `.nd` file, resolved like
+    `koopa.io.load_nd`.
+    """
+    nd_data = parse_nd(path)
+    stem, _ = splitext(path)
+    stacks = []
+    for channel in range(1, int(nd_data["NWavelengths"]) + 1):
+        stack = f"{stem}_w{channel}{nd_data[f'WaveName{channel}']}"
+        stacks.append(f"{stack}.stk" if isfile(f"{stack}.stk")
+                      else f"{stack}.tif")
+    return stacks
+
+
+def companion_files(path: str) -> list[str]:
+    """
+    Files which have to be staged together with `path`. MetaMorph `.nd`
+    files reference one stack per channel next to them. Without channel
+    entries all `<stem>_*` files are taken, which excludes the stacks of
+    images whose stem only starts with this one (`x_10` for `x_1`).
+    """
+    if path.endswith(".nd"):
+        try:
+            stacks = [s for s in nd_stacks(path) if exists(s)]
+        except KeyError:
+            stem, _ = splitext(path)
+            stacks = glob(escape(stem) + "_*")
+        return sorted(set(stacks) | {path})
+    return [path]
+
+
+def file_hash(path: str) -> str:
+    digest = xxhash.xxh3_64()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 22), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _copy_file_verified(src: str, dst: str, verify: bool):
+    os.makedirs(dirname(dst), exist_ok=True)
+    tmp = f"{dst}.{os.getpid()}.part"
+    shutil.copyfile(src, tmp)
+    if os.path.getsize(src) != os.path.getsize(tmp) or \
+            (verify and file_hash(src) != file_hash(tmp)):
+        os.remove(tmp)
+        raise IOError(f"Copy of {src} to {dst} is corrupted.")
+    os.replace(tmp, dst)
+
+
+def copy_verified(src: str, dst: str, verify: bool = True):
+    """
+    Copy a file or directory (zarr) to `dst`. Every file is copied to a
+    temporary name, checked (size, optionally checksum) and moved into
+    place, so `dst` never holds a partial file.
+    """
+    if not isdir(src):
+        _copy_file_verified(src, dst, verify)
+        return
+
+    for root, _, files in os.walk(src):
+        for name in files:
+            path = join(root, name)
+            _copy_file_verified(path, join(dst, os.path.relpath(path, src)),
+                                verify)
+
+
+def _remove(path: str):
+    if isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif exists(path):
+        os.remove(path)
+
+
+class Prefetcher:
+    """
+    Copies the raw files of a shard to scratch in the background, at most
+    `depth` files ahead of the consumer.
+    """
+
+    def __init__(self, files: list[str], scratch_dir: str, depth: int = 2,
+                 verify: bool = True):
+        self._files = list(files)
+        self._scratch_dir = scratch_dir
+        self._depth = max(1, depth)
+        self._verify = verify
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._staged: dict[str, Future] = {}
+        self._next = 0
+        for _ in range(self._depth):
+            self._schedule()
+
+    def _schedule(self):
+        if self._next < len(self._files):
+            file = self._files[self._next]
+            self._staged[file] = self._executor.submit(self._stage, file)
+            self._next += 1
+
+    def _stage(self, file: str) -> str:
+        # One directory per source directory keeps companion files together.
+        local_dir = join(self._scratch_dir,
+                         xxhash.xxh3_64(dirname(file).encode()).hexdigest())
+        for path in companion_files(file):
+            copy_verified(path, join(local_dir, basename(path)),
+                          self._verify)
+        return join(local_dir, basename(file))
+
+    def get(self, file: str) -> str:
+        """Local copy of `file`, waits if it is not staged yet."""
+        if file not in self._staged:
+            self._staged[file] = self._executor.submit(self._stage, file)
+        local = self._staged.pop(file).result()
+        self._schedule()
+        return local
+
+    def release(self, local: str):
+        """Remove a staged file (and its companions) once it was read."""
+        for path in companion_files(local):
+            _remove(path)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+
+class WriteBack:
+    """
+    Copies finished outputs from scratch to their final location in a
+    background thread, `batch_size` files at a time. `flush` waits until
+    everything is written and re-raises copy errors.
+    """
+
+    def __init__(self, batch_size: int = 8, verify: bool = True):
+        self._batch_size = max(1, batch_size)
+        self._verify = verify
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._batch: list[tuple[str, str]] = []
+        self._pending: list[Future] = []
+
+    def add(self, local: str, remote: str):
+        self._batch.append((local, remote))
+        if len(self._batch) >= self._batch_size:
+            self._submit()
+
+    def _submit(self):
+        if len(self._batch) > 0:
+            self._pending.append(
+                self._executor.submit(self._sync, self._batch)
+            )
+            self._batch = []
+
+    def _sync(self, batch: list[tuple[str, str]]):
+        for local, remote in batch:
+            copy_verified(local, remote, self._verify)
+            _remove(local)
+
+    def flush(self):
+        self._submit()
+        pending, self._pending = self._pending, []
+        for future in pending:
+            future.result()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self._executor.shutdown(wait=True)
+
+
+class ShardStaging:
+    """
+    Stages the raw files of one shard to node-local scratch and writes the
+    outputs produced from them back to the shared output directory. When
+    staging is not active, files and outputs are used in place.
+
+        with ShardStaging(files, out_dir, staging) as shard:
+            for file in files:
+                output = process(shard.stage_in(file), shard.out_dir)
+                outputs.append(shard.stage_out(output))
+    """
+
+    def __init__(self, files: list[str], out_dir: str,
+                 staging: ScratchStaging):
+        self.staging = staging
+        self.remote_out_dir = str(out_dir)
+        self.out_dir = str(out_dir)
+        self._tmp_dir = None
+        self._prefetcher = None
+        self._write_back = None
+        if staging.active:
+            scratch = staging.scratch_dir or os.environ.get(
+                "TMPDIR", tempfile.gettempdir()
+            )
+            os.makedirs(scratch, exist_ok=True)
+            self._tmp_dir = tempfile.mkdtemp(prefix="koopaflows-",
+                                             dir=scratch)
+            self.out_dir = join(self._tmp_dir, "outputs")
+            os.makedirs(self.out_dir, exist_ok=True)
+            self._prefetcher = Prefetcher(
+                files, join(self._tmp_dir, "inputs"),
+                depth=staging.prefetch_depth, verify=staging.verify,
+            )
+            self._write_back = WriteBack(staging.write_back_batch,
+                                         verify=staging.verify)
+
+    def stage_in(self, file: str) -> str:
+        if self._prefetcher is None:
+            return file
+        return self._prefetcher.get(file)
+
+    def release(self, local: str):
+        if self._prefetcher is not None:
+            self._prefetcher.release(local)
+
+    def stage_out(self, output: Resource) -> Resource:
+        """
+        Queue the files of `output` for write-back and return the resource
+        at its final location.
+        """
+        if self._write_back is None:
+            return output
+
+        paths = [output.get_path()]
+        if hasattr(output, "get_index_path") and \
+                exists(output.get_index_path()):
+            paths.append(output.get_index_path())
+        for path in paths:
+            self._write_back.add(path, join(self.remote_out_dir,
+                                            basename(path)))
+
+        data = output.serialize()
+        data["location"] = self.remote_out_dir
+        return type(output)(**data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        try:
+            if self._prefetcher is not None:
+                self._prefetcher.close()
+            if self._write_back is not None:
+                self._write_back.close()
+        finally:
+            if self._tmp_dir is not None:
+                shutil.rmtree(self._tmp_dir, ignore_errors=True)
@@ -0,0 +1,214 @@
+import json
+import os
+from contextlib import contextmanager, nullcontext
+from typing import Literal, Optional
+
+from koopaflows.threads import task_slots
+from prefect.context import FlowRunContext
+from prefect.futures import PrefectFuture
+from prefect.task_runners import BaseTaskRunner, ConcurrentTaskRunner
+from pydantic import BaseModel
+
+# Path to a JSON file with a `DaskCluster` configuration. If it is not set
+# the flows use prefect's default (concurrent) task runner.
+CLUSTER_CONFIG_ENV = "KOOPAFLOWS_CLUSTER_CONFIG"
+
+
+class StageResources(BaseModel):
+    # Abstract resources reserved per task, in GB and cores. Workers
+    # advertise their total memory and cores.
+    memory: float = 0
+    cores: int = 0
+    # Adaptive scaling while the stage runs, 0 keeps the cluster default.
+    min_workers: int = 0
+    max_workers: int = 0
+
+    def annotation(self) -> dict[str, float]:
+        resources = {}
+        if self.memory > 0:
+            resources["memory"] = self.memory
+        if self.cores > 0:
+            resources["cores"] = self.cores
+        return resources
+
+
+class DaskCluster(BaseModel):
+    backend: Literal["local", "slurm"] = "local"
+    # Per worker (one worker per SLURM job).
+    cores: int = 4
+    memory: float = 16
+    # Adaptive scaling bounds of the cluster.
+    min_workers: int = 1
+    max_workers: int = 4
+    # SLURM only.
+    queue: Optional[str] = None
+    account: Optional[str] = None
+    walltime: str = "04:00:00"
+    job_extra_directives: list[str] = []
+    local_directory: Optional[str] = None
+    stages: dict[str, StageResources] = {
+        "preprocess": StageResources(memory=8),
+        "segmentation": StageResources(cores=2),
+    }
+
+
+def cluster_config_from_env() -> Optional[DaskCluster]:
+    path = os.environ.get(CLUSTER_CONFIG_ENV)
+    if path is None:
+        return None
+
+    with open(path) as f:
+        return DaskCluster(**json.load(f))
+
+
+def worker_resources(cluster: DaskCluster) -> dict[str, float]:
+    return {"memory": cluster.memory, "cores": cluster.cores}
+
+
+def dask_task_runner(cluster: DaskCluster) -> BaseTaskRunner:
+    """
+    `DaskTaskRunner` with an adaptive `SLURMCluster`, or a `LocalCluster`
+    with the same worker resources for testing on a single machine.
+    """
+    from prefect_dask import DaskTaskRunner
+
+    for name, resources in cluster.stages.items():
+        assert resources.memory <= cluster.memory and \
+               resources.cores <= cluster.cores, \
+            f"Stage {name} requests more resources than a worker has."
+
+    resources = worker_resources(cluster)
+    adapt_kwargs = {"minimum": cluster.min_workers,
+                    "maximum": cluster.max_workers}
+    if cluster.backend == "local":
+        return DaskTaskRunner(
+            cluster_class="distributed.LocalCluster",
+            cluster_kwargs={
+                "n_workers": cluster.min_workers,
+                "threads_per_worker": cluster.cores,
+                "memory_limit": f"{cluster.memory}GB",
+                "resources": resources,
+                "local_directory": cluster.local_directory,
+            },
+            adapt_kwargs=adapt_kwargs,
+        )
+
+    return DaskTaskRunner(
+        cluster_class="dask_jobqueue.SLURMCluster",
+        cluster_kwargs={
+            "cores": cluster.cores,
+            "processes": 1,
+            "memory": f"{cluster.memory}GB",
+            "queue": cluster.queue,
+            "account": cluster.account,
+            "walltime": cluster.walltime,
+            "job_extra_directives": cluster.job_extra_directives,
+            "local_directory": cluster.local_directory,
+            "worker_extra_args": [
+                "--resources",
+                ",".join(f"{k}={v}" for k, v in resources.items()),
+            ],
+        },
+        adapt_kwargs=adapt_kwargs,
+    )
+
+
+def task_runner_from_env() -> BaseTaskRunner:
+    """Task runner of the meta flows, see `CLUSTER_CONFIG_ENV`."""
+    cluster = cluster_config_from_env()
+    if cluster is None:
+        return ConcurrentTaskRunner()
+
+    return dask_task_runner(cluster)
+
+
+def _running_cluster():
+    context = FlowRunContext.get()
+    if context is None:
+        return None
+
+    # The cluster the DaskTaskRunner started for this flow run.
+    return getattr(context.task_runner, "_cluster", None)
+
+
+def escalated_resources(resources: StageResources, cluster: DaskCluster,
+                        memory_factor: float) -> StageResources:
+    """
+    `resources` with `memory_factor` times the memory, at most a whole
+    worker. Stages without a memory reservation start from a core's share.
+    """
+    memory = resources.memory or cluster.memory / cluster.cores
+    return resources.copy(
+        update={"memory": min(memory * memory_factor, cluster.memory)}
+    )
+
+
+@contextmanager
+def stage(name: str, cluster: Optional[DaskCluster] = None,
+          memory_factor: float = 1, slots: Optional[int] = None):
+    """
+    Tasks submitted in this context reserve the resources of stage `name`
+    and the cluster adapts to the worker bounds of the stage. With a
+    `memory_factor` above 1 they reserve that much more memory, e.g. to
+    rerun tasks which ran out of memory. Without a cluster configuration
+    only `slots`, the number of tasks the stage runs at the same time,
+    applies to the thread budget (see `task_slots`).
+    """
+    cluster = cluster or cluster_config_from_env()
+    if cluster is None:
+        with task_slots(slots) if slots is not None else nullcontext():
+            yield
+        return
+
+    import dask
+
+    resources = cluster.stages.get(name, StageResources())
+    if memory_factor > 1:
+        resources = escalated_resources(resources, cluster, memory_factor)
+    running = _running_cluster()
+    if running is not None and hasattr(running, "adapt"):
+        if resources.max_workers > 0:
+            running.adapt(minimum=resources.min_workers,
+                          maximum=resources.max_workers)
+        else:
+            running.adapt(minimum=cluster.min_workers,
+                          maximum=cluster.max_workers)
+
+    with dask.annotate(resources=resources.annotation()):
+        yield
+
+
+def _holding_worker(future) -> Optional[str]:
+    """Address of the dask worker which holds the result of `future`."""
+    context = FlowRunContext.get()
+    dask_futures = getattr(context.task_runner, "_dask_futures", None) \
+        if context is not None else None
+    if not isinstance(future, PrefectFuture) or not dask_futures:
+        return None
+
+    dask_future = dask_futures.get(future.key)
+    if dask_future is None or not dask_future.done():
+        return None
+
+    holders = dask_future.client.who_has([dask_future.key])
+    holders = list(holders.get(dask_future.key, ()))
+    return holders[0] if len(holders) > 0 else None
+
+
+@contextmanager
+def near(future):
+    """
+    Tasks submitted in this context prefer the worker which produced
+    `future`, e.g. all tasks of one image follow its preprocessing. Other
+    workers may still run (steal) them when that worker is busy. Without a
+    dask task runner this is a no-op.
+    """
+    address = _holding_worker(future)
+    if address is None:
+        yield
+        return
+
+    import dask
+
+    with dask.annotate(workers=[address], allow_other_workers=True):
+        yield
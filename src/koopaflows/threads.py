@@ -0,0 +1,186 @@
+import functools
+import os
+import sys
+import threading
+from contextlib import contextmanager
+from typing import Optional
+
+# Number of tasks running at the same time in one process, overrides the
+# slots of `task_slots`. Dask workers use their threads and the cores
+# reserved by the task instead.
+TASK_SLOTS_ENV = "KOOPAFLOWS_TASK_SLOTS"
+# Set to 0 to leave the thread pools of the libraries untouched.
+THREAD_BUDGET_ENV = "KOOPAFLOWS_THREAD_BUDGET"
+# Inherited by subprocesses started by a task.
+THREAD_ENV_VARS = ("OMP_NUM_THREADS", "MKL_NUM_THREADS",
+                   "OPENBLAS_NUM_THREADS")
+
+_lock = threading.Lock()
+_running: list[int] = []
+_slots: list[int] = []
+_restore_limits = None
+_restore_env: dict[str, Optional[str]] = {}
+
+
+def available_cores() -> list[int]:
+    """Cores of the current allocation (SLURM or affinity mask)."""
+    cores = sorted(os.sched_getaffinity(0))
+    slurm_cpus = os.environ.get("SLURM_CPUS_PER_TASK")
+    if slurm_cpus is not None:
+        cores = cores[: int(slurm_cpus)]
+    return cores
+
+
+def _dask_task_threads() -> Optional[int]:
+    """Threads of the running task on a dask worker, None elsewhere."""
+    try:
+        from distributed import get_worker
+        from distributed.worker import thread_state
+        worker = get_worker()
+    except (ImportError, ValueError):
+        return None
+
+    task = worker.state.tasks.get(getattr(thread_state, "key", None))
+    restrictions = getattr(task, "resource_restrictions", None) or {}
+    if restrictions.get("cores", 0) > 0:
+        return int(restrictions["cores"])
+    return max(1, len(available_cores()) // worker.state.nthreads)
+
+
+@contextmanager
+def task_slots(slots: int):
+    """
+    Budgeted tasks started in this context share the allocation with
+    `slots` tasks, the number the flow runs at the same time. The setting
+    is process wide: the ConcurrentTaskRunner runs tasks in threads of the
+    flow process.
+    """
+    slots = max(1, slots)
+    with _lock:
+        _slots.append(slots)
+    try:
+        yield slots
+    finally:
+        with _lock:
+            _slots.remove(slots)
+
+
+def task_threads() -> int:
+    """
+    Threads a task may use: the allocation split between the tasks running
+    at the same time. Outside of `task_slots` (e.g. tasks called directly)
+    it is split between the budgeted tasks currently running.
+    """
+    threads = _dask_task_threads()
+    if threads is not None:
+        return threads
+
+    slots = os.environ.get(TASK_SLOTS_ENV)
+    with _lock:
+        if slots is None and len(_slots) > 0:
+            slots = _slots[-1]
+        running = len(_running)
+    if slots is not None:
+        return max(1, len(available_cores()) // max(1, int(slots)))
+
+    return max(1, len(available_cores()) // max(1, running + 1))
+
+
+@functools.lru_cache(maxsize=None)
+def _threadpool_controller():
+    """Loaded BLAS/OpenMP libraries, looked up once per process."""
+    try:
+        from threadpoolctl import ThreadpoolController
+    except ImportError:
+        return None
+    return ThreadpoolController()
+
+
+def _limit_process(threads: int):
+    """
+    Limit the process wide pools: BLAS/OpenMP via threadpoolctl, the
+    environment of subprocesses and TensorFlow if it is not initialized.
+    """
+    global _restore_limits
+    controller = _threadpool_controller()
+    if controller is not None:
+        limits = controller.limit(limits=threads)
+        # The first limits of a run hold the original settings.
+        if _restore_limits is None:
+            _restore_limits = limits
+
+    for var in THREAD_ENV_VARS:
+        if var not in _restore_env:
+            _restore_env[var] = os.environ.get(var)
+        os.environ[var] = str(threads)
+
+    if "tensorflow" in sys.modules:
+        tf = sys.modules["tensorflow"]
+        try:
+            tf.config.threading.set_intra_op_parallelism_threads(threads)
+            tf.config.threading.set_inter_op_parallelism_threads(1)
+        except RuntimeError:
+            # TensorFlow was initialized already.
+            pass
+
+
+def _restore_process():
+    global _restore_limits
+    if _restore_limits is not None:
+        _restore_limits.restore_original_limits()
+        _restore_limits = None
+
+    for var, value in _restore_env.items():
+        if value is None:
+            os.environ.pop(var, None)
+        else:
+            os.environ[var] = value
+    _restore_env.clear()
+
+
+@contextmanager
+def limit_threads(threads: int):
+    """
+    Run the enclosed code with at most `threads` BLAS/OpenMP, numba and
+    TensorFlow threads. Process wide pools use the smallest limit of the
+    running tasks and are restored when the last one finishes; numba's
+    limit is per thread.
+    """
+    threads = max(1, threads)
+    with _lock:
+        _running.append(threads)
+        if threads <= min(_running):
+            _limit_process(threads)
+
+    numba = sys.modules.get("numba")
+    previous = None
+    if numba is not None:
+        previous = numba.get_num_threads()
+        numba.set_num_threads(min(threads, numba.config.NUMBA_NUM_THREADS))
+
+    try:
+        yield threads
+    finally:
+        if numba is not None:
+            numba.set_num_threads(previous)
+        with _lock:
+            _running.remove(threads)
+            if len(_running) == 0:
+                _restore_process()
+
+
+def budgeted(fn):
+    """
+    Run a task function with its share of the cores, see `task_threads`.
+    Placed below `@task`, the task keeps the signature of `fn`.
+    """
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if os.environ.get(THREAD_BUDGET_ENV, "1") == "0":
+            return fn(*args, **kwargs)
+
+        with limit_threads(task_threads()):
+            return fn(*args, **kwargs)
+
+    return wrapper
@@ -1,5 +1,9 @@
 from typing import Callable
 
+from cpr.utilities.utilities import task_input_hash
+from koopaflows.cpr_parquet import ParquetDatasetSource, ParquetTarget, \
+    consolidate_parquet_targets
+from prefect import task
 from prefect.futures import PrefectFuture
 
 
@@ -11,3 +15,42 @@ def wait_for_task_runs(
 ):
     while len(buffer) >= max(1, max_buffer_length):
         results.append(result_insert_fn(buffer.pop(0)))
+
+
+def completed(future: PrefectFuture) -> PrefectFuture:
+    """
+    `result_insert_fn` which keeps the finished future instead of its
+    result. Downstream tasks submitted with the future depend on it, which
+    lets a dask scheduler place them on the worker holding the result.
+    """
+    future.result()
+    return future
+
+
+def finished(future: PrefectFuture) -> PrefectFuture:
+    """
+    `result_insert_fn` which waits for the task run and keeps its future,
+    failed or not, to inspect the failure later.
+    """
+    future.wait()
+    return future
+
+
+def resolve(item):
+    """Result of a future, anything else is returned as is."""
+    if isinstance(item, PrefectFuture):
+        return item.result()
+    return item
+
+
+def shards(items: list, shard_size: int) -> list[list]:
+    shard_size = max(1, shard_size)
+    return [items[i:i + shard_size] for i in range(0, len(items), shard_size)]
+
+
+@task(cache_key_fn=task_input_hash)
+def consolidate_parquet(
+    targets: list[ParquetTarget],
+    dataset_path: str,
+) -> list[ParquetDatasetSource]:
+    return consolidate_parquet_targets(targets, dataset_path)
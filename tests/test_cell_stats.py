@@ -0,0 +1,75 @@
+import numpy as np
+import pandas as pd
+import pytest
+from skimage.draw import ellipse
+from skimage.measure import regionprops_table
+
+from koopaflows import cell_stats as cell_stats_module
+from koopaflows.cell_stats import cell_stats
+
+
+@pytest.fixture
+def labels_2d():
+    rng = np.random.default_rng(0)
+    labels = np.zeros((300, 300), dtype=np.uint16)
+    for label in range(1, 150):
+        rr, cc = ellipse(*rng.integers(0, 300, 2), *rng.integers(1, 20, 2),
+                         rotation=rng.uniform(0, np.pi), shape=labels.shape)
+        labels[rr, cc] = label
+    # Single pixel object and gaps in the label sequence.
+    labels[3, 3] = 400
+    return labels
+
+
+@pytest.fixture
+def labels_3d():
+    rng = np.random.default_rng(0)
+    labels = np.zeros((20, 100, 100), dtype=np.uint16)
+    for label in range(1, 60):
+        z, y, x = rng.integers(0, 20), *rng.integers(0, 100, 2)
+        labels[max(z - 2, 0):z + 3, max(y - 5, 0):y + rng.integers(1, 8),
+               x:x + 4] = label
+    return labels
+
+
+def assert_matches_regionprops(stats, labels, properties, **kwargs):
+    expected = pd.DataFrame(
+        regionprops_table(labels, properties=properties, **kwargs)
+    ).rename(columns={"intensity_mean": "intensity_mean-0"})
+    for column in expected.columns:
+        np.testing.assert_allclose(stats[column], expected[column],
+                                   atol=1e-9, err_msg=column)
+
+
+def test_cell_stats_2d(labels_2d, monkeypatch):
+    # Small blocks to exercise the accumulation over several blocks.
+    monkeypatch.setattr(cell_stats_module, "BLOCK_SIZE", 1000)
+    image = np.random.default_rng(1).random((2,) + labels_2d.shape)
+
+    stats = cell_stats(labels_2d, image)
+
+    assert_matches_regionprops(
+        stats, labels_2d,
+        ["label", "area", "centroid", "bbox", "inertia_tensor",
+         "inertia_tensor_eigvals", "eccentricity", "intensity_mean"],
+        intensity_image=np.moveaxis(image, 0, -1),
+    )
+    np.testing.assert_allclose(stats["intensity_sum-1"],
+                               stats["intensity_mean-1"] * stats["area"])
+
+
+def test_cell_stats_3d(labels_3d):
+    stats = cell_stats(labels_3d, labels_3d.astype(np.float32))
+
+    assert_matches_regionprops(
+        stats, labels_3d,
+        ["label", "area", "centroid", "bbox", "inertia_tensor",
+         "inertia_tensor_eigvals", "intensity_mean"],
+        intensity_image=labels_3d.astype(np.float32),
+    )
+    assert "eccentricity" not in stats.columns
+
+
+def test_cell_stats_empty():
+    stats = cell_stats(np.zeros((10, 10), dtype=np.uint8))
+    assert len(stats) == 0
@@ -0,0 +1,109 @@
+import logging
+import signal
+
+import numpy as np
+from prefect import flow, task
+
+from koopaflows.escalation import EscalationReport, MemoryEscalation, \
+    is_out_of_memory, raises_memory, retry_out_of_memory
+from koopaflows.recycling import ProcessRecycling, WorkerDied, run_recycled
+
+
+def reserve(gb: float) -> float:
+    np.empty(int(gb * 1e9), dtype=np.uint8)
+    return gb
+
+
+@task
+def allocate(gb: float, recycling: ProcessRecycling) -> float:
+    return run_recycled(reserve, recycling, gb=gb)
+
+
+@task
+def broken():
+    raise ValueError("not a memory problem")
+
+
+def test_is_out_of_memory():
+    assert is_out_of_memory(MemoryError())
+    assert is_out_of_memory(WorkerDied("task", -signal.SIGKILL))
+    assert is_out_of_memory(RuntimeError("CUDA out of memory"))
+    assert not is_out_of_memory(WorkerDied("task", 1))
+    assert not is_out_of_memory(ValueError("broken"))
+
+
+def test_out_of_memory_tasks_are_rerun_with_more_memory(tmp_path):
+    # The memory limit of the recycled subprocess stands in for the memory
+    # of a cluster node.
+    recycling = ProcessRecycling(active=True, memory_limit=3)
+    report = EscalationReport(str(tmp_path / "escalations.md"))
+    sizes = [0.5, 4, 20]
+
+    @flow
+    def escalating_flow():
+        futures = [allocate.submit(gb, recycling) for gb in sizes]
+        futures.append(broken.submit())
+        for future in futures:
+            future.wait()
+
+        return retry_out_of_memory(
+            futures,
+            names=["small", "large", "huge", "broken"],
+            resubmit=lambda i, factor: allocate.submit(
+                sizes[i], recycling.scaled(factor)
+            ),
+            stage="preprocess",
+            escalation=MemoryEscalation(max_attempts=2, factor=2),
+            report=report,
+            logger=logging.getLogger(__name__),
+        )
+
+    assert escalating_flow() == [0.5, 4, None, None]
+
+    outcomes = {(e["name"], e["memory_factor"], e["outcome"])
+                for e in report.entries}
+    assert outcomes == {("large", 2, "completed"),
+                        ("huge", 4, "out of memory"),
+                        ("broken", 1, "failed")}
+    assert "| preprocess | large | 2 | completed |" in \
+           (tmp_path / "escalations.md").read_text()
+
+
+def test_raises_memory(monkeypatch):
+    monkeypatch.delenv("KOOPAFLOWS_CLUSTER_CONFIG", raising=False)
+    assert raises_memory(ProcessRecycling(active=True, memory_limit=3))
+    assert not raises_memory(ProcessRecycling(active=True))
+    assert not raises_memory(ProcessRecycling(memory_limit=3))
+
+
+def test_out_of_memory_tasks_without_limit_are_retried_unscaled(tmp_path):
+    report = EscalationReport(str(tmp_path / "escalations.md"))
+    factors = []
+
+    @task
+    def out_of_memory():
+        raise MemoryError()
+
+    def resubmit(i, factor):
+        factors.append(factor)
+        return out_of_memory.submit()
+
+    @flow
+    def retrying_flow():
+        future = out_of_memory.submit()
+        future.wait()
+        return retry_out_of_memory(
+            [future],
+            names=["huge"],
+            resubmit=resubmit,
+            stage="preprocess",
+            escalation=MemoryEscalation(max_attempts=2, factor=2),
+            report=report,
+            logger=logging.getLogger(__name__),
+            escalates=False,
+        )
+
+    assert retrying_flow() == [None]
+    assert factors == [1, 1]
+    assert [(e["name"], e["memory_factor"], e["outcome"])
+            for e in report.entries] == [("huge", 1, "out of memory")]
@@ -0,0 +1,101 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+pytest.importorskip("tf2onnx")
+pytest.importorskip("onnxruntime")
+pytest.importorskip("deepblink")
+
+from koopaflows.spot_detection.inference import (  # noqa: E402
+    DeepBlinkInference,
+    check_parity,
+    detect_image,
+    inference_model_hash,
+    load_inference_model,
+    onnx_model_path,
+    synthetic_spots,
+)
+
+
+@pytest.fixture(scope="module")
+def model_path(tmp_path_factory):
+    """Small fully convolutional stand-in with deepBlink's in/output layout."""
+    tf.keras.utils.set_random_seed(0)
+    inputs = tf.keras.layers.Input(shape=(None, None, 1))
+    x = tf.keras.layers.Conv2D(8, 3, padding="same", activation="relu")(inputs)
+    x = tf.keras.layers.MaxPooling2D(2)(x)
+    x = tf.keras.layers.Conv2D(8, 3, padding="same", activation="relu")(x)
+    x = tf.keras.layers.MaxPooling2D(2)(x)
+    outputs = tf.keras.layers.Conv2D(3, 1, activation="sigmoid")(x)
+    path = str(tmp_path_factory.mktemp("model") / "model.h5")
+    tf.keras.Model(inputs, outputs).save(path)
+    return path
+
+
+@pytest.mark.parametrize("quantize", [False, True])
+def test_onnx_parity(model_path, quantize):
+    reference = load_inference_model(model_path)
+    model = load_inference_model(
+        model_path,
+        DeepBlinkInference(backend="onnx", quantize=quantize,
+                           intra_op_threads=1),
+    )
+    images = [synthetic_spots(seed=seed)[0] for seed in range(3)]
+
+    parity = check_parity(reference, model, images)
+
+    assert parity["max_abs_error"] < (5e-2 if quantize else 1e-4)
+    assert parity["recall"] > (0.9 if quantize else 0.99)
+
+
+def test_onnx_conversion_is_cached(model_path):
+    inference = DeepBlinkInference(backend="onnx")
+    model = load_inference_model(model_path, inference)
+    assert model.path == onnx_model_path(model_path)
+
+    mtime = os.stat(model.path).st_mtime_ns
+    load_inference_model(model_path, inference)
+    assert os.stat(model.path).st_mtime_ns == mtime
+
+
+def test_inference_model_hash_depends_on_backend(model_path):
+    hashes = {
+        inference_model_hash(model_path, DeepBlinkInference(**kwargs))
+        for kwargs in [{}, {"backend": "onnx"},
+                       {"backend": "onnx", "quantize": True}]
+    }
+    assert len(hashes) == 3
+
+
+def test_cached_outputs_match_koopa(model_path, tmp_path):
+    pytest.importorskip("trackpy")
+    model = load_inference_model(model_path, output_cache=str(tmp_path))
+    calls = []
+    predict = model.model.predict
+    model.model.predict = lambda x, *args, **kwargs: \
+        calls.append(x.shape) or predict(x, *args, **kwargs)
+    image = synthetic_spots(seed=0)[0][np.newaxis]
+
+    for radius in [3, 5]:
+        spots = detect_image(image, 0, model, refinement_radius=radius)
+        # A rerun takes the outputs from the cache.
+        n_calls = len(calls)
+        pd.testing.assert_frame_equal(
+            spots, detect_image(image, 0, model, refinement_radius=radius)
+        )
+        assert len(calls) == n_calls
+        # The cached outputs give koopa's detections at every radius.
+        pd.testing.assert_frame_equal(
+            spots, detect_image(image, 0, model.model,
+                                refinement_radius=radius)
+        )
+    # The network input is padded by the radius, other radii are not reused.
+    assert len(calls) == 4
+
+    onnx = load_inference_model(model_path,
+                                DeepBlinkInference(backend="onnx"),
+                                output_cache=str(tmp_path))
+    assert onnx.cache_dir != model.cache_dir
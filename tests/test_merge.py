@@ -0,0 +1,88 @@
+import numpy as np
+import pandas as pd
+import pytest
+from skimage.draw import ellipse
+
+pytest.importorskip("cpr")
+postprocess = pytest.importorskip("koopa.postprocess")
+
+from koopaflows.cpr_image import create_image_target, \
+    image_from_dict  # noqa: E402
+from koopaflows.merge import load_partition, merge_segmaps_sparse, \
+    save_partition  # noqa: E402
+
+
+def random_labels(shape, n_cells, rng):
+    labels = np.zeros(shape, dtype=np.uint16)
+    for label in range(1, n_cells + 1):
+        rr, cc = ellipse(*rng.integers(0, shape[0], 2),
+                         *rng.integers(3, 25, 2),
+                         rotation=rng.uniform(0, np.pi), shape=shape)
+        labels[rr, cc] = label
+    return labels
+
+
+@pytest.mark.parametrize("image_format", ["tif", "zarr"])
+def test_sparse_merge_matches_koopa(tmp_path, image_format):
+    if image_format == "zarr":
+        pytest.importorskip("zarr")
+
+    rng = np.random.default_rng(0)
+    cyto = random_labels((256, 256), 40, rng)
+    nuclei = np.where(rng.random(cyto.shape) > 0.5, cyto, 0)
+    other = random_labels((256, 256), 10, rng)
+    spots = pd.DataFrame({
+        "FileID": "image",
+        "y": rng.uniform(0, 260, 500),
+        "x": rng.uniform(0, 256, 500),
+        "frame": 0,
+        "channel": 1,
+    })
+
+    segmaps = {"cyto": cyto, "nuclei": nuclei, "other_c2": other}
+    targets = {}
+    for name, data in segmaps.items():
+        target = create_image_target(str(tmp_path), name,
+                                     image_format, labels=True,
+                                     imagej=False)
+        target.set_data(data)
+        targets[name] = type(target)(**target.serialize())
+
+    df, df_cell = postprocess.merge_segmaps(spots.copy(), segmaps,
+                                            fname="image")
+    df_sparse, df_cell_sparse = merge_segmaps_sparse(spots.copy(), targets,
+                                                     fname="image")
+
+    pd.testing.assert_frame_equal(df_sparse, df, check_dtype=False)
+    pd.testing.assert_frame_equal(df_cell_sparse, df_cell, check_dtype=False)
+
+
+@pytest.mark.parametrize("image_format", ["tif", "zarr"])
+def test_label_targets_keep_their_index_when_deserialized(tmp_path,
+                                                         image_format):
+    if image_format == "zarr":
+        pytest.importorskip("zarr")
+
+    labels = random_labels((64, 64), 5, np.random.default_rng(0))
+    target = create_image_target(str(tmp_path), "labels", image_format,
+                                 labels=True)
+    target.set_data(labels)
+
+    restored = image_from_dict(target.serialize())
+    assert type(restored) is type(target)
+    assert len(restored.get_object_index()) == len(np.unique(labels)) - 1
+    assert type(image_from_dict(
+        create_image_target(str(tmp_path), "image", image_format).serialize()
+    )) is not type(target)
+
+
+def test_reused_partitions_are_lossless(tmp_path):
+    df = pd.DataFrame({"FileID": ["a"] * 3, "y": [0.1, 1 / 3, 2e-9],
+                       "cell_id": np.array([0, 1, 70000], np.int64)})
+    df_cell = pd.DataFrame({"FileID": ["a"], "area_cyto": [1 / 7]})
+    save_partition(str(tmp_path), "a", "fingerprint", df, df_cell)
+
+    assert load_partition(str(tmp_path), "a", "other") is None
+    spots, cells = load_partition(str(tmp_path), "a", "fingerprint")
+    pd.testing.assert_frame_equal(spots, df)
+    pd.testing.assert_frame_equal(cells, df_cell)
@@ -0,0 +1,36 @@
+import pandas as pd
+import pytest
+
+pytest.importorskip("cpr.Serializer")
+
+from koopaflows.cpr_parquet import ParquetTarget, \
+    consolidate_parquet_targets, read_parquet  # noqa: E402
+
+
+def spot_target(tmp_path, name: str, n: int) -> ParquetTarget:
+    target = ParquetTarget(location=str(tmp_path), name=name)
+    target.set_data(pd.DataFrame({
+        "FileID": [name] * n,
+        "y": [float(i) for i in range(n)],
+        "x": [float(i) for i in range(n)],
+    }))
+    target._write_data()
+    return target
+
+
+def test_consolidation_keeps_images_of_earlier_runs(tmp_path):
+    dataset = str(tmp_path / "detection_raw_c0.parq")
+    consolidate_parquet_targets(
+        [spot_target(tmp_path, "a", 3), spot_target(tmp_path, "b", 2)],
+        dataset,
+    )
+    # A later run with a new image and a re-detected one.
+    sources = consolidate_parquet_targets(
+        [spot_target(tmp_path, "b", 4), spot_target(tmp_path, "c", 1)],
+        dataset,
+    )
+
+    df = read_parquet(dataset)
+    assert df.groupby("FileID").size().to_dict() == {"a": 3, "b": 4, "c": 1}
+    assert [len(s.get_data()) for s in sources] == [4, 1]
+    assert not (tmp_path / "b.parq").exists()
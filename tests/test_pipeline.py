@@ -0,0 +1,130 @@
+import os
+import threading
+import time
+import weakref
+
+import pytest
+from koopaflows.pipeline import CACHE_DIR, BatchError, ResultCache, \
+    cached_pipelined, input_fingerprint, pipelined
+
+
+def test_pipelined_keeps_order_and_bounds_memory():
+    lock = threading.Lock()
+    held, max_held = 0, 0
+
+    def load(item):
+        nonlocal held, max_held
+        with lock:
+            held += 1
+            max_held = max(max_held, held)
+        time.sleep(0.01)
+        return item * 10
+
+    def write(item, result):
+        nonlocal held
+        time.sleep(0.02)
+        with lock:
+            held -= 1
+        return item, result
+
+    results = pipelined(list(range(10)), load=load,
+                        compute=lambda item, data: data + 1, write=write,
+                        in_flight=2)
+
+    assert results == [(i, i * 10 + 1) for i in range(10)]
+    assert max_held == 2
+
+
+class Image:
+    pass
+
+
+def test_pipelined_releases_loaded_items():
+    alive = weakref.WeakSet()
+    max_alive = 0
+
+    def load(item):
+        nonlocal max_alive
+        image = Image()
+        alive.add(image)
+        max_alive = max(max_alive, len(alive))
+        return image
+
+    def compute(item, image):
+        time.sleep(0.005)
+        return item
+
+    results = pipelined(list(range(20)), load=load, compute=compute,
+                        write=lambda item, result: result, in_flight=3)
+
+    assert results == list(range(20))
+    assert max_alive <= 3
+    assert len(alive) == 0
+
+
+def test_pipelined_overlaps_io_and_compute():
+    def sleep(*args):
+        time.sleep(0.05)
+
+    start = time.perf_counter()
+    pipelined(list(range(6)), load=sleep, compute=sleep, write=sleep,
+              in_flight=3)
+    # Sequential processing takes 0.9s.
+    assert time.perf_counter() - start < 0.6
+
+
+def test_pipelined_raises_compute_errors():
+    def compute(item, data):
+        if item == 3:
+            raise ValueError("broken image")
+        return data
+
+    with pytest.raises(ValueError, match="broken image"):
+        pipelined(list(range(8)), load=lambda item: item, compute=compute,
+                  write=lambda item, result: result, in_flight=2)
+
+
+class FileResource:
+    def __init__(self, location, name):
+        self.location = location
+        self.name = name
+
+    def get_path(self):
+        return os.path.join(self.location, self.name)
+
+    def serialize(self):
+        return {"location": self.location, "name": self.name}
+
+
+def test_cached_pipelined_reruns_only_failed_images(tmp_path):
+    cache = ResultCache(str(tmp_path / CACHE_DIR))
+    items = [f"img{i}" for i in range(5)]
+    keys = [input_fingerprint([], item=item) for item in items]
+    computed = []
+    broken = {"img3"}
+
+    def compute(item, data):
+        computed.append(item)
+        if item in broken:
+            raise ValueError(item)
+        return data
+
+    def write(item, data):
+        (tmp_path / item).write_text(data)
+        return FileResource(str(tmp_path), item)
+
+    def run():
+        return cached_pipelined(items, names=items, keys=keys, cache=cache,
+                                load=lambda item: item, compute=compute,
+                                write=write, in_flight=2)
+
+    with pytest.raises(BatchError, match="img3"):
+        run()
+    assert computed == items
+
+    computed.clear()
+    broken.clear()
+    results = run()
+    assert computed == ["img3"]
+    assert [r.name for r in results] == items
+    assert isinstance(results[0], FileResource)
@@ -0,0 +1,189 @@
+import json
+
+import numpy as np
+import pytest
+import tifffile
+
+pytest.importorskip("cpr")
+
+from koopaflows.pipeline import ResultCache, cached_pipelined  # noqa: E402
+from koopaflows.planning import FLOW_STAGES, PROFILE_DIR_ENV, \
+    Preprocessing, Queue, estimate_stage, load_costs, main, plan_run, \
+    profiled, read_header, scan_headers  # noqa: E402
+from koopaflows.task_runners import DaskCluster  # noqa: E402
+
+
+def write_nd(tmp_path, stem: str, shape: tuple) -> str:
+    channels = ["DAPI", "Cy5"]
+    for i, name in enumerate(channels):
+        tifffile.imwrite(tmp_path / f"{stem}_w{i + 1}{name}.stk",
+                         np.zeros(shape, np.uint8))
+    lines = ['"NDInfoFile", Version 1.0', f'"NWavelengths", {len(channels)}']
+    lines += [f'"WaveName{i + 1}", "{name}"'
+              for i, name in enumerate(channels)]
+    (tmp_path / f"{stem}.nd").write_text("\n".join(lines + ['"EndFile"']))
+    return str(tmp_path / f"{stem}.nd")
+
+
+def test_read_header(tmp_path):
+    tifffile.imwrite(tmp_path / "a.tif", np.zeros((5, 32, 48), np.uint16))
+    nd = write_nd(tmp_path, "b", (7, 16, 16))
+    (tmp_path / "broken.tif").write_bytes(b"not a tif")
+
+    header = read_header(str(tmp_path / "a.tif"))
+    assert header.shape == (1, 5, 32, 48)
+    assert header.dtype == "uint16"
+    # Channels of .nd files are merged and cast to uint16.
+    assert read_header(nd).shape == (2, 7, 16, 16)
+    assert read_header(nd).dtype == "uint16"
+
+    # Single plane channels keep their position, Z is 1.
+    for stack in [(16, 16), (1, 16, 16)]:
+        nd = write_nd(tmp_path, "c", stack)
+        header = read_header(nd)
+        assert header.shape == (2, 1, 16, 16)
+        assert header.z_depth == 1
+        assert header.projected_gvoxels == 2 * 16 * 16 / 1e9
+    (tmp_path / "d.zarr").mkdir()
+    (tmp_path / "d.zarr" / ".zarray").write_text(
+        json.dumps({"shape": [1, 3, 1, 32, 48], "dtype": "<u2"})
+    )
+    assert read_header(str(tmp_path / "d.zarr")).shape == (3, 1, 32, 48)
+
+    headers, errors = scan_headers(
+        [str(tmp_path / n) for n in ["a.tif", "broken.tif"]], workers=2
+    )
+    assert [h.shape for h in headers] == [(1, 5, 32, 48)]
+    assert list(errors) == [str(tmp_path / "broken.tif")]
+
+
+def test_profiled_tasks_record_costs(tmp_path, monkeypatch):
+    tifffile.imwrite(tmp_path / "a.tif", np.zeros((4, 50, 50), np.uint16))
+
+    @profiled("segment_other", "img")
+    def segment(img, threshold=1):
+        return threshold
+
+    assert segment(str(tmp_path / "a.tif")) == 1
+    assert not (tmp_path / "profiles").exists()
+
+    monkeypatch.setenv(PROFILE_DIR_ENV, str(tmp_path / "profiles"))
+    for _ in range(3):
+        segment(img=str(tmp_path / "a.tif"), threshold=2)
+
+    records = (tmp_path / "profiles" / "segment_other.jsonl").read_text()
+    assert len(records.splitlines()) == 3
+    assert json.loads(records.splitlines()[0])["gvoxels"] == 1e-05
+
+    costs = load_costs(str(tmp_path / "profiles"))
+    assert costs["segment_other"].samples == 3
+    assert costs["segment_nuclei"].samples == 0
+
+
+class FileResource:
+    def __init__(self, path):
+        self.path = path
+
+    def get_path(self):
+        return self.path
+
+    def serialize(self):
+        return {"path": self.path}
+
+
+def test_batch_tasks_record_only_processed_images(tmp_path, monkeypatch):
+    monkeypatch.setenv(PROFILE_DIR_ENV, str(tmp_path / "profiles"))
+    files = []
+    for i, size in enumerate([10, 20, 40]):
+        files.append(str(tmp_path / f"{i}.tif"))
+        tifffile.imwrite(files[-1], np.zeros((size, 100, 100), np.uint8))
+    cache = ResultCache(str(tmp_path / "cache"))
+    cache.save("0", FileResource(files[0]))
+
+    @profiled("segment_other", "imgs")
+    def segment_batch(imgs):
+        return cached_pipelined(imgs, names=imgs, keys=["0", "1", "2"],
+                                cache=cache, load=lambda f: f,
+                                compute=lambda f, data: data,
+                                write=lambda f, data: FileResource(data))
+
+    segment_batch(files)
+    # Every image is cached now, nothing to record.
+    segment_batch(files)
+
+    records = (tmp_path / "profiles" / "segment_other.jsonl").read_text()
+    assert [json.loads(line)["gvoxels"] for line in records.splitlines()] \
+        == [0.0006]
+
+
+def test_brain_stages_see_the_preprocessed_volume(tmp_path):
+    tifffile.imwrite(tmp_path / "a.tif", np.zeros((2, 4, 8, 8), np.uint16))
+    header = read_header(str(tmp_path / "a.tif")).copy(
+        update={"shape": (2, 100, 2048, 2048)}
+    )
+    preprocessing = Preprocessing(crop_start=24, crop_end=2024,
+                                  bin_axes=(1, 1, 4, 4))
+    assert header.preprocessed_gvoxels(preprocessing) == \
+        2 * 100 * 500 * 500 / 1e9
+
+    stages = FLOW_STAGES["brain_3d"]
+    estimate = estimate_stage("spots", stages["spots"], [header],
+                              load_costs(None), cluster=DaskCluster(),
+                              headroom=1, task_seconds=300,
+                              preprocessing=preprocessing)
+    assert estimate.gvoxels == 0.05
+    assert estimate_stage("preprocess", stages["preprocess"], [header],
+                          load_costs(None), DaskCluster(), 1, 300,
+                          preprocessing).gvoxels == round(header.gvoxels, 3)
+
+
+def test_plan_run(tmp_path):
+    for i in range(40):
+        tifffile.imwrite(tmp_path / f"img{i}.tif",
+                         np.zeros((2, 4, 8, 8), np.uint16))
+    headers, _ = scan_headers(
+        [str(tmp_path / f"img{i}.tif") for i in range(40)]
+    )
+    # Pretend the images are large: 1 Gvoxel each.
+    headers = [h.copy(update={"shape": (2, 50, 100, 100_000)})
+               for h in headers]
+    cluster = DaskCluster(cores=8, memory=64, max_workers=2)
+    plan = plan_run("fixed_cell", str(tmp_path), "tif", headers,
+                    load_costs(None), cluster,
+                    [Queue.parse("short:0.1"), Queue.parse("long:48:256")])
+
+    preprocess = plan.stages[0]
+    assert preprocess.stage == "preprocess"
+    # 12 GB per Gvoxel, 1.25 headroom: 16 GB per task, 4 per worker.
+    assert preprocess.memory == 16
+    assert preprocess.per_worker == 4
+    # 8 slots, 60 s per image: batches of 5 images run 300 s.
+    assert preprocess.batch_size == 5
+    assert preprocess.shards == 8
+    assert plan.cluster.stages["preprocess"].memory == 16
+    assert plan.batching_sizes["preprocess"] == plan.shard_size == 5
+    assert plan.queue == "long"
+    assert plan.warnings == []
+
+
+def test_no_images_is_a_usage_error(tmp_path, capsys):
+    with pytest.raises(SystemExit):
+        main([str(tmp_path), "--ext", "tif", "--dry-run"])
+    assert "No readable .tif images" in capsys.readouterr().err
+
+
+def test_dry_run_writes_nothing(tmp_path, capsys):
+    tifffile.imwrite(tmp_path / "a.tif", np.zeros((3, 16, 16), np.uint16))
+    out = tmp_path / "plan"
+
+    main([str(tmp_path), "--ext", "tif", "--flow", "brain_3d",
+          "--output", str(out), "--dry-run", "--queue", "short:4"])
+    assert "cluster.json" in capsys.readouterr().out
+    assert not out.exists()
+
+    plan = main([str(tmp_path), "--ext", "tif", "--flow", "brain_3d",
+                 "--output", str(out), "--queue", "short:4"])
+    with open(out / "cluster.json") as f:
+        assert DaskCluster(**json.load(f)).queue == "short"
+    assert json.loads((out / "plan.json").read_text())["images"] == \
+        plan.images == 1
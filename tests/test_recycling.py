@@ -0,0 +1,87 @@
+import os
+
+import pytest
+from koopaflows.recycling import ProcessRecycling, RecyclingPool, \
+    WorkerDied, _pool, run_recycled
+
+# Held by the worker process between tasks.
+_ballast = []
+
+
+def pid():
+    return os.getpid()
+
+
+def allocate(mb: int):
+    _ballast.append(bytearray(mb * 2 ** 20))
+    return os.getpid()
+
+
+def fail():
+    raise ValueError("broken volume")
+
+
+def die():
+    os._exit(3)
+
+
+def test_workers_are_recycled_after_max_tasks():
+    pool = RecyclingPool(ProcessRecycling(active=True, max_tasks=2))
+    try:
+        pids = [pool.run(pid) for _ in range(5)]
+    finally:
+        pool.close()
+
+    assert pids[0] == pids[1] != pids[2] == pids[3] != pids[4]
+    assert os.getpid() not in pids
+    assert pool.n_started == 3
+
+
+def test_workers_are_recycled_above_max_rss():
+    pool = RecyclingPool(ProcessRecycling(active=True, max_tasks=100,
+                                          max_rss=0.2))
+    try:
+        first = pool.run(allocate, mb=10)
+        assert pool.run(allocate, mb=10) == first
+        assert pool.run(allocate, mb=300) == first
+        assert pool.run(allocate, mb=10) != first
+    finally:
+        pool.close()
+
+
+def test_errors_and_dead_workers():
+    pool = RecyclingPool(ProcessRecycling(active=True))
+    try:
+        with pytest.raises(ValueError, match="broken volume"):
+            pool.run(fail)
+        with pytest.raises(WorkerDied) as e:
+            pool.run(die)
+        assert e.value.exitcode == 3
+        assert pool.run(pid) != os.getpid()
+    finally:
+        pool.close()
+
+
+def test_inactive_runs_in_process():
+    assert run_recycled(pid, ProcessRecycling()) == os.getpid()
+
+
+def test_scaled_pools_share_the_processes():
+    recycling = ProcessRecycling(active=True, max_tasks=100, memory_limit=8)
+    pool = _pool(recycling)
+    scaled = _pool(recycling.scaled(2))
+    try:
+        first = run_recycled(pid, recycling)
+        worker = pool._idle[0]
+        # Rerun with a scaled memory limit after running out of memory.
+        assert scaled is not pool
+        assert _pool(recycling) is pool
+        assert run_recycled(pid, recycling.scaled(2)) != first
+        # The idle subprocess of the other pool made way for the rerun.
+        assert not worker.process.is_alive()
+        assert len(scaled._idle) == 1
+        assert run_recycled(pid, recycling) not in (first, os.getpid())
+        assert len(scaled._idle) == 0
+    finally:
+        pool.close()
+        scaled.close()
@@ -0,0 +1,92 @@
+import os
+
+import pytest
+
+pytest.importorskip("cpr")
+
+from koopaflows.staging import Prefetcher, WriteBack, \
+    companion_files, copy_verified  # noqa: E402
+
+
+def write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(content)
+
+
+def test_companion_files(tmp_path):
+    for name in ["a.nd", "a_w1.stk", "a_w2.stk", "b.nd", "b_w1.stk"]:
+        write(str(tmp_path / name), b"x")
+
+    names = [os.path.basename(f)
+             for f in companion_files(str(tmp_path / "a.nd"))]
+    assert names == ["a.nd", "a_w1.stk", "a_w2.stk"]
+    assert companion_files(str(tmp_path / "a_w1.stk")) == \
+           [str(tmp_path / "a_w1.stk")]
+
+
+def write_nd(directory, stem, channels):
+    for i, name in enumerate(channels):
+        write(str(directory / f"{stem}_w{i + 1}{name}.stk"), stem.encode())
+    lines = [f'"NWavelengths", {len(channels)}']
+    lines += [f'"WaveName{i + 1}", "{name}"' for i, name in enumerate(channels)]
+    write(str(directory / f"{stem}.nd"), "\n".join(lines + [""]).encode())
+    return str(directory / f"{stem}.nd")
+
+
+def test_releasing_an_image_keeps_images_with_longer_stems(tmp_path):
+    files = [write_nd(tmp_path / "raw", stem, ["DAPI", "Cy5"])
+             for stem in ["x_1", "x_10"]]
+    assert [os.path.basename(f) for f in companion_files(files[0])] == \
+           ["x_1.nd", "x_1_w1DAPI.stk", "x_1_w2Cy5.stk"]
+
+    prefetcher = Prefetcher(files, str(tmp_path / "scratch"), depth=2)
+    local_1, local_10 = prefetcher.get(files[0]), prefetcher.get(files[1])
+    prefetcher.release(local_1)
+    prefetcher.close()
+
+    assert not os.path.exists(local_1)
+    assert sorted(os.listdir(os.path.dirname(local_10))) == \
+           ["x_10.nd", "x_10_w1DAPI.stk", "x_10_w2Cy5.stk"]
+
+
+def test_copy_verified_directory(tmp_path):
+    write(str(tmp_path / "src.zarr" / "0" / "0.0"), b"chunk")
+    write(str(tmp_path / "src.zarr" / ".zarray"), b"{}")
+
+    copy_verified(str(tmp_path / "src.zarr"), str(tmp_path / "dst.zarr"))
+
+    with open(tmp_path / "dst.zarr" / "0" / "0.0", "rb") as f:
+        assert f.read() == b"chunk"
+    assert not any(name.endswith(".part")
+                   for _, _, files in os.walk(tmp_path) for name in files)
+
+
+def test_prefetch_and_write_back(tmp_path):
+    files = []
+    for i in range(5):
+        files.append(str(tmp_path / "raw" / f"{i}.tif"))
+        write(files[-1], bytes([i]) * 100)
+
+    prefetcher = Prefetcher(files, str(tmp_path / "scratch"), depth=2)
+    write_back = WriteBack(batch_size=2)
+    for file in files:
+        local = prefetcher.get(file)
+        assert local != file
+        with open(local, "rb") as f:
+            content = f.read()
+        prefetcher.release(local)
+        assert not os.path.exists(local)
+
+        out = str(tmp_path / "scratch-out" / os.path.basename(file))
+        write(out, content)
+        write_back.add(out, str(tmp_path / "out" / os.path.basename(file)))
+
+    prefetcher.close()
+    write_back.close()
+
+    for file in files:
+        with open(file, "rb") as f, \
+                open(tmp_path / "out" / os.path.basename(file), "rb") as g:
+            assert f.read() == g.read()
+    assert os.listdir(tmp_path / "scratch-out") == []
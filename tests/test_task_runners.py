@@ -0,0 +1,48 @@
+import pytest
+
+pytest.importorskip("prefect_dask")
+
+from prefect import flow, task  # noqa: E402
+
+from koopaflows.task_runners import (  # noqa: E402
+    DaskCluster,
+    StageResources,
+    dask_task_runner,
+    stage,
+)
+
+
+@task
+def square(x: int) -> int:
+    return x * x
+
+
+def local_cluster(**stages) -> DaskCluster:
+    return DaskCluster(backend="local", cores=2, memory=2, min_workers=1,
+                       max_workers=2, stages=stages)
+
+
+def test_local_cluster_runs_annotated_stage():
+    cluster = local_cluster(heavy=StageResources(memory=2, max_workers=1),
+                            light=StageResources(cores=1))
+
+    @flow(task_runner=dask_task_runner(cluster))
+    def staged_flow():
+        with stage("heavy", cluster):
+            heavy = [square.submit(i) for i in range(3)]
+        with stage("light", cluster):
+            light = [square.submit(i) for i in range(3)]
+        return [f.result() for f in heavy + light]
+
+    assert staged_flow() == [0, 1, 4, 0, 1, 4]
+
+
+def test_stage_larger_than_worker():
+    with pytest.raises(AssertionError):
+        dask_task_runner(local_cluster(huge=StageResources(memory=64)))
+
+
+def test_stage_without_cluster_is_noop(monkeypatch):
+    monkeypatch.delenv("KOOPAFLOWS_CLUSTER_CONFIG", raising=False)
+    with stage("preprocess"):
+        pass
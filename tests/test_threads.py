@@ -0,0 +1,56 @@
+import inspect
+import os
+
+import numpy as np
+import pytest
+
+from koopaflows import threads
+from koopaflows.threads import TASK_SLOTS_ENV, budgeted, limit_threads, \
+    task_slots, task_threads
+
+
+@pytest.fixture
+def eight_cores(monkeypatch):
+    monkeypatch.setattr(threads, "available_cores", lambda: list(range(8)))
+
+
+def test_task_threads_split_the_allocation(eight_cores, monkeypatch):
+    assert task_threads() == 8
+    with limit_threads(2):
+        with limit_threads(2):
+            assert task_threads() == 2
+
+    # The first task of a stage gets its share, not the whole allocation.
+    with task_slots(4):
+        assert task_threads() == 2
+        with task_slots(48):
+            assert task_threads() == 1
+        assert task_threads() == 2
+
+    monkeypatch.setenv(TASK_SLOTS_ENV, "3")
+    with task_slots(4):
+        assert task_threads() == 2
+
+
+def test_limit_threads_restores_process_limits():
+    threadpoolctl = pytest.importorskip("threadpoolctl")
+    np.ones((4, 4)) @ np.ones((4, 4))
+    original = {p["internal_api"]: p["num_threads"]
+                for p in threadpoolctl.threadpool_info()}
+
+    with limit_threads(1):
+        assert os.environ["OMP_NUM_THREADS"] == "1"
+        assert all(p["num_threads"] == 1
+                   for p in threadpoolctl.threadpool_info())
+
+    assert {p["internal_api"]: p["num_threads"]
+            for p in threadpoolctl.threadpool_info()} == original
+
+
+def test_budgeted_keeps_signature():
+    @budgeted
+    def square(x: int, power: int = 2) -> int:
+        return x ** power
+
+    assert square(3) == 9
+    assert list(inspect.signature(square).parameters) == ["x", "power"]